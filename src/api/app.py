@@ -1,24 +1,349 @@
 import os
 import logging
+from collections import OrderedDict
+from functools import partial
 
-from flask import Flask, jsonify, make_response
+from flask import Flask, jsonify, make_response, request
 from pymodm import connect
 
 from core.logging_setup import setup_logging
 setup_logging()
-from api.decorators import log_latency_decorator
+from api.cache import FILE_CACHE
+from api.coalesce import COALESCER
+from api.compression import IDENTITY, compress, negotiate, supported_encodings
+from api.decorators import metrics_decorator
 from api.exceptions import APIException, FileInvalidStatusError, FileNotFound
+from api.external_api import SESSION_POOL, SegmentStream
+from api.fieldsets import FieldSet
+from api.ingestion import INGESTION_QUEUE
 from api.jobs import GeventJobs
+from api.limiter import UPSTREAM_LIMITER
+from api.metrics import METRICS, STAGE_LATENCY
 from api.models import FileModel
+from api.negative_cache import NEGATIVE_CACHE
+from api.refresh import EXPIRED, REFRESHER, STALE, freshness, unexpired
+from api.resilience import UPSTREAM_POLICY
+from api.search import SEARCH_INDEX, SEARCH_RESULTS_SIZE
+from api.segments import SEGMENTS_PAGE_MAX, SEGMENTS_PAGE_SIZE, SEGMENT_STORE
+from api.serialization import render
+from api.storage import presentation, render_stored_file, save_file, save_files, unpack_file
+from api.streaming import StreamedFile
+from api.utils import FileStatus
+from api.warmer import last_report
+from api.write_behind import SAVE_QUEUE
 
 app = Flask(__name__)
 LOGGER = logging.getLogger(__name__)
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 100))
+# shared secret the processing API sends in the X-Ingestion-Token header. Not checked if unset.
+INGESTION_TOKEN = os.environ.get('INGESTION_TOKEN')
 LOGGER.debug(f"Connecting to {os.environ.get('DB_CONNECTION_STRING')}.")
 connect(os.environ.get('DB_CONNECTION_STRING'))
 
 
+def gevent_loop_active():
+    import gevent
+
+    return gevent.get_hub().loop.activecnt
+
+
+METRICS.gauge('coalescer_in_flight', "Upstream fetches in flight in the fetch coalescer.").set_function(
+    lambda: COALESCER.stats()['in_flight']
+)
+METRICS.gauge('gevent_loop_active', "Active watchers of the gevent loop, i.e. green threads waiting on I/O or timers.").set_function(
+    gevent_loop_active
+)
+
+
+def json_response(body, status):
+    """
+    Response for an already serialized JSON body.
+    """
+    return app.response_class(body, status=status, mimetype='application/json')
+
+
+def load_file(model, file_id):
+    """
+    Read a file from local storage, or from the write-behind queue if it is yet to be saved.
+    Returns a (document, status) tuple or None if it is not stored or has expired.
+    Raises the cached error if the file is in the negative cache.
+    """
+    queued = SAVE_QUEUE.pending(file_id)
+    if queued is not None:
+        return presentation(dict(queued)), 200
+    document = model._mongometa.collection.find_one(unexpired(file_id), projection={'rendered': 0, 'renderedFile': 0})
+    if document is not None:
+        return presentation(unpack_file(document, model)), 200
+    NEGATIVE_CACHE.check(file_id)
+    return None
+
+
+def fetch_and_store_file(strategy, model, file_id):
+    """
+    Fetch a file and its details from the processing API and queue it to be stored.
+    Returns a (document, status) tuple. The document is a StreamedFile, stored as it
+    is sent, if the segments are too large to be read whole.
+    """
+    try:
+        the_file = strategy.fetch_file_bundle(file_id, stream_segments=True)
+    except (FileNotFound, FileInvalidStatusError) as e:
+        NEGATIVE_CACHE.record(file_id, e)
+        raise
+
+    if isinstance(the_file.get('segments'), SegmentStream):
+        LOGGER.info(f"Streaming the segments of {file_id}.")
+        segments = the_file.pop('segments')
+        # as with write-behind, other workers wait for the streamed file to be stored.
+        return StreamedFile(the_file, segments, model, on_done=COALESCER.hold(file_id)), 201
+
+    # save the fetched file details in storage for posterity, after the response went out.
+    # the fetch lease is kept until then, so that other workers wait for the file instead of fetching it again.
+    LOGGER.info(f"Queueing {file_id} details fetched to be saved in local storage.")
+    release = COALESCER.hold(file_id)
+    if not SAVE_QUEUE.put(the_file, release):
+        try:
+            save_file(the_file, model)
+        finally:
+            if release is not None:
+                release()
+    return the_file, 201
+
+
+def servable(model, file_id, fetched_at, serve_expired=False):
+    """
+    Whether a stored copy of a file can be served. A stale copy is, and gets refreshed
+    in the background. An expired one is refetched on the request path, unless
+    serve_expired says the refetch already failed.
+    """
+    state = freshness(fetched_at)
+    if state == STALE:
+        REFRESHER.refresh_async(file_id, model)
+    return state != EXPIRED or serve_expired
+
+
+def variant_etag(etag, encoding):
+    """
+    Each content coding of a body is a different representation, so it gets its own strong ETag.
+    """
+    if encoding == IDENTITY:
+        return etag
+    return f"{etag}-{encoding}"
+
+
+def matching_etag(etag):
+    """
+    Return the ETag of the representation the client already holds, None if it has none.
+    """
+    for encoding in [IDENTITY] + supported_encodings():
+        candidate = variant_etag(etag, encoding)
+        if request.if_none_match.contains_weak(candidate):
+            return candidate
+    return None
+
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def stored_file(model, file_id, fields):
+    """
+    Read only the given fields of a stored file with plain pymongo, skipping the ODM.
+    Returns None if the file is not stored.
+    """
+    projection = dict.fromkeys(fields, 1)
+    if 'rendered' in fields:
+        # the body of a large file may be in GridFS.
+        projection['renderedFile'] = 1
+    document = model._mongometa.collection.find_one({'_id': file_id}, projection=projection)
+    return unpack_file(document, model) if document is not None else None
+
+
+def file_response(file_id, etag, bodies, generation, fetched_at, store=False):
+    """
+    Answer a presentation request from the serialized bodies of a file.
+
+    @param bodies: dict of content coding -> body, holding at least the identity body.
+    @param fetched_at: fetchedAt of the stored file, cached along with the bodies.
+    A body compressed here is cached along with the others, so a file is
+    compressed once per coding instead of once per request.
+    """
+    matched = matching_etag(etag)
+    if matched is not None:
+        return not_modified(matched)
+
+    encoding = negotiate(request.accept_encodings, len(bodies[IDENTITY]))
+    body = bodies.get(encoding)
+    if body is None:
+        body = compress(bodies[IDENTITY], encoding)
+        bodies = dict(bodies, **{encoding: body})
+        store = True
+    if store:
+        FILE_CACHE.set(file_id, (etag, bodies, fetched_at), generation, size=sum(len(b) for b in bodies.values()))
+
+    response = json_response(body, 200)
+    response.set_etag(variant_etag(etag, encoding))
+    if encoding != IDENTITY:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def stored_file_response(model, file_id, serve_expired=False):
+    """
+    Answer a presentation request for a whole file from the cache or local storage.
+    Returns None if the file is not stored or has expired.
+    """
+    generation = FILE_CACHE.generation()
+
+    # a cache hit skips the storage and serialization altogether.
+    cached = FILE_CACHE.get(file_id)
+    if cached is not None and servable(model, file_id, cached[2], serve_expired):
+        LOGGER.info("File found in local cache.")
+        etag, bodies, fetched_at = cached
+        return file_response(file_id, etag, bodies, generation, fetched_at)
+
+    # a client revalidating its copy only needs the ETag, not the whole document.
+    if request.if_none_match:
+        document = stored_file(model, file_id, ['etag', 'fetchedAt'])
+        matched = matching_etag(document['etag']) if document and document.get('etag') else None
+        if matched is not None and servable(model, file_id, document.get('fetchedAt'), serve_expired):
+            LOGGER.info("File not modified.")
+            return not_modified(matched)
+
+    # only the pre-rendered body is read.
+    document = stored_file(model, file_id, ['etag', 'rendered', 'fetchedAt'])
+    if document is not None and document.get('rendered') is None:
+        # stored before bodies were, render it once and keep it.
+        document = render_stored_file(file_id, model)
+    if document is None:
+        LOGGER.info(f"File {file_id} not found in local storage.")
+        return None
+    if not servable(model, file_id, document.get('fetchedAt'), serve_expired):
+        LOGGER.info(f"File {file_id} in local storage has expired.")
+        return None
+    LOGGER.info("File found in local storage.")
+    return file_response(
+        file_id, document['etag'], {IDENTITY: bytes(document['rendered'])}, generation, document.get('fetchedAt'), store=True
+    )
+
+
+def sparse_file_response(model, file_id, field_set, serve_expired=False):
+    """
+    Answer a presentation request for part of a file from local storage.
+    Returns None if the file is not stored or has expired.
+    """
+    document = field_set.read(model, file_id, extra_fields=['fetchedAt'])
+    if document is None:
+        LOGGER.info(f"File {file_id} not found in local storage.")
+        return None
+    if not servable(model, file_id, document.get('fetchedAt'), serve_expired):
+        LOGGER.info(f"File {file_id} in local storage has expired.")
+        return None
+    LOGGER.info("File found in local storage.")
+    return json_response(render(field_set.apply(document, projected=True)), 200)
+
+
+def streamed_file_response(model, file_id, field_set, stream):
+    """
+    Answer a presentation request for a file whose segments are streamed.
+
+    The first request for the whole file sends the stream as it is read. A request
+    for part of it reads the stream through first if nobody else has, and the
+    others wait for it to be stored and answer from storage.
+    """
+    if stream.claim():
+        if field_set.is_full:
+            response = app.response_class(stream.body(), status=201, mimetype='application/json')
+            response.call_on_close(stream.close)
+            return response
+        stream.drain()
+    else:
+        stream.wait()
+    if field_set.is_full:
+        response = stored_file_response(model, file_id, serve_expired=True)
+    else:
+        response = sparse_file_response(model, file_id, field_set, serve_expired=True)
+    if response is None:
+        return make_response(jsonify({'error': f"Could not fetch file {file_id} at the moment."}), 400)
+    return response
+
+
+def store_with_segments(strategy, model, the_file):
+    """
+    Fetch the segments of a file fetched without them and store the whole file.
+    Returns a (document, status) tuple.
+    """
+    the_file = dict(the_file, segments=strategy.fetch_file_segments(the_file['fileId']))
+    LOGGER.info(f"Saving {the_file['fileId']} details fetched in local storage.")
+    save_file(the_file, model)
+    return the_file, 201
+
+
+def fetch_file_deferring_segments(strategy, model, file_id):
+    """
+    Fetch a file and its details for a caller that did not ask for the segments.
+    The segments call is left out of the request, the segments are fetched and
+    the whole file stored in the background.
+    Returns a (document, status) tuple, the document has no segments.
+    """
+    import gevent
+
+    try:
+        the_file = strategy.fetch_file_bundle(file_id, segments=False)
+    except (FileNotFound, FileInvalidStatusError) as e:
+        NEGATIVE_CACHE.record(file_id, e)
+        raise
+
+    # the fetch lease is kept until the whole file is stored, so that other workers wait for it instead of fetching it again.
+    release = COALESCER.hold(file_id)
+
+    def complete():
+        try:
+            store_with_segments(strategy, model, the_file)
+        except Exception as e:
+            LOGGER.warning(f"Could not store {file_id} with its segments. {str(e)}.")
+        finally:
+            if release is not None:
+                release()
+
+    gevent.spawn(complete)
+    return the_file, 201
+
+
+def error_status(error):
+    if isinstance(error, FileNotFound):
+        return 404
+    return 400
+
+
+def batch_file_ids(payload):
+    """
+    The distinct file ids of a batch request body, in order. Raises ValueError on bad input.
+    """
+    file_ids = payload.get('fileIds') if isinstance(payload, dict) else None
+    if not file_ids or not isinstance(file_ids, list) or not all(isinstance(f, str) for f in file_ids):
+        raise ValueError("fileIds must be a non empty list of file ids.")
+    if len(file_ids) > BATCH_MAX_FILES:
+        raise ValueError(f"At most {BATCH_MAX_FILES} files can be requested at once.")
+    return list(OrderedDict.fromkeys(file_ids))
+
+
+def batch_item(file_id, outcome):
+    """
+    The per file entry of a batch response. The outcome is
+    either a (document, status) tuple or an exception.
+    """
+    if isinstance(outcome, Exception):
+        return {'fileId': file_id, 'status': error_status(outcome), 'error': str(outcome)}
+    the_file, status = outcome
+    return {'fileId': file_id, 'status': status, 'file': the_file}
+
+
 @app.route('/api/presentation/files/<file_id>')
-@log_latency_decorator
+@metrics_decorator
 def file_details_api(file_id):
     """
     REST API endpoint to serve all file and segment metadata
@@ -26,14 +351,42 @@ def file_details_api(file_id):
     a 400 Bad Request if the file is not in the FINISHED status.
 
     The API makes use of gevent as a strategy to call the 3rd party APIs
-    for concurrent execution.
+    for concurrent execution. File details and segments are fetched
+    speculatively alongside the page scan.
 
-    1. Check the file in local storage.
+    1. Check the file in the in-process cache, then in local storage.
     2. If not in local storage, fetch from 3rd party API.
-    3. Store the file in local storage.
+    3. Queue the file to be stored in local storage once the response is out,
+       see api.write_behind.
+
+    NotFound, PROCESSING and FAILED outcomes are cached for a short while
+    and answered without calling the processing API. Pass ?refresh=true
+    to skip the negative cache.
+
+    Concurrent misses for the same file in a worker share one fetch, and a
+    lease in storage makes sure only one worker calls the processing API.
+
+    Stored files are served with a strong ETag saved along with the document.
+    A request with a matching If-None-Match gets a 304 Not Modified, read from
+    the cache or from the ETag alone. Bodies are gzip or brotli compressed as
+    the Accept-Encoding header allows, and the compressed bodies are cached.
+
+    A stored file older than FILE_SOFT_TTL is served as it is and refreshed
+    from the processing API in the background. One older than FILE_HARD_TTL is
+    refetched before it is served, or served anyway if the processing API fails.
+
+    Query parameters: fields, segments, offset, limit.
+    fields is a comma separated list of the fields to return, e.g.
+    fields=processingStatus,mp3Path,seriesTitle. segments is one of all, none,
+    count (segmentCount instead of the list) or page (limit segments from
+    offset). Both are applied as projections in storage. A cold miss that does
+    not need the segments answers without them and stores them in the background.
+
+    Segments larger than SEGMENTS_STREAM_MIN_BYTES are parsed as they arrive from
+    the processing API and streamed to the client and to storage, see api.streaming.
 
     @return: JSON
-    Success - 200 OK.
+    Success - 200 OK, 304 Not Modified.
     ========
     {
         "fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
@@ -61,37 +414,321 @@ def file_details_api(file_id):
     """
     strategy = GeventJobs()
     model = FileModel
-
-    # query storage for the file first.
     try:
-        the_file = model.objects.get({"_id": file_id})
-    except model.DoesNotExist as e:
-        LOGGER.info(f"File {file_id} not found in local storage. {str(e)}.")
-        pass
-    else:
-        LOGGER.info("File found in local storage.")
-        return make_response(jsonify(the_file.to_son()), 200)
+        field_set = field_set_arg()
+    except ValueError as e:
+        return make_response(jsonify({'error': f"Invalid query parameter. {str(e)}"}), 400)
+
+    with STAGE_LATENCY.time(stage='local_lookup'):
+        if field_set.is_full:
+            response = stored_file_response(model, file_id)
+        else:
+            response = sparse_file_response(model, file_id, field_set)
+    if response is not None:
+        return response
+
+    # a refresh forgets a cached NotFound/PROCESSING/FAILED outcome.
+    if request.args.get('refresh', '').lower() in ('1', 'true', 'yes'):
+        NEGATIVE_CACHE.invalidate(file_id)
 
     # otherwise, fetch the file and details from processing API.
+    # concurrent misses for the same file wait on one fetch.
     LOGGER.info(f"Fetching file {file_id} from APIs.")
     try:
-        the_file = strategy.fetch_file(file_id)
-    except (FileInvalidStatusError, APIException) as e:
+        NEGATIVE_CACHE.check(file_id)
+        fetch = fetch_and_store_file if field_set.needs_segments else fetch_file_deferring_segments
+        the_file, status = COALESCER.fetch(
+            file_id, partial(fetch, strategy, model, file_id), partial(load_file, model, file_id)
+        )
+        if field_set.needs_segments and 'segments' not in the_file:
+            # joined a fetch that deferred the segments, wait for it to store the whole file.
+            the_file, status = COALESCER.fetch(
+                file_id, partial(fetch, strategy, model, file_id), partial(load_file, model, file_id)
+            )
+    except FileInvalidStatusError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    except APIException as e:
+        # an expired copy beats no copy when the processing API is failing.
+        if field_set.is_full:
+            response = stored_file_response(model, file_id, serve_expired=True)
+        else:
+            response = sparse_file_response(model, file_id, field_set, serve_expired=True)
+        if response is not None:
+            LOGGER.warning(f"Serving expired file {file_id}. {str(e)}.")
+            return response
         return make_response(jsonify({'error': str(e)}), 400)
     except FileNotFound as e:
         return make_response(jsonify({'error': str(e)}), 404)
+    if isinstance(the_file, StreamedFile):
+        return streamed_file_response(model, file_id, field_set, the_file)
+    if not field_set.is_full:
+        the_file = field_set.apply(the_file)
+    return json_response(render(the_file), status)
+
+
+def int_arg(name, default=None, minimum=0, args=None):
+    """
+    Parse an integer query parameter. Raises ValueError on bad input.
 
+    @param args: the query parameters, those of the Flask request by default.
+    """
+    value = (request.args if args is None else args).get(name)
+    if value is None or value == '':
+        return default
+    value = int(value)
+    if value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}.")
+    return value
+
+
+def field_set_arg(args=None):
+    """
+    The field set of the fields, segments, offset and limit query parameters. Raises ValueError on bad input.
+    """
+    args = request.args if args is None else args
+    return FieldSet.parse(
+        args.get('fields'),
+        args.get('segments'),
+        int_arg('offset', 0, args=args),
+        min(int_arg('limit', SEGMENTS_PAGE_SIZE, minimum=1, args=args), SEGMENTS_PAGE_MAX)
+    )
+
+
+@app.route('/api/presentation/files/<file_id>/segments')
+@metrics_decorator
+def file_segments_api(file_id):
+    """
+    REST API endpoint to serve the segments of a stored file overlapping
+    a [from, to] millisecond window, e.g. for a player seeking to minute 45.
+    Results are ordered by startTime, then fileSegmentId. Pass the returned
+    `next`, the fileSegmentId of the last segment, as `after` to get the next page.
+
+    Query parameters: from, to (milliseconds), after (fileSegmentId), limit.
+
+    @return: JSON
+    Success - 200 OK.
+    ========
+    {
+        "fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
+        "segments": [
+            {
+                "fileSegmentId": 2685,
+                "fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
+                "segmentText": "Full segment text",
+                "startTime": 3710,
+                "endTime": 4400
+            },
+            ..
+        ],
+        "next": 2785
+    }
+
+    Error - 400 Bad request, 404 Not Found.
+    ======
+    {"error": "The message about the error."}
+    """
     try:
-        the_file.update(strategy.fetch_file_details(file_id))
-    except APIException as e:
-        return make_response(jsonify({'error': str(e)}), 400)
+        start_time = int_arg('from', 0)
+        end_time = int_arg('to')
+        after = int_arg('after')
+        limit = min(int_arg('limit', SEGMENTS_PAGE_SIZE, minimum=1), SEGMENTS_PAGE_MAX)
+    except ValueError as e:
+        return make_response(jsonify({'error': f"Invalid query parameter. {str(e)}"}), 400)
+
+    # files stored before segments had their own collection are backfilled on first use.
+    if not SEGMENT_STORE.has(file_id):
+        model = FileModel
+        the_file = model._mongometa.collection.find_one({"_id": file_id}, projection={'segments': 1, 'segmentsPacked': 1})
+        if the_file is None:
+            return make_response(jsonify({'error': f"File {file_id} not found in local storage."}), 404)
+        LOGGER.info(f"Backfilling segments of {file_id}.")
+        SEGMENT_STORE.save(file_id, unpack_file(the_file, model).get('segments'))
+
+    segments, next_after = SEGMENT_STORE.find(file_id, start_time, end_time, after, limit)
+    return make_response(jsonify({'fileId': file_id, 'segments': segments, 'next': next_after}), 200)
+
+
+@app.route('/api/presentation/search')
+@metrics_decorator
+def search_api():
+    """
+    REST API endpoint to find where a phrase is spoken across all stored files.
+
+    Query parameters: q, limit.
+
+    @return: JSON
+    Success - 200 OK, best hits first.
+    ========
+    {
+        "query": "royally obsessed",
+        "hits": [
+            {
+                "fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
+                "fileSegmentId": 2685,
+                "startTime": 3710,
+                "endTime": 4400,
+                "segmentText": "Full segment text",
+                "score": 7.1342
+            },
+            ..
+        ]
+    }
 
+    Error - 400 Bad request.
+    ======
+    {"error": "The message about the error."}
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return make_response(jsonify({'error': "The q query parameter is required."}), 400)
     try:
-        the_file.update({'segments': strategy.fetch_file_segments(file_id)})
-    except APIException as e:
+        limit = min(int_arg('limit', SEARCH_RESULTS_SIZE, minimum=1), SEGMENTS_PAGE_MAX)
+    except ValueError as e:
+        return make_response(jsonify({'error': f"Invalid query parameter. {str(e)}"}), 400)
+    return make_response(jsonify({'query': query, 'hits': SEARCH_INDEX.search(query, limit)}), 200)
+
+
+@app.route('/api/presentation/files:batch', methods=['POST'])
+@metrics_decorator
+def file_details_batch_api():
+    """
+    REST API endpoint to serve many files at once, e.g. the items of a playlist.
+
+    Local hits are read with one query. The misses are looked for with a single
+    page scan that matches every missing file at once, then the details and
+    segments of the FINISHED ones are fetched concurrently and saved in bulk.
+
+    Request:
+    {"fileIds": ["aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", ..]}
+
+    @return: JSON
+    Success - 200 OK, with a per file status code.
+    ========
+    {
+        "files": [
+            {"fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", "status": 200, "file": {..}},
+            {"fileId": "aaaaaaaa-bbbb-cccc-dddd-ffffffffffff", "status": 400, "error": "The message about the error."},
+            ..
+        ]
+    }
+
+    Error - 400 Bad request.
+    ======
+    {"error": "The message about the error."}
+    """
+    try:
+        file_ids = batch_file_ids(request.get_json(silent=True))
+    except ValueError as e:
         return make_response(jsonify({'error': str(e)}), 400)
 
-    # save the fetched file details in storage for posterity.
-    LOGGER.info(f"Saving {file_id} details fetched in local storage.")
-    model(**the_file).save()
-    return make_response(jsonify(the_file), 201)
+    strategy = GeventJobs()
+    model = FileModel
+    outcomes = {}
+
+    # query storage for all the files first. Expired files are refetched, stale ones refreshed in the background.
+    expired = {}
+    stored = model._mongometa.collection.find({"_id": {"$in": file_ids}}, projection={'rendered': 0, 'renderedFile': 0})
+    for son in stored:
+        son = unpack_file(son, model)
+        if servable(model, son['_id'], son.get('fetchedAt')):
+            outcomes[son['_id']] = (presentation(son), 200)
+        else:
+            expired[son['_id']] = (presentation(son), 200)
+    misses = [f for f in file_ids if f not in outcomes]
+    outcomes.update(NEGATIVE_CACHE.check_many(misses))
+    misses = [f for f in misses if f not in outcomes]
+
+    # otherwise, fetch the files and details from processing API.
+    if misses:
+        LOGGER.info(f"Fetching {len(misses)} of {len(file_ids)} files from APIs.")
+        fetched = strategy.fetch_files_bundle(misses)
+        errors = save_files([f for f in fetched.values() if not isinstance(f, Exception)], model)
+        for file_id, the_file in fetched.items():
+            if isinstance(the_file, (FileNotFound, FileInvalidStatusError)):
+                NEGATIVE_CACHE.record(file_id, the_file)
+            if isinstance(the_file, APIException) and file_id in expired:
+                # an expired copy beats no copy when the processing API is failing.
+                outcomes[file_id] = expired[file_id]
+            elif isinstance(the_file, Exception):
+                outcomes[file_id] = the_file
+            else:
+                outcomes[file_id] = errors.get(file_id) or (the_file, 201)
+
+    return make_response(jsonify({'files': [batch_item(f, outcomes[f]) for f in file_ids]}), 200)
+
+
+@app.route('/api/ingestion/files', methods=['POST'])
+def ingestion_api():
+    """
+    Webhook for the processing API to tell us a file has finished processing.
+    The file is queued and stored ahead of demand by the ingestion workers (api.ingestion).
+
+    Request:
+    {"fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", "processingStatus": "FINISHED"}
+
+    @return: JSON
+    Success - 202 Accepted.
+    ========
+    {"fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", "state": "pending"}
+
+    Error - 400 Bad request, 401 Unauthorized.
+    ======
+    {"error": "The message about the error."}
+    """
+    if INGESTION_TOKEN and request.headers.get('X-Ingestion-Token') != INGESTION_TOKEN:
+        return make_response(jsonify({'error': "Invalid ingestion token."}), 401)
+
+    payload = request.get_json(silent=True) or {}
+    file_id = payload.get('fileId')
+    if not file_id or not isinstance(file_id, str):
+        return make_response(jsonify({'error': "fileId is required."}), 400)
+    if payload.get('processingStatus') != FileStatus.FINISHED:
+        return make_response(jsonify({'error': f"Only {FileStatus.FINISHED} files are ingested."}), 400)
+
+    LOGGER.info(f"Queueing ingestion of {file_id}.")
+    INGESTION_QUEUE.enqueue(file_id)
+    # a PROCESSING outcome cached before the notification is stale now.
+    NEGATIVE_CACHE.invalidate(file_id)
+    return make_response(jsonify({'fileId': file_id, 'state': 'pending'}), 202)
+
+
+@app.route('/api/stats')
+def stats_api():
+    """
+    Internal counters of the worker serving the request.
+
+    @return: JSON
+    {
+        "http": {"requests": 203, "new_connections": 20, "reused_connections": 183},
+        "cache": {"entries": 1, "bytes": 1024, "hits": 10, "misses": 2, "evictions": 0, "expirations": 0},
+        "coalescing": {"in_flight": 0, "fetches": 2, "coalesced": 18, "lease_waits": 1, "held": 3},
+        "negative_cache": {"hits": 42},
+        "ingestion": {"pending": 3, "running": 1, "done": 120, "failed": 0},
+        "refresh": {"refreshing": 1, "refreshed": 12, "failed": 0},
+        "save_queue": {"depth": 3, "saved": 410, "retried": 2, "dropped": 0, "rejected": 0},
+        "upstream": {"hedges": 4, "retries": 2, "rejected": 0, "circuits": {"file/all": "closed"}},
+        "limiter": {"limit": 24, "in_flight": 20, "queued": 35, "flows": 3, "increases": 310, "decreases": 4},
+        "warmer": {"finished": 950, "stored": 900, "fetched": 45, "failed": 5, "pageErrors": 0, "coverage": 99.47, ...}
+    }
+    warmer is the report of the last sweep of the cache warmer, null if it has not run yet.
+    """
+    return make_response(jsonify({
+        'http': SESSION_POOL.stats(),
+        'cache': FILE_CACHE.stats(),
+        'coalescing': COALESCER.stats(),
+        'negative_cache': {'hits': NEGATIVE_CACHE.hits},
+        'ingestion': INGESTION_QUEUE.depth(),
+        'refresh': REFRESHER.stats(),
+        'save_queue': SAVE_QUEUE.stats(),
+        'upstream': UPSTREAM_POLICY.stats(),
+        'limiter': UPSTREAM_LIMITER.stats(),
+        'warmer': last_report(),
+    }), 200)
+
+
+@app.route('/metrics')
+def metrics_api():
+    """
+    Latency histograms, counters and gauges of all the workers in the Prometheus text format.
+    """
+    return app.response_class(METRICS.render(), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
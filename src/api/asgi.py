@@ -0,0 +1,417 @@
+import re
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_accept_header, parse_etags
+
+from api.app import app as flask_app, batch_file_ids, batch_item, field_set_arg, variant_etag
+from api.async_jobs import ASYNC_DATABASE, ASYNC_SESSION_POOL, AsyncioJobs
+from api.cache import FILE_CACHE
+from api.coalesce import AsyncFetchCoalescer
+from api.compression import IDENTITY, compress, negotiate, supported_encodings
+from api.decorators import REQUEST_LATENCY, REQUESTS, REQUESTS_IN_FLIGHT
+from api.exceptions import APIException, FileInvalidStatusError, FileNotFound
+from api.metrics import METRICS, STAGE_LATENCY
+from api.models import FileModel
+from api.negative_cache import NEGATIVE_CACHE
+from api.refresh import EXPIRED, STALE, AsyncFileRefresher, freshness, unexpired
+from api.serialization import render
+from api.storage import index_segments, presentation, render_stored_file, save_file, save_files, unpack_file
+from api.write_behind import SAVE_QUEUE
+
+LOGGER = logging.getLogger(__name__)
+FILE_PATH = re.compile(r'^/api/presentation/files/([^/]+)$')
+BATCH_PATH = '/api/presentation/files:batch'
+ENDPOINT = 'file_details_api'
+BATCH_ENDPOINT = 'file_details_batch_api'
+
+
+class Request(object):
+    """
+    The bits of an ASGI http scope the presentation endpoint needs.
+    """
+    def __init__(self, scope):
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        self.if_none_match = parse_etags(self.headers.get('if-none-match'))
+        self.accept_encodings = parse_accept_header(self.headers.get('accept-encoding'))
+
+
+class Response(object):
+    def __init__(self, body=b'', status=200, etag=None, encoding=IDENTITY):
+        self.body = body
+        self.status = status
+        self.headers = [(b'vary', b'Accept-Encoding')]
+        if body or status != 304:
+            self.headers.append((b'content-type', b'application/json'))
+        if etag is not None:
+            self.headers.append((b'etag', f'"{etag}"'.encode('latin-1')))
+        if encoding != IDENTITY:
+            self.headers.append((b'content-encoding', encoding.encode('latin-1')))
+        self.headers.append((b'content-length', str(len(body)).encode('latin-1')))
+
+    async def send(self, send):
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': self.headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def error_response(error, status):
+    return Response(render({'error': str(error)}), status)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+class PresentationASGI(object):
+    """
+    ASGI entry point of the presentation API for JOBS_STRATEGY=asyncio, e.g.
+    gunicorn -k uvicorn.workers.UvicornWorker api.asgi:app
+
+    GET /api/presentation/files/<file_id> and POST /api/presentation/files:batch
+    are served on the event loop, with AsyncioJobs on a cold miss and motor for
+    storage reads, and behave like the Flask endpoints: cache, ETags, compression,
+    negative cache, coalescing, stale-while-revalidate, fieldsets and deferred segments.
+    Saving a file and sparse reads go through pymodm in the default executor.
+
+    The other endpoints (segments window, search, ingestion, stats, metrics) are
+    served by the Flask app in a thread pool. gevent is not monkey patched there,
+    so they must not spawn green threads: the ones that do are served here.
+    """
+    def __init__(self, wsgi_app=flask_app, strategy_class=AsyncioJobs, model=FileModel, database=None, coalescer=None,
+                 refresher=None):
+        from uvicorn.middleware.wsgi import WSGIMiddleware
+
+        self._fallback = WSGIMiddleware(wsgi_app)
+        self._strategy_class = strategy_class
+        self._model = model
+        self._database = database or ASYNC_DATABASE
+        self._coalescer = coalescer or AsyncFetchCoalescer()
+        self._refresher = refresher or AsyncFileRefresher(strategy_class)
+        self._tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        match = FILE_PATH.match(scope['path']) if scope['type'] == 'http' else None
+        if match is not None and scope['method'] == 'GET':
+            response = await self.timed(self.file_details_api(match.group(1), Request(scope)))
+            return await response.send(send)
+        if scope['type'] == 'http' and scope['path'] == BATCH_PATH and scope['method'] == 'POST':
+            response = await self.timed(self.file_details_batch_api(await read_body(receive)), BATCH_ENDPOINT)
+            return await response.send(send)
+        return await self._fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await ASYNC_SESSION_POOL.close()
+                await self.in_executor(SAVE_QUEUE.close)
+                self._database.close()
+                METRICS.flush()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def timed(self, handler, endpoint=ENDPOINT):
+        """
+        Record the latency, status and concurrency of the endpoint like metrics_decorator does.
+        """
+        REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+        start_time = time.perf_counter()
+        status = 500
+        try:
+            response = await handler
+            status = response.status
+            return response
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=status)
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+            METRICS.maybe_flush()
+
+    async def in_executor(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    @property
+    def _collection(self):
+        return self._database.collection(self._model)
+
+    def servable(self, file_id, fetched_at, serve_expired=False):
+        """
+        See api.app.servable().
+        """
+        state = freshness(fetched_at)
+        if state == STALE:
+            self._refresher.refresh_async(file_id, self._model)
+        return state != EXPIRED or serve_expired
+
+    def matching_etag(self, request, etag):
+        for encoding in [IDENTITY] + supported_encodings():
+            candidate = variant_etag(etag, encoding)
+            if request.if_none_match.contains_weak(candidate):
+                return candidate
+        return None
+
+    def file_response(self, request, file_id, etag, bodies, generation, fetched_at, store=False):
+        """
+        See api.app.file_response().
+        """
+        matched = self.matching_etag(request, etag)
+        if matched is not None:
+            return Response(status=304, etag=matched)
+
+        encoding = negotiate(request.accept_encodings, len(bodies[IDENTITY]))
+        body = bodies.get(encoding)
+        if body is None:
+            body = compress(bodies[IDENTITY], encoding)
+            bodies = dict(bodies, **{encoding: body})
+            store = True
+        if store:
+            FILE_CACHE.set(file_id, (etag, bodies, fetched_at), generation, size=sum(len(b) for b in bodies.values()))
+        return Response(body, 200, variant_etag(etag, encoding), encoding)
+
+    async def stored_file_response(self, request, file_id, serve_expired=False):
+        """
+        See api.app.stored_file_response(). Returns None if the file is not stored or has expired.
+        """
+        generation = FILE_CACHE.generation()
+        cached = FILE_CACHE.get(file_id)
+        if cached is not None and self.servable(file_id, cached[2], serve_expired):
+            LOGGER.info("File found in local cache.")
+            etag, bodies, fetched_at = cached
+            return self.file_response(request, file_id, etag, bodies, generation, fetched_at)
+
+        if request.if_none_match:
+            document = await self._collection.find_one({'_id': file_id}, projection={'etag': 1, 'fetchedAt': 1})
+            matched = self.matching_etag(request, document['etag']) if document and document.get('etag') else None
+            if matched is not None and self.servable(file_id, document.get('fetchedAt'), serve_expired):
+                LOGGER.info("File not modified.")
+                return Response(status=304, etag=matched)
+
+        document = await self._collection.find_one(
+            {'_id': file_id}, projection={'etag': 1, 'rendered': 1, 'renderedFile': 1, 'fetchedAt': 1}
+        )
+        if document is not None and 'renderedFile' in document:
+            # the body of a large file is in GridFS, read with the blocking driver.
+            document = await self.in_executor(unpack_file, document, self._model)
+        if document is not None and document.get('rendered') is None:
+            document = await self.in_executor(render_stored_file, file_id, self._model)
+        if document is None:
+            LOGGER.info(f"File {file_id} not found in local storage.")
+            return None
+        if not self.servable(file_id, document.get('fetchedAt'), serve_expired):
+            LOGGER.info(f"File {file_id} in local storage has expired.")
+            return None
+        LOGGER.info("File found in local storage.")
+        return self.file_response(
+            request, file_id, document['etag'], {IDENTITY: bytes(document['rendered'])}, generation, document.get('fetchedAt'), store=True
+        )
+
+    async def sparse_file_response(self, file_id, field_set, serve_expired=False):
+        """
+        See api.app.sparse_file_response(). Returns None if the file is not stored or has expired.
+        """
+        document = await self.in_executor(field_set.read, self._model, file_id, ['fetchedAt'])
+        if document is None:
+            LOGGER.info(f"File {file_id} not found in local storage.")
+            return None
+        if not self.servable(file_id, document.get('fetchedAt'), serve_expired):
+            LOGGER.info(f"File {file_id} in local storage has expired.")
+            return None
+        LOGGER.info("File found in local storage.")
+        return Response(render(field_set.apply(document, projected=True)), 200)
+
+    async def local_response(self, request, file_id, field_set, serve_expired=False):
+        if field_set.is_full:
+            return await self.stored_file_response(request, file_id, serve_expired)
+        return await self.sparse_file_response(file_id, field_set, serve_expired)
+
+    async def load_file(self, file_id):
+        """
+        See api.app.load_file().
+        """
+        queued = SAVE_QUEUE.pending(file_id)
+        if queued is not None:
+            return presentation(dict(queued)), 200
+        document = await self._collection.find_one(unexpired(file_id), projection={'rendered': 0, 'renderedFile': 0})
+        if document is not None:
+            if 'segmentsPacked' in document:
+                document = await self.in_executor(unpack_file, document, self._model)
+            return presentation(document), 200
+        await self.in_executor(NEGATIVE_CACHE.check, file_id)
+        return None
+
+    async def fetch_and_store_file(self, strategy, file_id):
+        """
+        See api.app.fetch_and_store_file(). If the write-behind queue is full the file is
+        saved in the executor, and its segments indexed there without the response waiting for it.
+        """
+        try:
+            the_file = await strategy.fetch_file_bundle(file_id)
+        except (FileNotFound, FileInvalidStatusError) as e:
+            await self.in_executor(NEGATIVE_CACHE.record, file_id, e)
+            raise
+
+        LOGGER.info(f"Queueing {file_id} details fetched to be saved in local storage.")
+        release = self._coalescer.hold(file_id)
+        if not SAVE_QUEUE.put(the_file, release):
+            try:
+                await self.save_file(the_file)
+            finally:
+                if release is not None:
+                    await self.in_executor(release)
+        return the_file, 201
+
+    async def save_file(self, the_file):
+        """
+        Save a file in the executor and copy and index its segments there without waiting for it.
+        """
+        await self.in_executor(save_file, the_file, self._model, False)
+        asyncio.get_event_loop().run_in_executor(None, index_segments, the_file['fileId'], the_file.get('segments'))
+
+    async def store_with_segments(self, strategy, the_file):
+        """
+        See api.app.store_with_segments().
+        """
+        the_file = dict(the_file, segments=await strategy.fetch_file_segments(the_file['fileId']))
+        LOGGER.info(f"Saving {the_file['fileId']} details fetched in local storage.")
+        await self.save_file(the_file)
+        return the_file, 201
+
+    async def fetch_file_deferring_segments(self, strategy, file_id):
+        """
+        See api.app.fetch_file_deferring_segments(). The segments are fetched and
+        the whole file stored in an asyncio task.
+        """
+        try:
+            the_file = await strategy.fetch_file_bundle(file_id, segments=False)
+        except (FileNotFound, FileInvalidStatusError) as e:
+            await self.in_executor(NEGATIVE_CACHE.record, file_id, e)
+            raise
+
+        release = self._coalescer.hold(file_id)
+
+        async def complete():
+            try:
+                await self.store_with_segments(strategy, the_file)
+            except Exception as e:
+                LOGGER.warning(f"Could not store {file_id} with its segments. {str(e)}.")
+            finally:
+                if release is not None:
+                    await self.in_executor(release)
+
+        task = asyncio.ensure_future(complete())
+        # keeps the task referenced until it is done.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return the_file, 201
+
+    async def file_details_api(self, file_id, request):
+        """
+        See api.app.file_details_api().
+        """
+        try:
+            field_set = field_set_arg(request.args)
+        except ValueError as e:
+            return error_response(f"Invalid query parameter. {str(e)}", 400)
+
+        with STAGE_LATENCY.time(stage='local_lookup'):
+            response = await self.local_response(request, file_id, field_set)
+        if response is not None:
+            return response
+
+        if request.args.get('refresh', '').lower() in ('1', 'true', 'yes'):
+            await self.in_executor(NEGATIVE_CACHE.invalidate, file_id)
+
+        LOGGER.info(f"Fetching file {file_id} from APIs.")
+        strategy = self._strategy_class()
+        try:
+            await self.in_executor(NEGATIVE_CACHE.check, file_id)
+            fetch = self.fetch_and_store_file if field_set.needs_segments else self.fetch_file_deferring_segments
+            the_file, status = await self._coalescer.fetch(
+                file_id, lambda: fetch(strategy, file_id), lambda: self.load_file(file_id)
+            )
+            if field_set.needs_segments and 'segments' not in the_file:
+                # joined a fetch that deferred the segments, wait for it to store the whole file.
+                the_file, status = await self._coalescer.fetch(
+                    file_id, lambda: fetch(strategy, file_id), lambda: self.load_file(file_id)
+                )
+        except FileInvalidStatusError as e:
+            return error_response(e, 400)
+        except APIException as e:
+            # an expired copy beats no copy when the processing API is failing.
+            response = await self.local_response(request, file_id, field_set, serve_expired=True)
+            if response is not None:
+                LOGGER.warning(f"Serving expired file {file_id}. {str(e)}.")
+                return response
+            return error_response(e, 400)
+        except FileNotFound as e:
+            return error_response(e, 404)
+        if not field_set.is_full:
+            the_file = field_set.apply(the_file)
+        return Response(render(the_file), status)
+
+    async def file_details_batch_api(self, body):
+        """
+        See api.app.file_details_batch_api().
+        """
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        try:
+            file_ids = batch_file_ids(payload)
+        except ValueError as e:
+            return error_response(e, 400)
+
+        strategy = self._strategy_class()
+        outcomes, expired = {}, {}
+        stored = await self._collection.find(
+            {'_id': {'$in': file_ids}}, projection={'rendered': 0, 'renderedFile': 0}
+        ).to_list(None)
+        for son in stored:
+            if 'segmentsPacked' in son:
+                son = await self.in_executor(unpack_file, son, self._model)
+            if self.servable(son['_id'], son.get('fetchedAt')):
+                outcomes[son['_id']] = (presentation(son), 200)
+            else:
+                expired[son['_id']] = (presentation(son), 200)
+        misses = [f for f in file_ids if f not in outcomes]
+        outcomes.update(await self.in_executor(NEGATIVE_CACHE.check_many, misses))
+        misses = [f for f in misses if f not in outcomes]
+
+        if misses:
+            LOGGER.info(f"Fetching {len(misses)} of {len(file_ids)} files from APIs.")
+            fetched = await strategy.fetch_files_bundle(misses)
+            files = [f for f in fetched.values() if not isinstance(f, Exception)]
+            errors = await self.in_executor(save_files, files, self._model, False)
+            loop = asyncio.get_event_loop()
+            for the_file in files:
+                if the_file['fileId'] not in errors:
+                    loop.run_in_executor(None, index_segments, the_file['fileId'], the_file.get('segments'))
+            for file_id, the_file in fetched.items():
+                if isinstance(the_file, (FileNotFound, FileInvalidStatusError)):
+                    await self.in_executor(NEGATIVE_CACHE.record, file_id, the_file)
+                if isinstance(the_file, APIException) and file_id in expired:
+                    # an expired copy beats no copy when the processing API is failing.
+                    outcomes[file_id] = expired[file_id]
+                elif isinstance(the_file, Exception):
+                    outcomes[file_id] = the_file
+                else:
+                    outcomes[file_id] = errors.get(file_id) or (the_file, 201)
+
+        return Response(render({'files': [batch_item(f, outcomes[f]) for f in file_ids]}), 200)
+
+
+app = PresentationASGI()
@@ -0,0 +1,496 @@
+import os
+import time
+import asyncio
+import logging
+
+from api.catalog import FileCatalog
+from api.exceptions import APIException, FileNotFound, FileInvalidStatusError
+from api.external_api import (
+    HTTP_KEEPALIVE_TIMEOUT, HTTP_POOL_MAXSIZE, PROCESSING_API_HOST, UPSTREAM_ERRORS, UPSTREAM_IN_FLIGHT, UPSTREAM_LATENCY
+)
+from api.jobs import MAX_PAGES, SCAN_POOL_SIZE, SCAN_WINDOW
+from api.metrics import FOUND_PAGE, STAGE_LATENCY
+from api.models import CatalogEntryModel
+from api.resilience import UPSTREAM_POLICY
+from api.utils import FileStatus
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSessionPool(object):
+    """
+    One aiohttp ClientSession, and so one keep-alive connection pool, per worker.
+    HTTP_POOL_MAXSIZE caps the connections, HTTP_KEEPALIVE_TIMEOUT is how long an idle one is kept.
+    The session is created in the event loop of the worker on first use.
+    """
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT):
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def get(self):
+        # local import to avoid installing this package if we are employing another strategy.
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_maxsize, keepalive_timeout=self.keepalive_timeout or None, ssl=False
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncDatabase(object):
+    """
+    A motor client of the database of DB_CONNECTION_STRING, created in the event loop of the worker on first use.
+    """
+    def __init__(self, connection_string=None):
+        self.connection_string = connection_string or os.environ.get('DB_CONNECTION_STRING')
+        self._client = None
+
+    def collection(self, model):
+        """
+        The motor collection of a pymodm model.
+        """
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        if self._client is None:
+            self._client = AsyncIOMotorClient(self.connection_string)
+        return self._client.get_default_database()[model._mongometa.collection_name]
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+ASYNC_SESSION_POOL = AsyncSessionPool()
+ASYNC_DATABASE = AsyncDatabase()
+# the catalog writes in flight, asyncio only keeps weak references to its tasks.
+CATALOG_WRITES = set()
+
+
+class AsyncProcessingAPIAdapter(object):
+    """
+    The asyncio twin of ProcessingAPIAdapter, on aiohttp.
+    All instances share the connections of ASYNC_SESSION_POOL. Failed calls are
+    retried like the gevent adapter does and go through the same circuit breakers.
+    """
+    def __init__(self, session_pool=None, policy=None):
+        self._host = PROCESSING_API_HOST
+        self._sessions = session_pool or ASYNC_SESSION_POOL
+        self._policy = policy or UPSTREAM_POLICY
+
+    async def _send(self, api_url, params, endpoint):
+        import aiohttp
+
+        UPSTREAM_IN_FLIGHT.inc(endpoint=endpoint)
+        start_time = time.perf_counter()
+        try:
+            async with self._sessions.get().get(api_url, params=params) as response:
+                if response.status >= 400:
+                    LOGGER.error(
+                        f"Exception occurred while calling GET of processing API {response.url}. "
+                        f"\nResponse Status Code: {response.status}"
+                        f"\nResponse Content: {await response.read()}."
+                    )
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except aiohttp.ClientResponseError as e:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint, reason=e.status)
+            raise
+        except BaseException as e:
+            # timeouts and cancelled scan tasks are counted too.
+            UPSTREAM_ERRORS.inc(endpoint=endpoint, reason=type(e).__name__)
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+            UPSTREAM_IN_FLIGHT.dec(endpoint=endpoint)
+
+    async def _get(self, relative_url, params=None, endpoint=None):
+        """
+        GET and decode the JSON body of an API.
+        Query parameter values must be strings, aiohttp does not convert them.
+        """
+        if not self._host:
+            raise APIException("Cannot call API. _host configuration is missing.")
+
+        api_url = self._host + relative_url
+        LOGGER.info("Calling processing API %s with params %s.", api_url, params)
+        endpoint = endpoint or relative_url
+        return await self._policy.call_async(endpoint, lambda: self._send(api_url, params or {}, endpoint))
+
+    async def fetch_all(self, limit=5, offset=0):
+        return await self._get('/api/file/all', params={'limit': str(limit), 'offset': str(offset)}, endpoint='file/all')
+
+    async def fetch_details(self, file_id):
+        return await self._get(f'/api/file/details/{file_id}', endpoint='file/details')
+
+    async def fetch_segments(self, file_id):
+        return await self._get(f'/api/file/segments/{file_id}', endpoint='file/segments')
+
+
+class AsyncFileCatalog(FileCatalog):
+    """
+    The file catalog read and written with motor. Storage errors are misses, like in FileCatalog.
+    """
+    def __init__(self, model=CatalogEntryModel, database=None):
+        super().__init__(model)
+        self._database = database or ASYNC_DATABASE
+
+    @property
+    def _collection(self):
+        return self._database.collection(self.model)
+
+    async def lookup(self, file_id, limit=5):
+        """
+        Return the page offset a file was last seen on, None if we have not seen it yet.
+        """
+        from pymongo.errors import PyMongoError
+
+        try:
+            entry = await self._collection.find_one({'_id': file_id, 'limit': limit}, projection={'offset': 1})
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not lookup file {file_id} in catalog. {str(e)}.")
+            return None
+        return entry['offset'] if entry is not None else None
+
+    async def lookup_many(self, file_ids, limit=5):
+        """
+        Return a dict of fileId -> page offset for the files of a batch we have seen.
+        """
+        from pymongo.errors import PyMongoError
+
+        try:
+            entries = await self._collection.find(
+                {'_id': {'$in': list(file_ids)}, 'limit': limit}, projection={'offset': 1}
+            ).to_list(None)
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not lookup {len(file_ids)} files in catalog. {str(e)}.")
+            return {}
+        return {e['_id']: e['offset'] for e in entries}
+
+    async def record_pages(self, pages):
+        from pymongo.errors import PyMongoError
+
+        operations = self.page_operations(pages)
+        if not operations:
+            return 0
+        try:
+            await self._collection.bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            self.log_write_error(e)
+        return len(operations)
+
+
+class AsyncioJobs(object):
+    """
+    The asyncio strategy. It keeps the contract of GeventJobs, i.e. fetch_file,
+    fetch_file_details, fetch_file_segments, fetch_file_bundle and fetch_files_bundle take the same
+    arguments and raise the same exceptions, as coroutines. Jobs are asyncio
+    tasks instead of green threads, the processing API is called with aiohttp
+    and the catalog is read with motor, so nothing needs monkey patching.
+    """
+    def __init__(self, processing_api=None, catalog=None):
+        self._api = processing_api or AsyncProcessingAPIAdapter()
+        self._catalog = catalog or AsyncFileCatalog()
+
+    def is_finished(self, the_file):
+        return the_file.get('processingStatus') == FileStatus.FINISHED
+
+    def preferred_status(self, statuses):
+        """
+        PROCESSING wins over FAILED as the file may still finish.
+        """
+        statuses = set(statuses)
+        if FileStatus.PROCESSING in statuses or not statuses:
+            return FileStatus.PROCESSING
+        return statuses.pop()
+
+    def filter_by_id(self, file_id, file_list):
+        return [r for r in file_list if r.get('fileId') == file_id]
+
+    def record_pages(self, pages):
+        """
+        Record the fetched pages in the catalog in a task of its own, off the request path.
+        """
+        if not pages:
+            return
+        task = asyncio.ensure_future(self._catalog.record_pages(pages))
+        CATALOG_WRITES.add(task)
+        task.add_done_callback(CATALOG_WRITES.discard)
+
+    async def cancel(self, tasks):
+        tasks = [t for t in tasks if not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def fetch_page(self, limit, offset, timeout):
+        return await asyncio.wait_for(self._api.fetch_all(limit, offset), timeout)
+
+    async def fetch_file(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES):
+        """
+        Fetch a file via a paginated API, from the page the catalog knows first. See GeventJobs.fetch_file().
+        """
+        with STAGE_LATENCY.time(stage='page_scan'):
+            offset = await self._catalog.lookup(file_id, limit)
+            if offset is not None:
+                the_file = await self.fetch_file_from_page(file_id, offset, limit, timeout)
+                if the_file is not None:
+                    FOUND_PAGE.observe(offset + 1, source='catalog')
+                    return the_file
+                LOGGER.info(f"File {file_id} not found at catalog page {offset + 1}. Falling back to a full scan.")
+            return await self.scan_file(file_id, limit, timeout, max_pages)
+
+    async def fetch_file_from_page(self, file_id, offset, limit=5, timeout=5):
+        """
+        Fetch a file from the page the catalog says it is on.
+        Returns None if the page failed or the file is no longer on it.
+        """
+        try:
+            page = await self.fetch_page(limit, offset, timeout)
+        except Exception as e:
+            LOGGER.info(f"Could not fetch catalog page {offset + 1}. {str(e)}.")
+            return None
+        self.record_pages([(limit, offset, page)])
+
+        the_file = self.filter_by_id(file_id, page)
+        if not the_file:
+            return None
+        if not self.is_finished(the_file[0]):
+            raise FileInvalidStatusError(
+                f"File {file_id} is not in {FileStatus.FINISHED} status.", the_file[0].get('processingStatus')
+            )
+        return the_file[0]
+
+    async def scan_file(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES, window=SCAN_WINDOW, pool_size=SCAN_POOL_SIZE):
+        """
+        Scan the paginated API for a file window by window with at most
+        SCAN_POOL_SIZE calls in flight, like GeventJobs.scan_file(). The tasks
+        still running are cancelled as soon as a page has the file FINISHED.
+        """
+        offsets = list(range(0, max_pages + 1))
+        if window <= 0:
+            window = len(offsets)
+        semaphore = asyncio.Semaphore(pool_size if pool_size > 0 else window)
+
+        async def scan_page(offset):
+            async with semaphore:
+                return await self.fetch_page(limit, offset, timeout)
+
+        pages = []
+        # per page: the record of the file, None if it is not on the page, or the exception.
+        outcomes = []
+        the_file = None
+        for start in range(0, len(offsets), window):
+            tasks = {asyncio.ensure_future(scan_page(offset)): offset for offset in offsets[start:start + window]}
+            pending = set(tasks)
+            try:
+                while pending and the_file is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            outcomes.append(task.exception())
+                            continue
+                        pages.append((limit, tasks[task], task.result()))
+                        records = self.filter_by_id(file_id, task.result())
+                        outcomes.append(records[0] if records else None)
+                        if records and self.is_finished(records[0]) and the_file is None:
+                            the_file = records[0]
+                            FOUND_PAGE.observe(tasks[task] + 1, source='scan')
+            finally:
+                await self.cancel(pending)
+            if the_file is not None:
+                break
+        self.record_pages(pages)
+
+        if the_file is not None:
+            return the_file
+        errors = [o for o in outcomes if isinstance(o, BaseException)]
+        if len(errors) == len(outcomes):
+            raise APIException("Could not fetch the file at the moment.")
+        records = [o for o in outcomes if isinstance(o, dict)]
+        if not records:
+            raise FileNotFound(f"File {file_id} not found in {max_pages} pages.")
+        raise FileInvalidStatusError(
+            f"File {file_id} is not in {FileStatus.FINISHED} status.",
+            self.preferred_status(r.get('processingStatus') for r in records)
+        )
+
+    async def fetch_file_details(self, file_id, timeout=5):
+        """
+        Fetch metadata of a file from an API.
+        """
+        try:
+            with STAGE_LATENCY.time(stage='details'):
+                return await asyncio.wait_for(self._api.fetch_details(file_id), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.info(f"Could not fetch details of {file_id}. {str(e)}.")
+            raise APIException("Could not fetch the file details at the moment.")
+
+    async def fetch_file_segments(self, file_id, timeout=5):
+        """
+        Fetch extracted audio segment details of a file from an API.
+        """
+        try:
+            with STAGE_LATENCY.time(stage='segments'):
+                return await asyncio.wait_for(self._api.fetch_segments(file_id), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.info(f"Could not fetch segments of {file_id}. {str(e)}.")
+            raise APIException("Could not fetch file segments at the moment.")
+
+    async def fetch_details_bundle(self, the_file, timeout=5):
+        """
+        Merge a file record we already have with its details and segments, fetched concurrently.
+        """
+        file_id = the_file['fileId']
+        details, segments = await asyncio.gather(
+            self.fetch_file_details(file_id, timeout), self.fetch_file_segments(file_id, timeout)
+        )
+        the_file = dict(the_file)
+        the_file.update(details)
+        the_file.update({'segments': segments})
+        return the_file
+
+    async def scan_files(self, file_ids, offsets, limit=5, timeout=5, window=SCAN_WINDOW, pool_size=SCAN_POOL_SIZE):
+        """
+        Scan the given pages for many files at once, window by window like scan_file().
+        The scan stops as soon as every file was seen in FINISHED status.
+        Returns the pages fetched, and the exceptions of the pages that failed.
+        """
+        pending = set(file_ids)
+        if window <= 0:
+            window = max(len(offsets), 1)
+        semaphore = asyncio.Semaphore(pool_size if pool_size > 0 else window)
+
+        async def scan_page(offset):
+            async with semaphore:
+                return await self.fetch_page(limit, offset, timeout)
+
+        pages, outcomes = [], []
+        for start in range(0, len(offsets), window):
+            tasks = {asyncio.ensure_future(scan_page(offset)): offset for offset in offsets[start:start + window]}
+            running = set(tasks)
+            try:
+                while running and pending:
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            outcomes.append(task.exception())
+                            continue
+                        pages.append((limit, tasks[task], task.result()))
+                        outcomes.append(task.result())
+                        pending -= set(r.get('fileId') for r in task.result() if self.is_finished(r))
+            finally:
+                await self.cancel(running)
+            if not pending:
+                break
+        self.record_pages(pages)
+        return outcomes
+
+    def matches(self, outcomes):
+        """
+        fileId -> list of the records of that file found on the pages scanned.
+        """
+        seen = {}
+        for page in outcomes:
+            if isinstance(page, BaseException):
+                continue
+            for record in page:
+                seen.setdefault(record.get('fileId'), []).append(record)
+        return seen
+
+    async def fetch_files(self, file_ids, limit=5, timeout=5, max_pages=MAX_PAGES):
+        """
+        Fetch many files via the paginated API with one shared page scan, see GeventJobs.fetch_files().
+        Returns a dict of fileId -> the FINISHED file, or the exception fetch_file would have raised for it.
+        """
+        known = await self._catalog.lookup_many(file_ids, limit)
+        known_offsets = sorted(set(known.values()))
+        outcomes = await self.scan_files(file_ids, known_offsets, limit, timeout) if known_offsets else []
+        seen = self.matches(outcomes)
+
+        remaining = [f for f in file_ids if f not in seen]
+        if remaining:
+            offsets = [o for o in range(0, max_pages + 1) if o not in set(known_offsets)]
+            outcomes += await self.scan_files(remaining, offsets, limit, timeout)
+            seen = self.matches(outcomes)
+
+        results = {}
+        for file_id in file_ids:
+            records = seen.get(file_id, [])
+            finished = [r for r in records if self.is_finished(r)]
+            if finished:
+                results[file_id] = dict(finished[0])
+            elif records:
+                results[file_id] = FileInvalidStatusError(
+                    f"File {file_id} is not in {FileStatus.FINISHED} status.",
+                    self.preferred_status(r.get('processingStatus') for r in records)
+                )
+            elif all(isinstance(o, BaseException) for o in outcomes):
+                results[file_id] = APIException("Could not fetch the file at the moment.")
+            else:
+                results[file_id] = FileNotFound(f"File {file_id} not found in {max_pages} pages.")
+        return results
+
+    async def fetch_files_bundle(self, file_ids, limit=5, timeout=5, max_pages=MAX_PAGES, pool_size=SCAN_POOL_SIZE):
+        """
+        Fetch many files merged with their details and segments, see GeventJobs.fetch_files_bundle().
+        At most pool_size details and segments calls are in flight.
+        Returns a dict of fileId -> the merged file or the exception for that file.
+        """
+        results = await self.fetch_files(file_ids, limit, timeout, max_pages)
+        finished = [f for f, r in results.items() if not isinstance(r, Exception)]
+        semaphore = asyncio.Semaphore(pool_size if pool_size > 0 else max(len(finished), 1))
+
+        async def bounded(call, file_id):
+            async with semaphore:
+                return await call(file_id, timeout)
+
+        fetched = await asyncio.gather(
+            *[bounded(call, f) for f in finished for call in (self.fetch_file_details, self.fetch_file_segments)],
+            return_exceptions=True
+        )
+        for i, file_id in enumerate(finished):
+            details, segments = fetched[2 * i], fetched[2 * i + 1]
+            if isinstance(details, Exception):
+                results[file_id] = details
+            elif isinstance(segments, Exception):
+                results[file_id] = segments
+            else:
+                results[file_id].update(details)
+                results[file_id].update({'segments': segments})
+        return results
+
+    async def fetch_file_bundle(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES, segments=True):
+        """
+        Fetch a file merged with its details and segments. The details and segments
+        calls run alongside the page scan and are cancelled if the scan fails.
+
+        @param segments: pass False to leave the segments out and skip their API call.
+        """
+        details_task = asyncio.ensure_future(self.fetch_file_details(file_id, timeout))
+        tasks = [details_task]
+        segments_task = None
+        if segments:
+            segments_task = asyncio.ensure_future(self.fetch_file_segments(file_id, timeout))
+            tasks.append(segments_task)
+        try:
+            the_file = dict(await self.fetch_file(file_id, limit, timeout, max_pages))
+            the_file.update(await details_task)
+            if segments_task is not None:
+                the_file.update({'segments': await segments_task})
+        except BaseException:
+            await self.cancel(tasks)
+            raise
+        return the_file
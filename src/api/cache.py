@@ -0,0 +1,125 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from api.shared_cache import SharedResponseCache
+
+LOGGER = logging.getLogger(__name__)
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get('FILE_CACHE_MAX_ENTRIES', 1000))
+FILE_CACHE_MAX_BYTES = int(os.environ.get('FILE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', 300))
+# file the workers of a host share the cache in, e.g. /dev/shm/snackable_file_cache. Empty keeps a cache per worker.
+FILE_CACHE_SHARED_PATH = os.environ.get('FILE_CACHE_SHARED_PATH', '')
+# bytes of a page of the shared cache. A larger response takes a chain of pages, up to half of them.
+FILE_CACHE_SHARED_PAGE_SIZE = int(os.environ.get('FILE_CACHE_SHARED_PAGE_SIZE', 1024 * 1024))
+
+
+class LRUCache(object):
+    """
+    A bounded in-process cache of serialized response bodies.
+
+    Entries are evicted least recently used first once either max_entries or
+    max_bytes is exceeded, and expire ttl seconds after they were stored.
+    The lock is a plain threading lock, which gevent monkey patches into a
+    cooperative one, so the cache is safe across green threads and threads alike.
+    """
+    def __init__(self, max_entries=FILE_CACHE_MAX_ENTRIES, max_bytes=FILE_CACHE_MAX_BYTES,
+                 ttl=FILE_CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        # key -> (value, size, expires_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # bumped on every invalidation, see generation().
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def generation(self):
+        """
+        Take the generation before reading the value from storage and pass it to set().
+        If the key was invalidated in between the read is stale and set() drops it.
+        """
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, _, expires_at = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None, size=None):
+        """
+        @param size: bytes the value takes, len(value) by default.
+        """
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return False
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, self._clock() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+def file_cache():
+    if not FILE_CACHE_SHARED_PATH:
+        return LRUCache()
+    return SharedResponseCache(
+        FILE_CACHE_SHARED_PATH, FILE_CACHE_MAX_ENTRIES, FILE_CACHE_MAX_BYTES, FILE_CACHE_TTL, FILE_CACHE_SHARED_PAGE_SIZE
+    )
+
+
+FILE_CACHE = file_cache()
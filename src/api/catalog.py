@@ -0,0 +1,123 @@
+import datetime
+import logging
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from api.models import CatalogEntryModel
+from api.utils import FileStatus
+
+LOGGER = logging.getLogger(__name__)
+DUPLICATE_KEY_ERROR = 11000
+
+
+class FileCatalog(object):
+    """
+    A persistent fileId -> page index of the paginated processing API.
+
+    Entries are filled in as a side effect of every page scan and by the
+    background crawler (api.crawler). A lookup lets us go straight to the
+    page a file was last seen on instead of scanning MAX_PAGES pages.
+    The catalog is only a hint, any storage error is logged and treated as a miss.
+    """
+    def __init__(self, model=CatalogEntryModel):
+        self.model = model
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def lookup(self, file_id, limit=5):
+        """
+        Return the catalog entry of a file or None if we have not seen it yet.
+        Offsets are page numbers, so an entry recorded with a different page
+        size is of no use to us.
+        """
+        try:
+            entry = self.model.objects.get({'_id': file_id})
+        except self.model.DoesNotExist:
+            return None
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not lookup file {file_id} in catalog. {str(e)}.")
+            return None
+        if entry.limit != limit:
+            return None
+        return entry
+
+    def lookup_many(self, file_ids, limit=5):
+        """
+        Return a dict of fileId -> page offset for the files of a batch we have seen.
+        """
+        try:
+            entries = self._collection.find({'_id': {'$in': list(file_ids)}, 'limit': limit}, projection={'offset': 1})
+            return {e['_id']: e['offset'] for e in entries}
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not lookup {len(file_ids)} files in catalog. {str(e)}.")
+            return {}
+
+    def _pick(self, current, candidate):
+        """
+        Pick the better of two sightings of the same file.
+        A FINISHED sighting wins, otherwise the lowest page wins.
+        """
+        if current is None:
+            return candidate
+        current_finished = current[2] == FileStatus.FINISHED
+        candidate_finished = candidate[2] == FileStatus.FINISHED
+        if candidate_finished != current_finished:
+            return candidate if candidate_finished else current
+        return candidate if candidate[0] < current[0] else current
+
+    def page_operations(self, pages):
+        """
+        The bulk upserts recording the files seen on a set of pages.
+
+        @param pages: iterable of (limit, offset, file_list) tuples.
+
+        FINISHED is a terminal status, so a FINISHED entry is never overwritten
+        by a PROCESSING/FAILED sighting of the same file on another page.
+        """
+        seen = {}
+        for limit, offset, file_list in pages:
+            for record in file_list or []:
+                file_id = record.get('fileId')
+                if not file_id:
+                    continue
+                candidate = (offset, limit, record.get('processingStatus'))
+                seen[file_id] = self._pick(seen.get(file_id), candidate)
+
+        now = datetime.datetime.utcnow()
+        operations = []
+        for file_id, (offset, limit, status) in seen.items():
+            query = {'_id': file_id}
+            if status != FileStatus.FINISHED:
+                query['processingStatus'] = {'$ne': FileStatus.FINISHED}
+            operations.append(UpdateOne(
+                query,
+                {'$set': {'offset': offset, 'limit': limit, 'processingStatus': status, 'updatedAt': now}},
+                upsert=True
+            ))
+        return operations
+
+    def log_write_error(self, error):
+        if isinstance(error, BulkWriteError):
+            # a filtered upsert against an already FINISHED entry surfaces as a duplicate key error.
+            errors = [err for err in error.details.get('writeErrors', []) if err.get('code') != DUPLICATE_KEY_ERROR]
+            if errors:
+                LOGGER.warning(f"Could not record {len(errors)} catalog entries. {errors[0].get('errmsg')}.")
+        else:
+            LOGGER.warning(f"Could not record catalog entries. {str(error)}.")
+
+    def record_pages(self, pages):
+        """
+        Upsert the files seen on a set of pages in one bulk write, see page_operations().
+        """
+        operations = self.page_operations(pages)
+        if not operations:
+            return 0
+
+        try:
+            self._collection.bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            self.log_write_error(e)
+        return len(operations)
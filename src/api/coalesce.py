@@ -0,0 +1,239 @@
+import os
+import uuid
+import asyncio
+import logging
+import datetime
+from functools import partial
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from api.models import FetchLeaseModel
+
+LOGGER = logging.getLogger(__name__)
+# seconds a worker may hold the upstream fetch of a file. Keep it above the worst case page scan.
+FETCH_LEASE_TTL = int(os.environ.get('FETCH_LEASE_TTL', 60))
+# seconds between two checks of a lease held by another worker.
+FETCH_LEASE_POLL_INTERVAL = float(os.environ.get('FETCH_LEASE_POLL_INTERVAL', 0.2))
+
+
+class FetchLease(object):
+    """
+    A lease document in MongoDB that makes sure only one gunicorn worker
+    fetches a file from the processing API at a time.
+    Storage errors fail open, i.e. the caller fetches without a lease.
+    """
+    def __init__(self, model=FetchLeaseModel, ttl=FETCH_LEASE_TTL, poll_interval=FETCH_LEASE_POLL_INTERVAL):
+        self.model = model
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def acquire(self, key):
+        """
+        Take the lease if nobody holds it or the holder let it expire.
+        Returns a token to release it with, or None if another worker holds it.
+        """
+        now = datetime.datetime.utcnow()
+        token = uuid.uuid4().hex
+        try:
+            self._collection.find_one_and_update(
+                {'_id': key, 'expiresAt': {'$lt': now}},
+                {'$set': {'token': token, 'expiresAt': now + datetime.timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return None
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not acquire fetch lease of {key}. Fetching without it. {str(e)}.")
+        return token
+
+    def release(self, key, token):
+        try:
+            self._collection.delete_one({'_id': key, 'token': token})
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not release fetch lease of {key}. It expires in {self.ttl}s. {str(e)}.")
+
+    def is_held(self, key):
+        try:
+            return self._collection.find_one({'_id': key, 'expiresAt': {'$gt': datetime.datetime.utcnow()}}) is not None
+        except PyMongoError:
+            return False
+
+    def wait(self, key):
+        """
+        Block the green thread until the lease of key is released or has expired.
+        """
+        import gevent
+
+        while self.is_held(key):
+            gevent.sleep(self.poll_interval)
+
+
+class FetchCoalescer(object):
+    """
+    Coalesces concurrent cold requests for the same file so that they cost one upstream fetch.
+
+    Inside a worker, concurrent calls for a key wait on the one in flight and get its
+    result (or exception). Across workers, the lease holder fetches while the others wait
+    for the lease and then read what it stored. A fetch that stores what it fetched
+    later, e.g. through the write-behind queue, keeps the lease until then with hold().
+    """
+    def __init__(self, lease=None):
+        self._lease = lease or FetchLease()
+        self._calls = {}
+        # key -> lease token of the fetches in flight.
+        self._tokens = {}
+        # key -> lease token kept past the end of its fetch, see hold().
+        self._held = {}
+        self.fetches = 0
+        self.coalesced = 0
+        self.lease_waits = 0
+
+    def fetch(self, key, fetch_fn, load_fn):
+        """
+        @param fetch_fn: callable fetching the value from upstream and storing it.
+        @param load_fn: callable reading the value from local storage, None if missing.
+        """
+        from gevent.event import AsyncResult
+
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return call.get()
+
+        call = AsyncResult()
+        self._calls[key] = call
+        try:
+            result = self._fetch_with_lease(key, fetch_fn, load_fn)
+        except BaseException as e:
+            # a killed or timed out leader too, or its followers would wait forever.
+            call.set_exception(e)
+            raise
+        else:
+            call.set(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    def hold(self, key):
+        """
+        Keep the lease of the fetch of key in flight past its end, until the returned
+        callable is called, e.g. once what it fetched is stored. Meanwhile the calls
+        for key in this worker are answered by load_fn, the other workers wait.
+        Returns None if there is no fetch of key in flight.
+        """
+        token = self._tokens.pop(key, None)
+        if token is None:
+            return None
+        self._held[key] = token
+        return partial(self._release_held, key, token)
+
+    def _release_held(self, key, token):
+        if self._held.get(key) == token:
+            self._held.pop(key, None)
+        self._lease.release(key, token)
+
+    def _release(self, key, token):
+        # a held lease is released by its holder.
+        if self._tokens.pop(key, None) is not None:
+            self._lease.release(key, token)
+
+    def _fetch_with_lease(self, key, fetch_fn, load_fn):
+        while True:
+            if key in self._held:
+                # this worker fetched it and is yet to store it.
+                result = load_fn()
+                if result is not None:
+                    return result
+            token = self._lease.acquire(key)
+            if token is not None:
+                break
+            LOGGER.info(f"Another worker is fetching {key}. Waiting for its lease.")
+            self.lease_waits += 1
+            self._lease.wait(key)
+            result = load_fn()
+            if result is not None:
+                return result
+
+        self._tokens[key] = token
+        try:
+            # the previous holder may have stored it right before we took the lease.
+            result = load_fn()
+            if result is not None:
+                return result
+            self.fetches += 1
+            return fetch_fn()
+        finally:
+            self._release(key, token)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'fetches': self.fetches,
+            'coalesced': self.coalesced,
+            'lease_waits': self.lease_waits,
+            'held': len(self._held),
+        }
+
+
+class AsyncFetchCoalescer(FetchCoalescer):
+    """
+    FetchCoalescer for the asyncio strategy. fetch_fn and load_fn are coroutine functions.
+    Concurrent calls for a key in the event loop wait on the one in flight. The lease
+    is taken and polled with pymongo in the default executor.
+    """
+    async def fetch(self, key, fetch_fn, load_fn):
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return await asyncio.shield(call)
+
+        call = asyncio.get_event_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await self._fetch_with_lease(key, fetch_fn, load_fn)
+        except BaseException as e:
+            call.set_exception(e)
+            # nobody may be waiting on it.
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    async def _fetch_with_lease(self, key, fetch_fn, load_fn):
+        loop = asyncio.get_event_loop()
+        while True:
+            if key in self._held:
+                result = await load_fn()
+                if result is not None:
+                    return result
+            token = await loop.run_in_executor(None, self._lease.acquire, key)
+            if token is not None:
+                break
+            LOGGER.info(f"Another worker is fetching {key}. Waiting for its lease.")
+            self.lease_waits += 1
+            while await loop.run_in_executor(None, self._lease.is_held, key):
+                await asyncio.sleep(self._lease.poll_interval)
+            result = await load_fn()
+            if result is not None:
+                return result
+
+        self._tokens[key] = token
+        try:
+            # the previous holder may have stored it right before we took the lease.
+            result = await load_fn()
+            if result is not None:
+                return result
+            self.fetches += 1
+            return await fetch_fn()
+        finally:
+            await loop.run_in_executor(None, self._release, key, token)
+
+
+COALESCER = FetchCoalescer()
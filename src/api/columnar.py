@@ -0,0 +1,117 @@
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+from bson.binary import Binary
+
+VERSION = 1
+INT_COLUMNS = ('fileSegmentId', 'startTime', 'endTime')
+TEXT_COLUMN = 'segmentText'
+# a key every segment of a file repeats with the id of the file.
+FILE_ID = 'fileId'
+COLUMNS = INT_COLUMNS + (TEXT_COLUMN, FILE_ID)
+INT32 = (-2 ** 31, 2 ** 31 - 1)
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+
+def _int_array(values):
+    """
+    Little endian packed ints, 4 bytes each if they all fit, 8 otherwise. None if a value is not an int64.
+    """
+    if not all(type(v) is int for v in values):
+        return None
+    low, high = (min(values), max(values)) if values else (0, 0)
+    if low < INT64[0] or high > INT64[1]:
+        return None
+    typecode = 'i' if INT32[0] <= low and high <= INT32[1] else 'q'
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return {'type': typecode, 'data': Binary(packed.tobytes())}
+
+
+def _ints(column):
+    packed = array(column['type'])
+    packed.frombytes(column['data'])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tolist()
+
+
+def pack_segments(file_id, segments):
+    """
+    The segments of a file as columns: packed int arrays of the ids, start and end
+    times, and the texts as one zlib compressed blob with their lengths. fileId is not
+    repeated. Returns None if the segments cannot be packed without losing anything,
+    i.e. they do not all have the same keys out of COLUMNS, values of the expected
+    types or the fileId of the file. Those are stored as they are.
+    """
+    segments = segments or []
+    keys = sorted(segments[0]) if segments else []
+    if not set(keys) <= set(COLUMNS) or any(sorted(s) != keys for s in segments):
+        return None
+    if FILE_ID in keys and any(s[FILE_ID] != file_id for s in segments):
+        return None
+
+    packed = {'v': VERSION, 'count': len(segments), 'keys': keys}
+    for key in INT_COLUMNS:
+        if key in keys:
+            packed[key] = _int_array([s[key] for s in segments])
+            if packed[key] is None:
+                return None
+    if TEXT_COLUMN in keys:
+        texts = [s[TEXT_COLUMN] for s in segments]
+        if not all(type(t) is str for t in texts):
+            return None
+        # lengths are in characters, the blob is decoded once and sliced.
+        packed['textLengths'] = _int_array([len(t) for t in texts])
+        packed['text'] = Binary(zlib.compress(''.join(texts).encode('utf-8')))
+    return packed
+
+
+def unpack_segments(file_id, packed, start=0, stop=None):
+    """
+    The segments pack_segments() packed, equal to the ones it was given.
+    Pass start and stop to only build the segments of a page.
+    """
+    if packed.get('v') != VERSION:
+        raise ValueError(f"Unknown packed segments version {packed.get('v')}.")
+    window = slice(start, stop)
+    count = len(range(packed['count'])[window])
+    columns = {key: _ints(packed[key])[window] for key in INT_COLUMNS if key in packed['keys']}
+    if TEXT_COLUMN in packed['keys']:
+        text = zlib.decompress(packed['text']).decode('utf-8')
+        ends = list(accumulate(_ints(packed['textLengths'])))
+        columns[TEXT_COLUMN] = [text[a:b] for a, b in zip([0] + ends, ends)][window]
+    if FILE_ID in packed['keys']:
+        columns[FILE_ID] = [file_id] * count
+    keys = list(columns)
+    if len(keys) == len(COLUMNS):
+        # segments usually have every key, a dict display builds them a lot faster than dict(zip()).
+        return [
+            {'fileSegmentId': i, 'startTime': s, 'endTime': e, 'segmentText': t, 'fileId': f}
+            for i, s, e, t, f in zip(*columns.values())
+        ]
+    return [dict(zip(keys, row)) for row in zip(*columns.values())] if keys else [{} for _ in range(count)]
+
+
+def unpack_chunks(file_id, records, start=0, stop=None):
+    """
+    The segments of a file stored a chunk at a time, see api.streaming. A record is
+    the pack_segments() of a chunk, or {'count': n, 'segments': [...]} if it could not be packed.
+    Chunks out of the [start, stop) page are skipped without being unpacked.
+    """
+    segments, offset = [], 0
+    for record in records:
+        count = record['count']
+        if stop is not None and offset >= stop:
+            break
+        if offset + count > start:
+            window = (max(start - offset, 0), None if stop is None else stop - offset)
+            if 'v' in record:
+                segments.extend(unpack_segments(file_id, record, *window))
+            else:
+                segments.extend(record['segments'][slice(*window)])
+        offset += count
+    return segments
@@ -0,0 +1,51 @@
+import os
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+IDENTITY = 'identity'
+GZIP = 'gzip'
+BROTLI = 'br'
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+# bodies smaller than this are not worth compressing.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+
+
+def supported_encodings():
+    """
+    Content codings we can produce, most preferred first.
+    Brotli is in the requirements, it is only offered if the brotli package is installed.
+    """
+    if brotli is not None:
+        return [BROTLI, GZIP]
+    return [GZIP]
+
+
+def negotiate(accept_encodings, size):
+    """
+    Pick the content coding of a response body of size bytes.
+
+    @param accept_encodings: the werkzeug Accept object of the Accept-Encoding header.
+    """
+    if size < COMPRESSION_MIN_BYTES:
+        return IDENTITY
+    best, quality = IDENTITY, 0
+    for encoding in supported_encodings():
+        q = accept_encodings.quality(encoding)
+        if q > quality:
+            best, quality = encoding, q
+    return best
+
+
+def compress(body, encoding):
+    if encoding == GZIP:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return body
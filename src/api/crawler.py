@@ -0,0 +1,83 @@
+if __name__ == '__main__':
+    # patch before requests/pymongo get imported so that their sockets are cooperative.
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
+import logging
+
+from api.catalog import FileCatalog
+from api.external_api import ProcessingAPIAdapter
+from api.jobs import MAX_PAGES
+
+LOGGER = logging.getLogger(__name__)
+CATALOG_CRAWL_INTERVAL = int(os.environ.get('CATALOG_CRAWL_INTERVAL', 300))
+CATALOG_CRAWL_CONCURRENCY = int(os.environ.get('CATALOG_CRAWL_CONCURRENCY', 10))
+
+
+class CatalogCrawler(object):
+    """
+    A background job that sweeps the paginated processing API
+    and records every file it sees in the catalog.
+    Run it as a separate process with `python -m api.crawler`.
+    """
+    def __init__(self, processing_api=None, catalog=None, limit=5, max_pages=MAX_PAGES,
+                 concurrency=CATALOG_CRAWL_CONCURRENCY, timeout=5):
+        if not processing_api:
+            self._api = ProcessingAPIAdapter()
+        else:
+            self._api = processing_api
+
+        if not catalog:
+            self._catalog = FileCatalog()
+        else:
+            self._catalog = catalog
+
+        self.limit = limit
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def crawl_page(self, offset):
+        import gevent
+
+        with gevent.Timeout(self.timeout):
+            return (self.limit, offset, self._api.fetch_all(self.limit, offset))
+
+    def crawl(self):
+        """
+        Sweep MAX_PAGES pages with bounded concurrency and record them in the catalog.
+        """
+        from gevent.pool import Pool
+
+        pool = Pool(self.concurrency)
+        jobs = [pool.spawn(self.crawl_page, offset) for offset in range(0, self.max_pages + 1)]
+        pool.join()
+
+        pages = [j.value for j in jobs if j.successful()]
+        recorded = self._catalog.record_pages(pages)
+        LOGGER.info(f"Crawled {len(pages)} of {len(jobs)} pages and recorded {recorded} files in the catalog.")
+        return recorded
+
+    def run_forever(self, interval=CATALOG_CRAWL_INTERVAL):
+        import gevent
+
+        while True:
+            try:
+                self.crawl()
+            except Exception as e:
+                LOGGER.exception(f"Catalog crawl failed. {str(e)}.")
+            gevent.sleep(interval)
+
+
+def main():
+    from pymodm import connect
+
+    from core.logging_setup import setup_logging
+    setup_logging()
+    connect(os.environ.get('DB_CONNECTION_STRING'))
+    CatalogCrawler().run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,36 @@
 import time
 import logging
 from functools import wraps
+
+from api.metrics import METRICS
+
 LOGGER = logging.getLogger(__name__)
+REQUEST_LATENCY = METRICS.histogram('api_request_seconds', "Latency of the API endpoints.", ['endpoint'])
+REQUESTS = METRICS.counter('api_requests_total', "Requests served by the API endpoints.", ['endpoint', 'status'])
+REQUESTS_IN_FLIGHT = METRICS.gauge('api_requests_in_flight', "Requests being served.", ['endpoint'])
 
 
-def log_latency_decorator(func):
+def metrics_decorator(func):
     """
-    Decorator function to log time taken.
+    Decorator function to record the latency, status and concurrency of an endpoint.
     Example,
-    @log_latency_decorator
+    @metrics_decorator
     def f():
         ..
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        LOGGER.info(f"\nRunning {func.__name__}.")
-        start_time = time.time()
-        LOGGER.info(f"Start time is {start_time}.")
-        res = func(*args, **kwargs)
-        end_time = time.time()
-        LOGGER.info(f"End time is {end_time}.")
-        LOGGER.info(f"Total time taken in seconds is {end_time - start_time}.")
-        return res
+        endpoint = func.__name__
+        REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+        start_time = time.perf_counter()
+        status = 500
+        try:
+            res = func(*args, **kwargs)
+            status = getattr(res, 'status_code', 200)
+            return res
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=status)
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+            METRICS.maybe_flush()
     return wrapper
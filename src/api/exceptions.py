@@ -3,8 +3,18 @@ class APIException(Exception):
 
 
 class FileInvalidStatusError(Exception):
-    pass
+    def __init__(self, message='', status=None):
+        super().__init__(message)
+        self.status = status
 
 
 class FileNotFound(Exception):
     pass
+
+
+class CircuitOpenError(APIException):
+    pass
+
+
+class LimiterTimeout(APIException):
+    pass
@@ -1,21 +1,169 @@
 import os
+import time
 import logging
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from api.exceptions import APIException
+from api.jsonstream import iter_json_array
+from api.limiter import UPSTREAM_LIMITER
+from api.metrics import METRICS
+from api.resilience import UPSTREAM_POLICY
 
 LOGGER = logging.getLogger(__name__)
 PROCESSING_API_HOST = os.environ.get('PROCESSING_API_HOST')
+# no. of hosts we keep a connection pool for.
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+# no. of keep-alive connections kept per host. Size it to the gevent fan-out of a worker.
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 50))
+# seconds a pool may sit idle before its connections are dropped.
+HTTP_KEEPALIVE_TIMEOUT = int(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 30))
+# segments responses of at least this many bytes, or of unknown length, are parsed as they are read. 0 reads them whole.
+SEGMENTS_STREAM_MIN_BYTES = int(os.environ.get('SEGMENTS_STREAM_MIN_BYTES', 1024 * 1024))
+# bytes read from a streamed response at a time.
+SEGMENTS_STREAM_READ_SIZE = int(os.environ.get('SEGMENTS_STREAM_READ_SIZE', 64 * 1024))
+# seconds a read of a streamed response may take.
+SEGMENTS_STREAM_READ_TIMEOUT = float(os.environ.get('SEGMENTS_STREAM_READ_TIMEOUT', 5))
+UPSTREAM_LATENCY = METRICS.histogram('upstream_request_seconds', "Latency of the processing API endpoints.", ['endpoint'])
+UPSTREAM_ERRORS = METRICS.counter('upstream_errors_total', "Failed calls to the processing API endpoints.", ['endpoint', 'reason'])
+UPSTREAM_IN_FLIGHT = METRICS.gauge('upstream_requests_in_flight', "Calls to the processing API in flight.", ['endpoint'])
+
+
+class PooledSession(object):
+    """
+    A requests.Session with keep-alive connection pools shared by every
+    adapter instance of a worker process.
+
+    The session is rebuilt after a fork, so gunicorn workers never share
+    sockets, and when it has been idle for longer than the keep-alive timeout,
+    so we do not hand out connections the server already closed.
+    """
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._pid = None
+        self._last_used = 0
+        self._retired = {'requests': 0, 'new_connections': 0}
+
+    def _build(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _pools(self):
+        if self._session is None:
+            return []
+        adapters = {id(a): a for a in self._session.adapters.values() if isinstance(a, HTTPAdapter)}
+        pools = []
+        for adapter in adapters.values():
+            container = adapter.poolmanager.pools
+            pools.extend(container[key] for key in container.keys())
+        return pools
+
+    def _retire(self):
+        stats = self._pool_stats()
+        self._retired['requests'] += stats['requests']
+        self._retired['new_connections'] += stats['new_connections']
+        self._session.close()
+        self._session = None
+
+    def _pool_stats(self):
+        pools = self._pools()
+        return {
+            'requests': sum(p.num_requests for p in pools),
+            'new_connections': sum(p.num_connections for p in pools),
+        }
+
+    def get(self):
+        now = time.monotonic()
+        if self._session is not None and self._pid != os.getpid():
+            # forked from the parent, start with fresh sockets.
+            self._session = None
+        if self._session is not None and self.keepalive_timeout and now - self._last_used > self.keepalive_timeout:
+            LOGGER.debug("HTTP session idle for longer than keep-alive timeout. Dropping its connections.")
+            self._retire()
+        if self._session is None:
+            self._session = self._build()
+            self._pid = os.getpid()
+        self._last_used = now
+        return self._session
+
+    def stats(self):
+        """
+        Counters of requests sent and connections opened by this worker.
+        Every request that did not open a new connection reused a pooled one.
+        """
+        current = self._pool_stats()
+        requests_sent = self._retired['requests'] + current['requests']
+        new_connections = self._retired['new_connections'] + current['new_connections']
+        return {
+            'requests': requests_sent,
+            'new_connections': new_connections,
+            'reused_connections': max(requests_sent - new_connections, 0),
+        }
+
+
+SESSION_POOL = PooledSession()
+
+
+class SegmentStream(object):
+    """
+    The segments of a file in an open processing API response, parsed as they are
+    read, see api.streaming. Iterate it once, and close it if you do not.
+    """
+    def __init__(self, response, read_size=SEGMENTS_STREAM_READ_SIZE, read_timeout=SEGMENTS_STREAM_READ_TIMEOUT):
+        self.response = response
+        self.read_size = read_size
+        self.read_timeout = read_timeout
+        self.bytes_read = 0
+
+    def _chunks(self):
+        import gevent
+
+        chunks = self.response.iter_content(self.read_size)
+        while True:
+            with gevent.Timeout(self.read_timeout, APIException("Timed out reading file segments.")):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        try:
+            yield from iter_json_array(self._chunks())
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
+
+
+def is_large(response, min_bytes=SEGMENTS_STREAM_MIN_BYTES):
+    length = response.headers.get('Content-Length')
+    return min_bytes > 0 and (length is None or int(length) >= min_bytes)
 
 
 class ProcessingAPIAdapter(object):
     """
     An adapter class to implement file processing API calls.
     This is borrowed from my own implementation in erstwhile similar project.
+    All instances share the keep-alive connections of SESSION_POOL, the
+    retries, hedging and circuit breakers of UPSTREAM_POLICY and the
+    concurrency window of UPSTREAM_LIMITER. Every instance is a flow of its
+    own in the queues of the limiter, e.g. a request, the crawler or the warmer.
     """
-    def __init__(self):
+    def __init__(self, session_pool=None, policy=None, limiter=None):
         self._host = PROCESSING_API_HOST
+        self._sessions = session_pool or SESSION_POOL
+        self._policy = policy or UPSTREAM_POLICY
+        self._limiter = limiter or UPSTREAM_LIMITER
 
     def _regulate_headers(self, headers=None):
         if not headers:
@@ -47,12 +195,19 @@ class ProcessingAPIAdapter(object):
                 raise e
         return response
 
-    def _get(self, relative_url, headers=None, params=None, raise_on_error=True):
+    def _get(self, relative_url, headers=None, params=None, raise_on_error=True, endpoint=None, stream=False):
         """
         A wrapper method to GET results from an API.
-        Apart from calling requests.get it prepares the request and
+        Apart from calling GET on the pooled session it prepares the request and
         handles the response appropriately so that the interface for
         the adapter methods are simple.
+
+        Latency, errors and calls in flight are recorded per endpoint, the URL
+        template (e.g. file/details) rather than the URL of a file, and per attempt,
+        so retried and hedged calls are counted once for every request sent.
+        A stream=True call is done once the headers are read, the body is read by the caller.
+        All processing API calls are idempotent GETs, so they go through the
+        retries, hedging and circuit breaker of the upstream policy.
         """
         if not params:
             params = {}
@@ -63,27 +218,53 @@ class ProcessingAPIAdapter(object):
         headers = self._regulate_headers(headers)
         api_url = self._get_api_url(relative_url)
         LOGGER.info("Calling processing API %s with headers %s and params %s.", api_url, headers, params)
-        # gevent would monkey patch requests lib to be async.
-        response = requests.get(api_url, headers=headers, params=params, verify=False)
-        return self._respond_or_raise(response, raise_exec=raise_on_error)
+        endpoint = endpoint or relative_url
+        # a streamed call only waits for the headers, it is not as slow as one that reads the body.
+        baseline = f'{endpoint} stream' if stream else endpoint
+
+        def send():
+            with self._limiter.slot(id(self), baseline):
+                UPSTREAM_IN_FLIGHT.inc(endpoint=endpoint)
+                start_time = time.perf_counter()
+                try:
+                    # gevent would monkey patch requests lib to be async.
+                    response = self._sessions.get().get(api_url, headers=headers, params=params, verify=False, stream=stream)
+                    return self._respond_or_raise(response, raise_exec=raise_on_error)
+                except requests.exceptions.HTTPError as e:
+                    UPSTREAM_ERRORS.inc(endpoint=endpoint, reason=e.response.status_code if e.response is not None else 'HTTPError')
+                    raise
+                except BaseException as e:
+                    # timeouts, killed scan jobs and cancelled hedges are counted too.
+                    UPSTREAM_ERRORS.inc(endpoint=endpoint, reason=type(e).__name__)
+                    raise
+                finally:
+                    UPSTREAM_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+                    UPSTREAM_IN_FLIGHT.dec(endpoint=endpoint)
+
+        return self._policy.call(endpoint, send)
 
     def fetch_all(self, limit=5, offset=0):
         """
         Adapter method to fetch all files ingested by Snackable through a paginated endpoint.
         """
         relative_url = '/api/file/all'
-        return self._get(relative_url, params={'limit': limit, 'offset': offset}).json()
+        return self._get(relative_url, params={'limit': limit, 'offset': offset}, endpoint='file/all').json()
 
     def fetch_details(self, file_id):
         """
         Adapter method to fetch additional file details for a given file id.
         """
         relative_url = f'/api/file/details/{file_id}'
-        return self._get(relative_url).json()
+        return self._get(relative_url, endpoint='file/details').json()
 
-    def fetch_segments(self, file_id):
+    def fetch_segments(self, file_id, stream=False):
         """
         Adapter method to fetch file segment information for a given file id.
+
+        @param stream: return a SegmentStream instead of the list if the response is large.
         """
         relative_url = f'/api/file/segments/{file_id}'
-        return self._get(relative_url).json()
+        response = self._get(relative_url, endpoint='file/segments', stream=stream)
+        if stream and is_large(response):
+            return SegmentStream(response)
+        return response.json()
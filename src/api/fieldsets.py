@@ -0,0 +1,117 @@
+from api.segments import SEGMENTS_PAGE_SIZE
+from api.storage import unpack_file
+
+# presentation fields that can be asked for with ?fields=. fileId is always returned.
+FIELDS = ('fileId', 'processingStatus', 'fileName', 'fileLength', 'mp3Path', 'originalFilePath', 'seriesTitle', 'segments')
+SEGMENTS_ALL = 'all'
+SEGMENTS_NONE = 'none'
+SEGMENTS_COUNT = 'count'
+SEGMENTS_PAGE = 'page'
+SEGMENTS_OPTIONS = (SEGMENTS_ALL, SEGMENTS_NONE, SEGMENTS_COUNT, SEGMENTS_PAGE)
+
+
+class FieldSet(object):
+    """
+    The part of a stored file a presentation request asks for.
+
+    It is pushed down to MongoDB as a projection, so the fields (and segments)
+    the caller did not ask for never leave the database. segments=count is
+    computed with $size and segments=page cut with $slice on the server.
+    Packed segments, see api.columnar, are read whole and cut here, a count
+    is read from their header.
+    """
+    def __init__(self, fields=None, segments=SEGMENTS_ALL, offset=0, limit=SEGMENTS_PAGE_SIZE):
+        self.fields = fields
+        self.segments = segments
+        self.offset = offset
+        self.limit = limit
+
+    @classmethod
+    def parse(cls, fields=None, segments=None, offset=0, limit=SEGMENTS_PAGE_SIZE):
+        """
+        Build a field set from the fields and segments query parameters.
+        Raises ValueError on bad input.
+
+        Without a segments parameter the segments are returned in full if
+        fields asks for them (or is not given), and left out otherwise.
+        """
+        if fields:
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+            unknown = [f for f in fields if f not in FIELDS]
+            if unknown:
+                raise ValueError(f"Unknown fields {', '.join(unknown)}. Choose from {', '.join(FIELDS)}.")
+        else:
+            fields = None
+
+        if not segments:
+            segments = SEGMENTS_ALL if fields is None or 'segments' in fields else SEGMENTS_NONE
+        if segments not in SEGMENTS_OPTIONS:
+            raise ValueError(f"segments must be one of {', '.join(SEGMENTS_OPTIONS)}.")
+        return cls(fields, segments, offset, limit)
+
+    @property
+    def is_full(self):
+        return self.fields is None and self.segments == SEGMENTS_ALL
+
+    @property
+    def needs_segments(self):
+        return self.segments != SEGMENTS_NONE
+
+    def _scalar_fields(self):
+        return [f for f in (self.fields or FIELDS) if f not in ('fileId', 'segments')]
+
+    def projection(self):
+        projection = {'_id': 1}
+        projection.update({f: 1 for f in self._scalar_fields()})
+        if self.segments == SEGMENTS_ALL:
+            projection['segments'] = 1
+            projection['segmentsPacked'] = 1
+        elif self.segments == SEGMENTS_PAGE:
+            projection['segments'] = {'$slice': [self.offset, self.limit]}
+            projection['segmentsPacked'] = 1
+        return projection
+
+    def read(self, model, file_id, extra_fields=()):
+        """
+        Read the field set of a stored file. Returns None if the file is not stored.
+
+        @param extra_fields: stored fields to read along, e.g. fetchedAt. apply() leaves them out.
+        """
+        collection = model._mongometa.collection
+        projection = self.projection()
+        projection.update({f: 1 for f in extra_fields})
+        if self.segments != SEGMENTS_COUNT:
+            document = collection.find_one({'_id': file_id}, projection=projection)
+            if document is None or 'segmentsPacked' not in document:
+                return document
+            if self.segments == SEGMENTS_PAGE:
+                return unpack_file(document, model, self.offset, self.offset + self.limit)
+            return unpack_file(document, model)
+
+        projection['segmentCount'] = {'$size': {'$ifNull': ['$segments', []]}}
+        projection['segmentsPacked.count'] = 1
+        documents = list(collection.aggregate([{'$match': {'_id': file_id}}, {'$project': projection}]))
+        if documents and 'segmentsPacked' in documents[0]:
+            documents[0]['segmentCount'] = documents[0].pop('segmentsPacked')['count']
+        return documents[0] if documents else None
+
+    def apply(self, document, projected=False):
+        """
+        Shape a file document into the response body.
+
+        @param projected: whether the document was read with this field set's projection,
+        i.e. its segments are already sliced or counted.
+        """
+        result = {'fileId': document.get('fileId', document.get('_id'))}
+        for field in self._scalar_fields():
+            if field in document:
+                result[field] = document[field]
+
+        segments = document.get('segments') or []
+        if self.segments == SEGMENTS_ALL:
+            result['segments'] = segments
+        elif self.segments == SEGMENTS_PAGE:
+            result['segments'] = segments if projected else segments[self.offset:self.offset + self.limit]
+        elif self.segments == SEGMENTS_COUNT:
+            result['segmentCount'] = document['segmentCount'] if projected else len(segments)
+        return result
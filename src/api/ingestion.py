@@ -0,0 +1,184 @@
+if __name__ == '__main__':
+    # patch before requests/pymongo get imported so that their sockets are cooperative.
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
+import uuid
+import random
+import logging
+import datetime
+
+from pymongo import ASCENDING, ReturnDocument
+
+from api.jobs import GeventJobs
+from api.models import IngestionJobModel
+from api.storage import save_file
+from api.utils import FileStatus
+
+LOGGER = logging.getLogger(__name__)
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', 4))
+INGESTION_POLL_INTERVAL = float(os.environ.get('INGESTION_POLL_INTERVAL', 1))
+INGESTION_MAX_ATTEMPTS = int(os.environ.get('INGESTION_MAX_ATTEMPTS', 5))
+INGESTION_BACKOFF_BASE = float(os.environ.get('INGESTION_BACKOFF_BASE', 2))
+INGESTION_BACKOFF_MAX = float(os.environ.get('INGESTION_BACKOFF_MAX', 300))
+# seconds a claimed job stays invisible to other workers. A crashed worker's job is retried after it.
+INGESTION_VISIBILITY_TIMEOUT = int(os.environ.get('INGESTION_VISIBILITY_TIMEOUT', 120))
+
+
+class JobState(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class IngestionQueue(object):
+    """
+    A job queue in MongoDB, so that no outside broker is needed.
+    There is one job per file, a repeat notification re-queues it.
+    """
+    def __init__(self, model=IngestionJobModel, max_attempts=INGESTION_MAX_ATTEMPTS,
+                 backoff_base=INGESTION_BACKOFF_BASE, backoff_max=INGESTION_BACKOFF_MAX,
+                 visibility_timeout=INGESTION_VISIBILITY_TIMEOUT):
+        self.model = model
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.visibility_timeout = visibility_timeout
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def enqueue(self, file_id):
+        now = datetime.datetime.utcnow()
+        self._collection.update_one(
+            {'_id': file_id},
+            {
+                '$set': {'state': JobState.PENDING, 'attempts': 0, 'runAt': now, 'updatedAt': now},
+                '$unset': {'token': '', 'lockedUntil': '', 'lastError': ''},
+            },
+            upsert=True
+        )
+
+    def claim(self):
+        """
+        Take the next due job, or a running one whose worker let its lock expire.
+        """
+        now = datetime.datetime.utcnow()
+        return self._collection.find_one_and_update(
+            {'$or': [
+                {'state': JobState.PENDING, 'runAt': {'$lte': now}},
+                {'state': JobState.RUNNING, 'lockedUntil': {'$lt': now}},
+            ]},
+            {
+                '$set': {
+                    'state': JobState.RUNNING,
+                    'token': uuid.uuid4().hex,
+                    'lockedUntil': now + datetime.timedelta(seconds=self.visibility_timeout),
+                    'updatedAt': now,
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('runAt', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def complete(self, job):
+        # the token check leaves a job re-queued by a newer notification pending.
+        self._collection.update_one(
+            {'_id': job['_id'], 'token': job['token']},
+            {'$set': {'state': JobState.DONE, 'updatedAt': datetime.datetime.utcnow()}}
+        )
+
+    def backoff(self, attempts):
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
+
+    def fail(self, job, error):
+        now = datetime.datetime.utcnow()
+        if job['attempts'] >= self.max_attempts:
+            update = {'state': JobState.FAILED}
+            LOGGER.error(f"Giving up on ingestion of {job['_id']} after {job['attempts']} attempts. {error}.")
+        else:
+            update = {'state': JobState.PENDING, 'runAt': now + datetime.timedelta(seconds=self.backoff(job['attempts']))}
+        update.update({'lastError': str(error), 'updatedAt': now})
+        self._collection.update_one({'_id': job['_id'], 'token': job['token']}, {'$set': update})
+
+    def depth(self):
+        """
+        No. of jobs per state, pending is the queue depth.
+        """
+        depth = {JobState.PENDING: 0, JobState.RUNNING: 0, JobState.DONE: 0, JobState.FAILED: 0}
+        for group in self._collection.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+            depth[group['_id']] = group['count']
+        return depth
+
+
+class IngestionWorker(object):
+    """
+    Background gevent workers that pull jobs from the ingestion queue and store
+    the finished files ahead of demand. Run them as a separate process with
+    `python -m api.ingestion`.
+    """
+    def __init__(self, queue=None, strategy=None, concurrency=INGESTION_WORKERS, poll_interval=INGESTION_POLL_INTERVAL):
+        self._queue = queue or IngestionQueue()
+        self._strategy = strategy or GeventJobs()
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+    def process(self, job):
+        the_file = self._strategy.fetch_details_bundle({'fileId': job['_id'], 'processingStatus': FileStatus.FINISHED})
+        save_file(the_file)
+
+    def run_once(self):
+        """
+        Process the next due job. Returns False if there was none.
+        """
+        job = self._queue.claim()
+        if job is None:
+            return False
+        try:
+            self.process(job)
+        except Exception as e:
+            LOGGER.warning(f"Ingestion of {job['_id']} failed on attempt {job['attempts']}. {str(e)}.")
+            self._queue.fail(job, e)
+        else:
+            LOGGER.info(f"Ingested {job['_id']}.")
+            self._queue.complete(job)
+        return True
+
+    def loop(self):
+        import gevent
+
+        while True:
+            try:
+                if not self.run_once():
+                    gevent.sleep(self.poll_interval)
+            except Exception as e:
+                LOGGER.exception(f"Ingestion worker failed. {str(e)}.")
+                gevent.sleep(self.poll_interval)
+
+    def run_forever(self):
+        import gevent
+
+        gevent.joinall([gevent.spawn(self.loop) for _ in range(self.concurrency)])
+
+
+INGESTION_QUEUE = IngestionQueue()
+
+
+def main():
+    from pymodm import connect
+
+    from core.logging_setup import setup_logging
+    setup_logging()
+    connect(os.environ.get('DB_CONNECTION_STRING'))
+    IngestionWorker().run_forever()
+
+
+if __name__ == '__main__':
+    main()
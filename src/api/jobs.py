@@ -1,12 +1,16 @@
 import os
 import logging
 
-from api.external_api import ProcessingAPIAdapter
+from api.catalog import FileCatalog
+from api.external_api import ProcessingAPIAdapter, SegmentStream
 from api.exceptions import APIException, FileNotFound, FileInvalidStatusError
+from api.metrics import FOUND_PAGE, STAGE_LATENCY
 from api.utils import FileStatus
 
 LOGGER = logging.getLogger(__name__)
 MAX_PAGES = int(os.environ.get('MAX_PAGES', 200))
+SCAN_WINDOW = int(os.environ.get('SCAN_WINDOW', 20))
+SCAN_POOL_SIZE = int(os.environ.get('SCAN_POOL_SIZE', SCAN_WINDOW))
 
 
 class FetchFilesJob(object):
@@ -19,12 +23,15 @@ class FetchFilesJob(object):
         self.limit = limit
         self.offset = offset
         self.timeout = timeout
+        # the page as returned by the API, recorded in the catalog after the scan.
+        self.page = None
 
     def __call__(self):
         import gevent
 
         with gevent.Timeout(self.timeout):
             file_list = self.api.fetch_all(self.limit, self.offset)
+            self.page = file_list
             the_file = self.filter_by_id(file_list)
             if len(the_file) == 0:
                 return None
@@ -38,6 +45,26 @@ class FetchFilesJob(object):
         return the_file.get('processingStatus')
 
 
+class FetchManyFilesJob(FetchFilesJob):
+    """
+    A gevent green thread job to call paginated processing API for a page
+    and match every file of a batch on it at once.
+    """
+    def __init__(self, file_ids, api, limit=5, offset=0, timeout=5):
+        super().__init__(None, api, limit, offset, timeout)
+        self.file_ids = set(file_ids)
+
+    def __call__(self):
+        import gevent
+
+        with gevent.Timeout(self.timeout):
+            self.page = self.api.fetch_all(self.limit, self.offset)
+            return self.filter_by_id(self.page)
+
+    def filter_by_id(self, file_list):
+        return list(filter(lambda r: r.get('fileId') in self.file_ids, file_list))
+
+
 class FetchFileDetailsJob(object):
     """
     A gevent green thread job to get a file details from API.
@@ -50,23 +77,27 @@ class FetchFileDetailsJob(object):
     def __call__(self):
         import gevent
 
-        with gevent.Timeout(self.timeout):
+        with STAGE_LATENCY.time(stage='details'), gevent.Timeout(self.timeout):
             return self.api.fetch_details(self.file_id)
 
 
 class FetchFileSegmentsJob(object):
     """
     A gevent green thread job to get a file segments from API.
+    With stream, a large response is returned as a SegmentStream once its headers are read.
     """
-    def __init__(self, file_id, api, timeout=5):
+    def __init__(self, file_id, api, timeout=5, stream=False):
         self.file_id = file_id
         self.api = api
         self.timeout = timeout
+        self.stream = stream
 
     def __call__(self):
         import gevent
 
-        with gevent.Timeout(self.timeout):
+        with STAGE_LATENCY.time(stage='segments'), gevent.Timeout(self.timeout):
+            if self.stream:
+                return self.api.fetch_segments(self.file_id, stream=True)
             return self.api.fetch_segments(self.file_id)
 
 
@@ -77,19 +108,38 @@ class GeventJobs(object):
     to build another async/sync way of acheiving work done here
     we can implement a separate strategy class for it.
     """
-    def __init__(self, processing_api=None):
+    def __init__(self, processing_api=None, catalog=None):
         if not processing_api:
             self._api = ProcessingAPIAdapter()
         else:
             self._api = processing_api
 
+        if not catalog:
+            self._catalog = FileCatalog()
+        else:
+            self._catalog = catalog
+
     def is_finished(self, the_file):
         return the_file.get('processingStatus') == FileStatus.FINISHED
 
+    def is_killed(self, job):
+        """
+        A greenlet killed by an early terminated scan counts as successful
+        with a GreenletExit value. It tells us nothing about the file.
+        """
+        from gevent import GreenletExit
+
+        return job.ready() and job.successful() and isinstance(job.value, GreenletExit)
+
+    def completed(self, jobs):
+        return [j for j in jobs if j.ready() and not self.is_killed(j)]
+
     def is_all_error(self, jobs):
         """
         All jobs raised exception. Either timeout or requests exceptions.
+        Jobs that did not run to completion are not counted.
         """
+        jobs = self.completed(jobs)
         errors = [j.exception for j in filter(lambda x: not x.successful(), jobs)]
         return len(errors) == len(jobs)
 
@@ -97,13 +147,30 @@ class GeventJobs(object):
         """
         Some jobs raised exception and others returned None?
         Then we have not found the file we are looking for.
+        Jobs that did not run to completion are not counted.
         """
+        jobs = self.completed(jobs)
         values = [None for j in filter(lambda x: x.successful() and x.value is None, jobs)]
         errors = [None for j in filter(lambda x: not x.successful(), jobs)]
         return len(values + errors) == len(jobs)
 
+    def unfinished_status(self, jobs):
+        """
+        Status of a file none of the pages returned as FINISHED.
+        """
+        return self.preferred_status(j.value.get('processingStatus') for j in filter(self.success_filter, jobs) if j.value is not None)
+
+    def preferred_status(self, statuses):
+        """
+        PROCESSING wins over FAILED as the file may still finish.
+        """
+        statuses = set(statuses)
+        if FileStatus.PROCESSING in statuses or not statuses:
+            return FileStatus.PROCESSING
+        return statuses.pop()
+
     def success_filter(self, job):
-        return job.successful()
+        return job.successful() and not self.is_killed(job)
 
     def is_finished_filter(self, job):
         return self.success_filter(job) and job.value is not None and self.is_finished(job.value)
@@ -118,13 +185,66 @@ class GeventJobs(object):
         values = [j.value for j in filter(filter_fn, jobs)]
         return values
 
+    def record_pages(self, tasks):
+        """
+        Record the pages fetched by FetchFilesJob tasks in the catalog.
+        The bulk upsert runs in a green thread of its own, off the request path.
+        """
+        import gevent
+
+        pages = [(t.limit, t.offset, t.page) for t in tasks if t.page is not None]
+        if pages:
+            gevent.spawn(self._catalog.record_pages, pages)
+
     def fetch_file(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES):
         """
-        Fetch a file via a paginated API. We limit the calls to MAX_PAGES pages.
+        Fetch a file via a paginated API.
+
+        The catalog is checked first. If it knows the page the file was last seen on
+        we fetch only that page, otherwise we fall back to scanning MAX_PAGES pages.
+        """
+        with STAGE_LATENCY.time(stage='page_scan'):
+            entry = self._catalog.lookup(file_id, limit)
+            if entry is not None:
+                the_file = self.fetch_file_from_page(file_id, entry.offset, limit, timeout)
+                if the_file is not None:
+                    FOUND_PAGE.observe(entry.offset + 1, source='catalog')
+                    return the_file
+                LOGGER.info(f"File {file_id} not found at catalog page {entry.offset + 1}. Falling back to a full scan.")
+            return self.scan_file(file_id, limit, timeout, max_pages)
+
+    def fetch_file_from_page(self, file_id, offset, limit=5, timeout=5):
+        """
+        Fetch a file from the page the catalog says it is on.
+        Returns None if the page failed or the file is no longer on it.
+        """
+        import gevent
+
+        task = FetchFilesJob(file_id, self._api, limit, offset, timeout)
+        job = gevent.spawn(task)
+        gevent.joinall([job])
+        self.record_pages([task])
+
+        if not job.successful() or job.value is None:
+            return None
+        if not self.is_finished(job.value):
+            raise FileInvalidStatusError(
+                f"File {file_id} is not in {FileStatus.FINISHED} status.", job.value.get('processingStatus')
+            )
+        return job.value
+
+    def scan_file(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES, window=SCAN_WINDOW, pool_size=SCAN_POOL_SIZE):
+        """
+        Scan the paginated API for a file. We limit the calls to MAX_PAGES pages.
         The method will spawn a gevent green thread for each API call.
 
+        Pages are scanned outward in windows of SCAN_WINDOW pages (first N pages, then the next N)
+        through a pool of SCAN_POOL_SIZE green threads. As soon as a page returns the file in
+        FINISHED status the remaining green threads are killed, so the latency depends on where
+        the file sits in the catalog rather than on MAX_PAGES. A window <= 0 scans all pages at once.
+
         I am not sure if this is the optimal approach, but given the contraints
-        I think looking at 1000 records (default MAX_PAGES = 200) concurrently is a good start.
+        I think looking at 1000 records (default MAX_PAGES = 200) is a good start.
         We can change the no. of records by changing MAX_PAGES environment variable.
 
         TODO: What can be the maximum number of records I may have to check to find a file?
@@ -135,20 +255,38 @@ class GeventJobs(object):
         """
         # local import to avoid installing this package if we are employing another strategy.
         import gevent
-
-        jobs = [gevent.spawn(FetchFilesJob(file_id, self._api, limit, offset, timeout)) for offset in range(0, max_pages + 1)]
-        gevent.joinall(jobs)
-
+        from gevent.pool import Pool
+
+        offsets = list(range(0, max_pages + 1))
+        if window <= 0:
+            window = len(offsets)
+        pool = Pool(pool_size if pool_size > 0 else window)
+
+        tasks, jobs = [], []
+        the_file = None
+        for start in range(0, len(offsets), window):
+            window_tasks = [FetchFilesJob(file_id, self._api, limit, offset, timeout) for offset in offsets[start:start + window]]
+            window_jobs = [pool.spawn(task) for task in window_tasks]
+            tasks.extend(window_tasks)
+            jobs.extend(window_jobs)
+
+            for job in gevent.iwait(window_jobs):
+                if self.is_finished_filter(job):
+                    the_file = job.value
+                    FOUND_PAGE.observe(window_tasks[window_jobs.index(job)].offset + 1, source='scan')
+                    break
+            if the_file is not None:
+                pool.kill()
+                break
+        self.record_pages(tasks)
+
+        if the_file is not None:
+            return the_file
         if self.is_all_error(jobs):
             raise APIException("Could not fetch the file at the moment.")
         if self.is_file_not_found(jobs):
             raise FileNotFound(f"File {file_id} not found in {max_pages} pages.")
-
-        # I see multiple pages return same file data.
-        finished_files = self.get_data(jobs, filter_fn=self.is_finished_filter)
-        if len(finished_files) == 0:
-            raise FileInvalidStatusError(f"File {file_id} is not in {FileStatus.FINISHED} status.")
-        return finished_files[0]
+        raise FileInvalidStatusError(f"File {file_id} is not in {FileStatus.FINISHED} status.", self.unfinished_status(jobs))
 
     def fetch_file_details(self, file_id, timeout=5):
         """
@@ -175,3 +313,177 @@ class GeventJobs(object):
         if self.is_all_error([job]):
             raise APIException("Could not fetch file segments at the moment.")
         return self.get_data([job])[0]
+
+    def fetch_details_bundle(self, the_file, timeout=5):
+        """
+        Merge a file record we already have, e.g. from a push notification or a
+        catalog sweep, with its details and segments. No page scan is needed.
+        The two API calls are made concurrently.
+        """
+        import gevent
+
+        file_id = the_file['fileId']
+        details_job = gevent.spawn(self.fetch_file_details, file_id, timeout)
+        segments_job = gevent.spawn(self.fetch_file_segments, file_id, timeout)
+        gevent.joinall([details_job, segments_job])
+        for job in (details_job, segments_job):
+            if not job.successful():
+                raise job.exception
+
+        the_file = dict(the_file)
+        the_file.update(details_job.value)
+        the_file.update({'segments': segments_job.value})
+        return the_file
+
+    def close_stream(self, job):
+        if job is not None and job.successful() and isinstance(job.value, SegmentStream):
+            job.value.close()
+
+    def fetch_file_bundle(self, file_id, limit=5, timeout=5, max_pages=MAX_PAGES, segments=True, stream_segments=False):
+        """
+        Fetch a file merged with its details and segments.
+
+        The details and segments jobs are spawned speculatively at the same time as
+        the page scan, so on a cold miss the latency is that of the slowest call
+        rather than the sum of the three. Their results are thrown away (and the jobs
+        killed) if the scan ends in FileNotFound or a non FINISHED status.
+
+        @param segments: pass False to leave the segments out and skip their API call.
+        @param stream_segments: pass True to get large segments as a SegmentStream
+        to read, see api.streaming.
+        """
+        import gevent
+
+        details_job = gevent.spawn(FetchFileDetailsJob(file_id, self._api, timeout))
+        jobs = [details_job]
+        segments_job = None
+        if segments:
+            segments_job = gevent.spawn(FetchFileSegmentsJob(file_id, self._api, timeout, stream_segments))
+            jobs.append(segments_job)
+        try:
+            the_file = dict(self.fetch_file(file_id, limit, timeout, max_pages))
+        except Exception:
+            gevent.killall(jobs)
+            self.close_stream(segments_job)
+            raise
+
+        gevent.joinall(jobs)
+        if self.is_all_error([details_job]):
+            self.close_stream(segments_job)
+            raise APIException("Could not fetch the file details at the moment.")
+        if segments_job is not None and self.is_all_error([segments_job]):
+            raise APIException("Could not fetch file segments at the moment.")
+
+        the_file.update(self.get_data([details_job])[0])
+        if segments_job is not None:
+            the_file.update({'segments': self.get_data([segments_job])[0]})
+        return the_file
+
+    def scan_files(self, file_ids, offsets, limit=5, timeout=5, window=SCAN_WINDOW, pool_size=SCAN_POOL_SIZE):
+        """
+        Scan the given pages for many files at once, window by window like scan_file.
+        The scan stops as soon as every file was seen in FINISHED status.
+        Returns the page jobs, the files matched on a page are their values.
+        """
+        import gevent
+        from gevent.pool import Pool
+
+        pending = set(file_ids)
+        if window <= 0:
+            window = max(len(offsets), 1)
+        pool = Pool(pool_size if pool_size > 0 else window)
+
+        tasks, jobs = [], []
+        for start in range(0, len(offsets), window):
+            window_tasks = [FetchManyFilesJob(pending, self._api, limit, offset, timeout) for offset in offsets[start:start + window]]
+            window_jobs = [pool.spawn(task) for task in window_tasks]
+            tasks.extend(window_tasks)
+            jobs.extend(window_jobs)
+
+            for job in gevent.iwait(window_jobs):
+                if self.success_filter(job):
+                    pending -= set(r.get('fileId') for r in job.value if self.is_finished(r))
+                if not pending:
+                    break
+            if not pending:
+                pool.kill()
+                break
+        self.record_pages(tasks)
+        return jobs
+
+    def matches(self, jobs):
+        """
+        fileId -> list of the records of that file found by the page jobs.
+        """
+        seen = {}
+        for job in filter(self.success_filter, jobs):
+            for record in job.value:
+                seen.setdefault(record.get('fileId'), []).append(record)
+        return seen
+
+    def fetch_files(self, file_ids, limit=5, timeout=5, max_pages=MAX_PAGES):
+        """
+        Fetch many files via the paginated API with one shared page scan.
+
+        The pages the catalog knows are fetched first. The files that were not
+        on their catalog page are then looked for, all at once, in a single scan
+        of the remaining pages.
+
+        Returns a dict of fileId -> the FINISHED file, or the exception fetch_file
+        would have raised for it.
+        """
+        known = self._catalog.lookup_many(file_ids, limit)
+        known_offsets = sorted(set(known.values()))
+        jobs = self.scan_files(file_ids, known_offsets, limit, timeout) if known_offsets else []
+        seen = self.matches(jobs)
+
+        remaining = [f for f in file_ids if f not in seen]
+        if remaining:
+            offsets = [o for o in range(0, max_pages + 1) if o not in set(known_offsets)]
+            jobs += self.scan_files(remaining, offsets, limit, timeout)
+            seen = self.matches(jobs)
+
+        results = {}
+        for file_id in file_ids:
+            records = seen.get(file_id, [])
+            finished = [r for r in records if self.is_finished(r)]
+            if finished:
+                results[file_id] = dict(finished[0])
+            elif records:
+                results[file_id] = FileInvalidStatusError(
+                    f"File {file_id} is not in {FileStatus.FINISHED} status.",
+                    self.preferred_status(r.get('processingStatus') for r in records)
+                )
+            elif self.is_all_error(jobs):
+                results[file_id] = APIException("Could not fetch the file at the moment.")
+            else:
+                results[file_id] = FileNotFound(f"File {file_id} not found in {max_pages} pages.")
+        return results
+
+    def fetch_files_bundle(self, file_ids, limit=5, timeout=5, max_pages=MAX_PAGES, pool_size=SCAN_POOL_SIZE):
+        """
+        Fetch many files merged with their details and segments.
+        The details and segments of the FINISHED files are fetched concurrently
+        through a pool once the shared page scan is done.
+
+        Returns a dict of fileId -> the merged file or the exception for that file.
+        """
+        from gevent.pool import Pool
+
+        results = self.fetch_files(file_ids, limit, timeout, max_pages)
+        finished = [f for f, r in results.items() if not isinstance(r, Exception)]
+
+        pool = Pool(pool_size)
+        details_jobs = {f: pool.spawn(FetchFileDetailsJob(f, self._api, timeout)) for f in finished}
+        segments_jobs = {f: pool.spawn(FetchFileSegmentsJob(f, self._api, timeout)) for f in finished}
+        pool.join()
+
+        for file_id in finished:
+            if self.is_all_error([details_jobs[file_id]]):
+                results[file_id] = APIException("Could not fetch the file details at the moment.")
+            elif self.is_all_error([segments_jobs[file_id]]):
+                results[file_id] = APIException("Could not fetch file segments at the moment.")
+            else:
+                results[file_id].update(self.get_data([details_jobs[file_id]])[0])
+                results[file_id].update({'segments': self.get_data([segments_jobs[file_id]])[0]})
+        return results
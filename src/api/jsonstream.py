@@ -0,0 +1,61 @@
+import json
+import codecs
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]'
+# what the parser expects next.
+OPENING, FIRST_ITEM, ITEM, SEPARATOR, END = range(5)
+
+
+def iter_json_array(chunks, decoder=json.JSONDecoder()):
+    """
+    The items of a JSON array read from an iterable of byte chunks, parsed as the
+    chunks arrive, so that only the item being read is buffered and not the array.
+    Raises ValueError if the bytes are not a JSON array.
+    """
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, state, last = '', OPENING, False
+    while not last:
+        chunk = next(chunks, None)
+        last = chunk is None
+        buffer += text.decode(chunk or b'', final=last)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state == END:
+                raise ValueError(f"Extra data after the JSON array at {buffer[position:position + 20]!r}.")
+            elif state == OPENING:
+                if char != '[':
+                    raise ValueError("Expected a JSON array.")
+                state = FIRST_ITEM
+                position += 1
+            elif char == ']' and state in (FIRST_ITEM, SEPARATOR):
+                state = END
+                position += 1
+            elif state == SEPARATOR:
+                if char != ',':
+                    raise ValueError(f"Expected ',' or ']' at {buffer[position:position + 20]!r}.")
+                state = ITEM
+                position += 1
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if last:
+                        raise
+                    # the item goes on in the next chunk.
+                    break
+                if not last and (end == len(buffer) or buffer[end] not in DELIMITERS):
+                    # so may a number, e.g. 2. of 2.5.
+                    break
+                yield item
+                state = SEPARATOR
+                position = end
+        buffer = buffer[position:]
+    if state != END:
+        raise ValueError("The JSON array is not closed.")
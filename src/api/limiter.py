@@ -0,0 +1,194 @@
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import requests
+
+from api.exceptions import LimiterTimeout
+from api.metrics import METRICS
+from api.resilience import is_retryable
+
+LOGGER = logging.getLogger(__name__)
+# calls to the processing API a worker may have in flight at first. The window then adapts to the latency and errors.
+UPSTREAM_LIMIT_INITIAL = int(os.environ.get('UPSTREAM_LIMIT_INITIAL', 20))
+UPSTREAM_LIMIT_MIN = int(os.environ.get('UPSTREAM_LIMIT_MIN', 2))
+UPSTREAM_LIMIT_MAX = int(os.environ.get('UPSTREAM_LIMIT_MAX', 50))
+# a call slower than this multiple of the fastest recent call to the same endpoint is a sign of congestion.
+UPSTREAM_LATENCY_TOLERANCE = float(os.environ.get('UPSTREAM_LATENCY_TOLERANCE', 2.0))
+# the window is multiplied by this on congestion.
+UPSTREAM_LIMIT_BACKOFF = float(os.environ.get('UPSTREAM_LIMIT_BACKOFF', 0.7))
+LIMIT = METRICS.gauge('upstream_limit', "Calls to the processing API a worker may have in flight.")
+QUEUED = METRICS.gauge('upstream_queued', "Calls to the processing API waiting for the limiter.")
+QUEUE_WAIT = METRICS.histogram('upstream_queue_wait_seconds', "Time calls to the processing API waited for the limiter.")
+
+
+def is_congestion(error):
+    """
+    Errors that tell us the processing API is overloaded: connection errors, timeouts, 5xx and 429 responses.
+    """
+    from gevent import Timeout
+
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, Timeout) or is_retryable(error)
+
+
+class AdaptiveLimiter(object):
+    """
+    Caps the calls a worker has in flight to the processing API with a window that adapts (AIMD).
+
+    Every call that completes in time grows the window by 1/window, i.e. by one per window of calls.
+    A call that fails with a congestion error, or that is slower than UPSTREAM_LATENCY_TOLERANCE
+    times the fastest of the recent calls to its endpoint, shrinks it by UPSTREAM_LIMIT_BACKOFF.
+    Endpoints have baselines of their own, a segments call is not slow for being slower than a details call. Calls that started
+    before the last decrease do not shrink it again, so one burst of slow calls counts once.
+
+    Calls over the window wait in per flow FIFO queues that are served round robin.
+    A flow is a caller, e.g. the adapter of a request, so the page scan of one request
+    cannot starve the details and segments calls of another.
+
+    The limiter is cooperative, it is meant to be used from the green threads of a worker.
+    """
+    def __init__(self, initial=UPSTREAM_LIMIT_INITIAL, min_limit=UPSTREAM_LIMIT_MIN, max_limit=UPSTREAM_LIMIT_MAX,
+                 tolerance=UPSTREAM_LATENCY_TOLERANCE, backoff=UPSTREAM_LIMIT_BACKOFF, samples=100,
+                 clock=time.monotonic):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._clock = clock
+        self._samples = samples
+        # endpoint -> latencies of the recent calls that completed in time.
+        self._latencies = {}
+        # flow -> deque of waiting events, in round robin order.
+        self._queues = OrderedDict()
+        self._decreased_at = None
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        LIMIT.set(int(self.limit))
+
+    def queued(self):
+        return sum(len(waiters) for waiters in self._queues.values())
+
+    def _has_room(self):
+        return self.in_flight < int(self.limit)
+
+    def _grant(self):
+        while self._queues and self._has_room():
+            flow, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            # the flow goes to the back of the line.
+            del self._queues[flow]
+            if waiters:
+                self._queues[flow] = waiters
+            self.in_flight += 1
+            waiter.set()
+        QUEUED.set(self.queued())
+
+    def _dequeue(self, flow, waiter):
+        waiters = self._queues.get(flow)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._queues[flow]
+        QUEUED.set(self.queued())
+
+    def acquire(self, flow):
+        """
+        Block the green thread until the call of flow may be sent.
+        A deadline that runs out while the call waits raises LimiterTimeout, the call was never sent.
+        """
+        from gevent import Timeout
+        from gevent.event import Event
+
+        if not self._queues and self._has_room():
+            self.in_flight += 1
+            QUEUE_WAIT.observe(0)
+            return
+        waiter = Event()
+        self._queues.setdefault(flow, deque()).append(waiter)
+        QUEUED.set(self.queued())
+        start_time = self._clock()
+        try:
+            waiter.wait()
+        except BaseException as e:
+            # timed out or killed while waiting, hand a slot we were just granted to the next one.
+            if waiter.is_set():
+                self.in_flight -= 1
+                self._grant()
+            else:
+                self._dequeue(flow, waiter)
+            if isinstance(e, Timeout):
+                raise LimiterTimeout(f"Timed out after {self._clock() - start_time:.3f}s waiting for the limiter.") from e
+            raise
+        QUEUE_WAIT.observe(self._clock() - start_time)
+
+    def release(self, started_at, latency, ok, endpoint=None):
+        """
+        @param ok: whether the call completed without congestion, None if it tells us nothing, e.g. it was killed.
+        @param endpoint: the endpoint the latency is compared with the recent calls of.
+        """
+        self.in_flight -= 1
+        if ok is not None:
+            self._adjust(started_at, latency, ok, endpoint)
+        self._grant()
+
+    def _window(self, endpoint):
+        if endpoint not in self._latencies:
+            self._latencies[endpoint] = deque(maxlen=self._samples)
+        return self._latencies[endpoint]
+
+    def _adjust(self, started_at, latency, ok, endpoint):
+        latencies = self._window(endpoint)
+        baseline = min(latencies) if latencies else None
+        if ok:
+            latencies.append(latency)
+        slow = baseline is not None and latency > self.tolerance * baseline
+        if ok and not slow:
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+            self.increases += 1
+        elif self._decreased_at is None or started_at > self._decreased_at:
+            self.limit = max(self.limit * self.backoff, self.min_limit)
+            self._decreased_at = self._clock()
+            self.decreases += 1
+            LOGGER.info(f"Processing API congested ({'slow' if ok else 'error'}). Limiting calls to {int(self.limit)}.")
+        LIMIT.set(int(self.limit))
+
+    @contextmanager
+    def slot(self, flow, endpoint=None):
+        """
+        Hold a slot of the window for the duration of a call.
+        @param endpoint: what the call is, its latency is only compared with the calls of the same endpoint.
+        """
+        from gevent import GreenletExit
+
+        self.acquire(flow)
+        started_at = self._clock()
+        ok = True
+        try:
+            yield
+        except GreenletExit:
+            ok = None
+            raise
+        except BaseException as e:
+            ok = not is_congestion(e)
+            raise
+        finally:
+            self.release(started_at, self._clock() - started_at, ok, endpoint)
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': self.queued(),
+            'flows': len(self._queues),
+            'increases': self.increases,
+            'decreases': self.decreases,
+        }
+
+
+UPSTREAM_LIMITER = AdaptiveLimiter()
@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+# directory the workers of a host write their metrics to. Give every container its own.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'snackable_metrics'))
+# seconds between two writes of the metrics of a worker to METRICS_DIR.
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# file the counters and histograms of the workers that exited are added up in.
+DEAD_WORKERS_FILE = 'dead.json'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._registry = registry
+        # label values -> value
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}, got {', '.join(labels)}.")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self._registry.lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = COUNTER
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauges of the live workers are summed, e.g. the requests in flight of a host.
+    A gauge can also be computed when it is collected, see set_function().
+    """
+    kind = GAUGE
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """
+        Compute the value of an unlabelled gauge with function whenever it is collected.
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        try:
+            return [[[], self._function()]]
+        except Exception as e:
+            LOGGER.warning(f"Could not compute gauge {self.name}. {str(e)}.")
+            return []
+
+
+class Histogram(Metric):
+    kind = HISTOGRAM
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per bucket (not cumulative) counts, the last one is +Inf.
+                entry = self._values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+
+class MetricsRegistry(object):
+    """
+    In-process counters, gauges and histograms, exposed in the Prometheus text format.
+
+    Every gunicorn worker keeps its own metrics and writes them to a file of its
+    own in METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds. A scrape,
+    whichever worker serves it, reads the files of all workers and adds them up.
+    Counters and histograms of workers that exited are kept so that totals never
+    go down, gauges only count for live workers. The gunicorn master folds the
+    file of an exited worker into DEAD_WORKERS_FILE, and empties the directory
+    when it starts, see gunicorn.conf.py.
+    """
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL, clock=time.monotonic):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self._clock = clock
+        self._metrics = {}
+        self._flushed_at = None
+        self._pid = None
+        self._path = None
+
+    def _get_or_create(self, cls, name, help, labels=(), **kwargs):
+        with self.lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered as a different {metric.kind}.")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self._metrics.values())
+        return {
+            m.name: {
+                'kind': m.kind,
+                'help': m.help,
+                'labels': list(m.labels),
+                'buckets': list(getattr(m, 'buckets', [])),
+                'samples': m.samples(),
+            } for m in metrics
+        }
+
+    def _file_path(self):
+        # a forked worker writes a file of its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f"{self._pid}-{uuid.uuid4().hex[:8]}.json")
+        return self._path
+
+    def flush(self):
+        """
+        Write the metrics of this process to its file in METRICS_DIR.
+        """
+        path = self._file_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({'pid': self._pid, 'metrics': self.snapshot()}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            LOGGER.warning(f"Could not write metrics to {path}. {str(e)}.")
+        self._flushed_at = self._clock()
+
+    def maybe_flush(self):
+        if self._flushed_at is None or self._clock() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def _file_names(self):
+        try:
+            return [n for n in os.listdir(self.directory) if n.endswith('.json')]
+        except OSError:
+            return []
+
+    def _read_file(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # the file of a worker that exited was folded meanwhile.
+            return None
+        except (OSError, ValueError) as e:
+            LOGGER.warning(f"Could not read metrics file {name}. {str(e)}.")
+            return None
+
+    def _read_files(self):
+        documents = [self._read_file(name) for name in self._file_names()]
+        return [document for document in documents if document is not None]
+
+    def mark_process_dead(self, pid):
+        """
+        Fold the counters and histograms of an exited worker into DEAD_WORKERS_FILE
+        and remove its file, so that its gauges go and a worker that gets its pid
+        does not count them. Called by the gunicorn master only.
+        """
+        names = [n for n in self._file_names() if n.startswith(f"{pid}-")]
+        if not names:
+            return
+        merged = {}
+        dead = self._read_file(DEAD_WORKERS_FILE)
+        if dead is not None:
+            add_up(merged, dead.get('metrics', {}))
+        for name in names:
+            document = self._read_file(name)
+            if document is not None:
+                add_up(merged, document.get('metrics', {}), gauges=False)
+        metrics = {
+            name: dict(metric, samples=[[list(key), value] for key, value in metric['samples'].items()])
+            for name, metric in merged.items()
+        }
+        path = os.path.join(self.directory, DEAD_WORKERS_FILE)
+        try:
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump({'pid': None, 'metrics': metrics}, f)
+            os.replace(f"{path}.tmp", path)
+            for name in names:
+                os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            LOGGER.warning(f"Could not fold the metrics of worker {pid}. {str(e)}.")
+
+    def clear(self):
+        """
+        Remove the files of all workers, e.g. those of a previous run of the server.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                LOGGER.warning(f"Could not remove metrics file {name}. {str(e)}.")
+
+    def collect(self):
+        """
+        Add up the metrics of every worker that wrote to METRICS_DIR.
+        Returns a dict of name -> metric with samples as a dict of label values -> value.
+        """
+        self.flush()
+        merged = {}
+        for document in self._read_files():
+            add_up(merged, document.get('metrics', {}), gauges=is_alive(document.get('pid')))
+        return merged
+
+    def render(self):
+        """
+        The metrics of all workers in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for key, value in sorted(metric['samples'].items()):
+                labels = list(zip(metric['labels'], key))
+                if metric['kind'] != HISTOGRAM:
+                    lines.append(f"{name}{format_labels(labels)} {float(value)}")
+                    continue
+                cumulative = 0
+                bounds = [str(float(b)) for b in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value['buckets']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + [('le', bound)])} {float(cumulative)}")
+                lines.append(f"{name}_sum{format_labels(labels)} {float(value['sum'])}")
+                lines.append(f"{name}_count{format_labels(labels)} {float(value['count'])}")
+        return '\n'.join(lines) + '\n'
+
+
+def add_up(merged, metrics, gauges=True):
+    """
+    Add the metrics of a worker file to merged, a dict of name -> metric with
+    samples as a dict of label values -> value.
+    @param gauges: False to leave the gauges out, e.g. those of a worker that exited.
+    """
+    for name, metric in metrics.items():
+        if metric['kind'] == GAUGE and not gauges:
+            continue
+        target = merged.setdefault(name, dict(metric, samples={}))
+        for key, value in metric['samples']:
+            key = tuple(key)
+            current = target['samples'].get(key)
+            if metric['kind'] != HISTOGRAM:
+                target['samples'][key] = (current or 0) + value
+            elif current is None:
+                target['samples'][key] = {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+            else:
+                current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                current['sum'] += value['sum']
+                current['count'] += value['count']
+
+
+def is_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        (name, value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+METRICS = MetricsRegistry()
+STAGE_LATENCY = METRICS.histogram(
+    'presentation_stage_seconds', "Latency of the stages of serving a file.", ['stage']
+)
+FOUND_PAGE = METRICS.histogram(
+    'presentation_found_page', "Page of the paginated API a file was found on.", ['source'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200)
+)
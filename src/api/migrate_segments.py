@@ -0,0 +1,87 @@
+import os
+import logging
+import argparse
+
+from bson import BSON
+
+from api.columnar import pack_segments
+from api.models import FileModel
+from api.storage import SEGMENTS_LIST, SEGMENTS_PACKED, drop_overflow, pack_file, unpack_file
+
+LOGGER = logging.getLogger(__name__)
+
+
+def needs_migration(son, segments_format):
+    if segments_format == SEGMENTS_LIST:
+        return 'segmentsPacked' in son
+    # segments that cannot be packed stay a list.
+    return isinstance(son.get('segments'), list) and pack_segments(son['_id'], son['segments']) is not None
+
+
+def migrate(segments_format, model=FileModel, batch_size=100, dry_run=False, max_bytes=None):
+    """
+    Rewrite the stored files kept in the other segments format in the given one.
+
+    The ETag, rendered body and fetchedAt of a file are kept as they are, so its
+    responses do not change. A file saved again while it is migrated, e.g. by a
+    refresh, is left as that save stored it.
+
+    Returns a dict of the files migrated and skipped, and their BSON bytes before and after.
+    """
+    collection = model._mongometa.collection
+    if segments_format == SEGMENTS_PACKED:
+        query = {'segments': {'$type': 'array'}}
+    else:
+        query = {'segmentsPacked': {'$exists': True}}
+    report = {'migrated': 0, 'skipped': 0, 'bytesBefore': 0, 'bytesAfter': 0}
+
+    for stored in collection.find(query, batch_size=batch_size):
+        if not needs_migration(stored, segments_format):
+            report['skipped'] += 1
+            continue
+        before = len(BSON.encode(stored))
+        son = unpack_file(dict(stored), model)
+        if dry_run:
+            # nothing is moved to GridFS either.
+            son = pack_file(son, model, segments_format, max_bytes=0)
+            report['migrated'] += 1
+            report['bytesBefore'] += before
+            report['bytesAfter'] += len(BSON.encode(son))
+            continue
+
+        son = pack_file(son, model, segments_format, max_bytes)
+        result = collection.replace_one(
+            {'_id': stored['_id'], 'etag': stored.get('etag'), 'fetchedAt': stored.get('fetchedAt')}, son
+        )
+        if result.matched_count:
+            drop_overflow(stored, son, model)
+            report['migrated'] += 1
+            report['bytesBefore'] += before
+            report['bytesAfter'] += len(BSON.encode(son))
+        else:
+            # saved again meanwhile, what this rewrite moved to GridFS is not referred to.
+            drop_overflow(son, stored, model)
+            report['skipped'] += 1
+        if (report['migrated'] + report['skipped']) % batch_size == 0:
+            LOGGER.info(f"Migrated {report['migrated']} files to {segments_format} segments so far.")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite the stored files in a segments format.")
+    parser.add_argument('--to', choices=(SEGMENTS_PACKED, SEGMENTS_LIST), required=True)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--dry-run', action='store_true', help="report the bytes saved without writing.")
+    args = parser.parse_args()
+
+    from pymodm import connect
+
+    from core.logging_setup import setup_logging
+    setup_logging()
+    connect(os.environ.get('DB_CONNECTION_STRING'))
+    report = migrate(args.to, batch_size=args.batch_size, dry_run=args.dry_run)
+    LOGGER.info(f"Segments migration to {args.to} done. {report}.")
+
+
+if __name__ == '__main__':
+    main()
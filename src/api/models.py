@@ -1,4 +1,5 @@
 from pymodm import fields, MongoModel
+from pymongo import ASCENDING, DESCENDING, IndexModel
 
 
 class FileModel(MongoModel):
@@ -10,3 +11,130 @@ class FileModel(MongoModel):
     originalFilePath = fields.URLField(required=False)
     seriesTitle = fields.CharField(required=False)
     segments = fields.ListField(field=fields.DictField(), required=False)
+    etag = fields.CharField(required=False)
+    # the presentation JSON body, see api.storage.render_file.
+    rendered = fields.BinaryField(required=False)
+    # when the file was last fetched from the processing API, see api.refresh.
+    fetchedAt = fields.DateTimeField(required=False)
+    # segments stored as columns instead of segments, see api.storage.pack_file.
+    segmentsPacked = fields.DictField(required=False)
+    # GridFS id of the rendered body of a document too large to hold it.
+    renderedFile = fields.ObjectIdField(required=False)
+
+
+class CatalogEntryModel(MongoModel):
+    """
+    Index of where a file was last seen on the paginated processing API.
+    """
+    fileId = fields.CharField(primary_key=True, required=True)
+    offset = fields.IntegerField(required=True)
+    limit = fields.IntegerField(required=True)
+    processingStatus = fields.CharField(required=True)
+    updatedAt = fields.DateTimeField(required=True)
+
+    class Meta:
+        final = True
+
+
+class FetchLeaseModel(MongoModel):
+    """
+    Short-lived lease held by the worker fetching a file from the processing API.
+    """
+    fileId = fields.CharField(primary_key=True, required=True)
+    token = fields.CharField(required=True)
+    expiresAt = fields.DateTimeField(required=True)
+
+    class Meta:
+        final = True
+
+
+class NegativeCacheModel(MongoModel):
+    """
+    A recent NotFound/PROCESSING/FAILED outcome of fetching a file.
+    MongoDB drops the document once it expires.
+    """
+    fileId = fields.CharField(primary_key=True, required=True)
+    status = fields.CharField(required=True)
+    error = fields.CharField(required=True)
+    expiresAt = fields.DateTimeField(required=True)
+
+    class Meta:
+        final = True
+        indexes = [IndexModel([('expiresAt', ASCENDING)], expireAfterSeconds=0)]
+
+
+class SegmentModel(MongoModel):
+    """
+    A segment of a file, stored on its own so that a time window
+    of a long file can be read without loading the whole transcript.
+    """
+    fileId = fields.CharField(required=True)
+    fileSegmentId = fields.IntegerField(required=True)
+    segmentText = fields.CharField(required=False, blank=True)
+    startTime = fields.IntegerField(required=True)
+    endTime = fields.IntegerField(required=True)
+    # the streamed write of the file the segment was last written by, see SegmentStore.prune_generation().
+    generation = fields.ObjectIdField(required=False)
+
+    class Meta:
+        final = True
+        indexes = [
+            IndexModel([('fileId', ASCENDING), ('startTime', ASCENDING), ('fileSegmentId', ASCENDING)]),
+            IndexModel([('fileId', ASCENDING), ('fileSegmentId', ASCENDING)], unique=True),
+        ]
+
+
+class SearchPostingModel(MongoModel):
+    """
+    Inverted index posting of a term in a segment of a file.
+    """
+    term = fields.CharField(required=True)
+    fileId = fields.CharField(required=True)
+    fileSegmentId = fields.IntegerField(required=True)
+    startTime = fields.IntegerField(required=True)
+    endTime = fields.IntegerField(required=True)
+    tf = fields.IntegerField(required=True)
+    positions = fields.ListField(field=fields.IntegerField(), required=False)
+
+    class Meta:
+        final = True
+        indexes = [
+            IndexModel([('term', ASCENDING), ('tf', DESCENDING)]),
+            IndexModel([('fileId', ASCENDING)]),
+        ]
+
+
+class IngestionJobModel(MongoModel):
+    """
+    A queued job to pre-materialize a file the processing API told us has finished.
+    """
+    fileId = fields.CharField(primary_key=True, required=True)
+    state = fields.CharField(required=True)
+    attempts = fields.IntegerField(required=True)
+    runAt = fields.DateTimeField(required=True)
+    token = fields.CharField(required=False)
+    lockedUntil = fields.DateTimeField(required=False)
+    lastError = fields.CharField(required=False)
+    updatedAt = fields.DateTimeField(required=True)
+
+    class Meta:
+        final = True
+        indexes = [IndexModel([('state', ASCENDING), ('runAt', ASCENDING)])]
+
+
+class WarmerReportModel(MongoModel):
+    """
+    Report of the last catalog sweep of the cache warmer.
+    """
+    name = fields.CharField(primary_key=True, required=True)
+    finished = fields.IntegerField(required=True)
+    stored = fields.IntegerField(required=True)
+    fetched = fields.IntegerField(required=True)
+    failed = fields.IntegerField(required=True)
+    pageErrors = fields.IntegerField(required=True)
+    coverage = fields.FloatField(required=True)
+    startedAt = fields.DateTimeField(required=True)
+    finishedAt = fields.DateTimeField(required=True)
+
+    class Meta:
+        final = True
@@ -0,0 +1,101 @@
+import os
+import logging
+import datetime
+
+from pymongo.errors import PyMongoError
+
+from api.exceptions import FileInvalidStatusError, FileNotFound
+from api.models import NegativeCacheModel
+from api.utils import FileStatus
+
+LOGGER = logging.getLogger(__name__)
+NEGATIVE_TTL_NOT_FOUND = int(os.environ.get('NEGATIVE_TTL_NOT_FOUND', 60))
+NEGATIVE_TTL_PROCESSING = int(os.environ.get('NEGATIVE_TTL_PROCESSING', 10))
+NEGATIVE_TTL_FAILED = int(os.environ.get('NEGATIVE_TTL_FAILED', 300))
+
+
+class NegativeCache(object):
+    """
+    Remembers that a file was not found, or was not FINISHED, for a short while
+    so that repeat requests get the same 404/400 without touching the processing API.
+    Each outcome has its own TTL. Transient API errors are never cached.
+    """
+    NOT_FOUND = 'NOT_FOUND'
+
+    def __init__(self, model=NegativeCacheModel, ttls=None):
+        self.model = model
+        self.ttls = ttls or {
+            self.NOT_FOUND: NEGATIVE_TTL_NOT_FOUND,
+            FileStatus.PROCESSING: NEGATIVE_TTL_PROCESSING,
+            FileStatus.FAILED: NEGATIVE_TTL_FAILED,
+        }
+        self.hits = 0
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def status_of(self, error):
+        if isinstance(error, FileNotFound):
+            return self.NOT_FOUND
+        return error.status or FileStatus.PROCESSING
+
+    def record(self, file_id, error):
+        status = self.status_of(error)
+        ttl = self.ttls.get(status, 0)
+        if ttl <= 0:
+            return
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        try:
+            self._collection.replace_one(
+                {'_id': file_id},
+                {'status': status, 'error': str(error), 'expiresAt': expires_at},
+                upsert=True
+            )
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not record negative cache entry of {file_id}. {str(e)}.")
+
+    def _error(self, entry):
+        if entry['status'] == self.NOT_FOUND:
+            return FileNotFound(entry['error'])
+        return FileInvalidStatusError(entry['error'], entry['status'])
+
+    def check(self, file_id):
+        """
+        Raise the cached FileNotFound/FileInvalidStatusError of a file, if any.
+        The TTL index only sweeps once a minute, so the expiry is checked here too.
+        """
+        try:
+            entry = self._collection.find_one({'_id': file_id, 'expiresAt': {'$gt': datetime.datetime.utcnow()}})
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not check negative cache of {file_id}. {str(e)}.")
+            return
+        if entry is None:
+            return
+
+        self.hits += 1
+        LOGGER.info(f"File {file_id} found in negative cache with status {entry['status']}.")
+        raise self._error(entry)
+
+    def check_many(self, file_ids):
+        """
+        Return a dict of fileId -> cached error for the files of a batch in the negative cache.
+        """
+        try:
+            entries = list(self._collection.find({
+                '_id': {'$in': list(file_ids)}, 'expiresAt': {'$gt': datetime.datetime.utcnow()}
+            }))
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not check negative cache of {len(file_ids)} files. {str(e)}.")
+            return {}
+        self.hits += len(entries)
+        return {entry['_id']: self._error(entry) for entry in entries}
+
+    def invalidate(self, file_id):
+        try:
+            self._collection.delete_one({'_id': file_id})
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not invalidate negative cache entry of {file_id}. {str(e)}.")
+
+
+NEGATIVE_CACHE = NegativeCache()
@@ -0,0 +1,174 @@
+import os
+import asyncio
+import logging
+import datetime
+
+from api.coalesce import FetchLease
+from api.jobs import GeventJobs
+from api.metrics import METRICS
+from api.models import FileModel
+from api.storage import index_segments, save_file
+
+LOGGER = logging.getLogger(__name__)
+# seconds after which a stored file is served as it is and refreshed in the background.
+FILE_SOFT_TTL = int(os.environ.get('FILE_SOFT_TTL', 3600))
+# seconds after which a stored file is refetched before it is served. 0 never expires a file.
+FILE_HARD_TTL = int(os.environ.get('FILE_HARD_TTL', 7 * 24 * 3600))
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+REFRESHES = METRICS.counter('file_refreshes_total', "Background refreshes of stale stored files.", ['outcome'])
+
+
+def freshness(fetched_at, now=None, soft_ttl=FILE_SOFT_TTL, hard_ttl=FILE_HARD_TTL):
+    """
+    FRESH, STALE or EXPIRED for a file fetched from the processing API at fetched_at.
+    Files stored before fetchedAt was are STALE, so they get refreshed without a slow request.
+    """
+    if fetched_at is None:
+        return STALE
+    age = ((now or datetime.datetime.utcnow()) - fetched_at).total_seconds()
+    if hard_ttl > 0 and age >= hard_ttl:
+        return EXPIRED
+    if soft_ttl > 0 and age >= soft_ttl:
+        return STALE
+    return FRESH
+
+
+def unexpired(file_id, now=None, hard_ttl=FILE_HARD_TTL):
+    """
+    Query of a stored file that has not expired.
+    """
+    query = {'_id': file_id}
+    if hard_ttl > 0:
+        cutoff = (now or datetime.datetime.utcnow()) - datetime.timedelta(seconds=hard_ttl)
+        query['fetchedAt'] = {'$not': {'$lte': cutoff}}
+    return query
+
+
+class FileRefresher(object):
+    """
+    Stale-while-revalidate of stored files.
+
+    A stale file is served as it is while a green thread refetches its details
+    and segments and replaces the stored document, see save_file(). A file is
+    refreshed once at a time, inside a worker by the set of files being
+    refreshed and across workers by the fetch lease of the file. A failed
+    refresh keeps the stored copy, the next stale hit tries again.
+    """
+    def __init__(self, strategy_factory=GeventJobs, lease=None):
+        self._strategy_factory = strategy_factory
+        self._lease = lease or FetchLease()
+        self._refreshing = set()
+        self.refreshed = 0
+        self.failed = 0
+
+    def refresh_async(self, file_id, model=FileModel):
+        import gevent
+
+        if file_id in self._refreshing:
+            return None
+        self._refreshing.add(file_id)
+        return gevent.spawn(self._run, file_id, model)
+
+    def _run(self, file_id, model):
+        try:
+            self.refresh(file_id, model)
+        finally:
+            self._refreshing.discard(file_id)
+
+    def stale_record(self, file_id, model):
+        """
+        The page record of a stored file to refetch the rest of, None if it is no longer stored or stale.
+        """
+        son = model._mongometa.collection.find_one({'_id': file_id}, projection={'processingStatus': 1, 'fetchedAt': 1})
+        if son is None or freshness(son.get('fetchedAt')) == FRESH:
+            return None
+        return {'fileId': file_id, 'processingStatus': son['processingStatus']}
+
+    def _done(self, outcome, file_id, error=None):
+        REFRESHES.inc(outcome=outcome)
+        if outcome == 'refreshed':
+            self.refreshed += 1
+            LOGGER.info(f"Refreshed stale file {file_id}.")
+        elif outcome == 'failed':
+            self.failed += 1
+            LOGGER.warning(f"Could not refresh stale file {file_id}. {str(error)}.")
+
+    def refresh(self, file_id, model=FileModel):
+        """
+        Refetch the details and segments of a stale file and store them. Returns True if it was refreshed.
+        """
+        token = self._lease.acquire(file_id)
+        if token is None:
+            # another worker is fetching it.
+            self._done('skipped', file_id)
+            return False
+        try:
+            the_file = self.stale_record(file_id, model)
+            if the_file is None:
+                self._done('skipped', file_id)
+                return False
+            save_file(self._strategy_factory().fetch_details_bundle(the_file), model)
+        except Exception as e:
+            self._done('failed', file_id, e)
+            return False
+        finally:
+            self._lease.release(file_id, token)
+        self._done('refreshed', file_id)
+        return True
+
+    def stats(self):
+        return {'refreshing': len(self._refreshing), 'refreshed': self.refreshed, 'failed': self.failed}
+
+
+class AsyncFileRefresher(FileRefresher):
+    """
+    FileRefresher for the asyncio strategy. The refresh runs as an asyncio task,
+    the strategy's fetch_details_bundle is a coroutine and storage is read and
+    written with pymongo in the default executor.
+    """
+    def __init__(self, strategy_factory, lease=None):
+        super().__init__(strategy_factory, lease)
+        # keeps the tasks referenced until they are done.
+        self._tasks = set()
+
+    def refresh_async(self, file_id, model=FileModel):
+        if file_id in self._refreshing:
+            return None
+        self._refreshing.add(file_id)
+        task = asyncio.ensure_future(self._run(file_id, model))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, file_id, model):
+        try:
+            await self.refresh(file_id, model)
+        finally:
+            self._refreshing.discard(file_id)
+
+    async def refresh(self, file_id, model=FileModel):
+        loop = asyncio.get_event_loop()
+        token = await loop.run_in_executor(None, self._lease.acquire, file_id)
+        if token is None:
+            self._done('skipped', file_id)
+            return False
+        try:
+            the_file = await loop.run_in_executor(None, self.stale_record, file_id, model)
+            if the_file is None:
+                self._done('skipped', file_id)
+                return False
+            the_file = await self._strategy_factory().fetch_details_bundle(the_file)
+            await loop.run_in_executor(None, save_file, the_file, model, False)
+            loop.run_in_executor(None, index_segments, file_id, the_file.get('segments'))
+        except Exception as e:
+            self._done('failed', file_id, e)
+            return False
+        finally:
+            await loop.run_in_executor(None, self._lease.release, file_id, token)
+        self._done('refreshed', file_id)
+        return True
+
+
+REFRESHER = FileRefresher()
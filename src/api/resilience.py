@@ -0,0 +1,368 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import requests
+
+from api.exceptions import CircuitOpenError, LimiterTimeout
+from api.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+# retries of a failed idempotent call (connection errors, timeouts and 5xx), with jittered exponential backoff.
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.05))
+HTTP_RETRY_BACKOFF_MAX = float(os.environ.get('HTTP_RETRY_BACKOFF_MAX', 1))
+# a duplicate call is sent once a call is slower than this percentile of the recent calls. 0 disables hedging.
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.02))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+# hedged calls allowed per call, i.e. at most 10% extra load on the processing API.
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.1))
+# the circuit opens when this share of the calls of the last CIRCUIT_WINDOW seconds failed.
+CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 20))
+CIRCUIT_WINDOW = float(os.environ.get('CIRCUIT_WINDOW', 10))
+# seconds an open circuit fails fast before a probe call is let through.
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN', 5))
+HEDGES = METRICS.counter('upstream_hedges_total', "Hedged duplicate calls to the processing API.", ['endpoint'])
+RETRIES = METRICS.counter('upstream_retries_total', "Retried calls to the processing API.", ['endpoint'])
+CIRCUIT_OPEN = METRICS.gauge('upstream_circuit_open', "Whether the circuit of a processing API endpoint is open.", ['endpoint'])
+
+
+class LatencyWindow(object):
+    """
+    The latencies of the last size successful calls of an endpoint.
+    """
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(int(p / 100.0 * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls to an endpoint fast while it is failing.
+
+    Closed: calls go through and their outcomes of the last window seconds are kept.
+    Once at least min_calls were made and failure_rate of them failed, the circuit opens.
+    Open: calls fail with CircuitOpenError for cooldown seconds.
+    Half open: one probe call goes through. Its success closes the circuit, its failure opens it again.
+    A probe that tells nothing of the endpoint, e.g. a 404, is released for another one to go through.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=CIRCUIT_FAILURE_RATE, min_calls=CIRCUIT_MIN_CALLS, window=CIRCUIT_WINDOW,
+                 cooldown=CIRCUIT_COOLDOWN, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.state = self.CLOSED
+        # (time, ok) of the calls of the window.
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._probe_started_at = None
+
+    def _close(self):
+        self.state = self.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
+        self._probe_started_at = None
+
+    def allow(self):
+        with self._lock:
+            now = self._clock()
+            if self.state == self.OPEN:
+                if now - self._opened_at < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                # a probe that never reported back, e.g. it was killed, does not block the circuit forever.
+                if self._probe_started_at is not None and now - self._probe_started_at < self.cooldown:
+                    return False
+                self._probe_started_at = now
+            return True
+
+    def release(self):
+        """
+        Let the probe in flight go without an outcome.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_started_at = None
+
+    def record(self, ok):
+        with self._lock:
+            now = self._clock()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            self._trim(now)
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= self.failure_rate * calls:
+                LOGGER.warning(f"{self._failures} of {calls} calls failed in {self.window}s. Opening the circuit.")
+                self._open(now)
+
+
+def close_response(attempt):
+    """
+    Close the response of a hedged attempt that lost, a streamed one holds its connection until then.
+    """
+    close = getattr(attempt.value, 'close', None)
+    if close is not None:
+        close()
+
+
+def is_retryable(error):
+    """
+    Connection errors, timeouts and 5xx responses are worth another try, 4xx responses are not.
+    Errors of requests and, under the asyncio strategy, of aiohttp are classified alike.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, asyncio.TimeoutError)):
+        return True
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, aiohttp.ClientConnectionError)
+
+
+class UpstreamPolicy(object):
+    """
+    Tail latency and failure controls of the calls to the processing API, per endpoint.
+
+    - A call slower than HEDGE_PERCENTILE of the recent calls gets a duplicate,
+      within a budget of HEDGE_BUDGET duplicates per call. The first success wins,
+      the responses of the others are closed.
+    - A failed call is retried HTTP_RETRIES times with jittered exponential backoff.
+    - A circuit breaker fails calls fast while the endpoint is failing.
+
+    Shared by every adapter instance of a worker process, like the HTTP session.
+    """
+    def __init__(self, retries=HTTP_RETRIES, backoff_base=HTTP_RETRY_BACKOFF, backoff_max=HTTP_RETRY_BACKOFF_MAX,
+                 hedge_percentile=HEDGE_PERCENTILE, hedge_min_delay=HEDGE_MIN_DELAY,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, hedge_budget=HEDGE_BUDGET, breaker_factory=CircuitBreaker):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget = hedge_budget
+        self._breaker_factory = breaker_factory
+        self._breakers = {}
+        self._latencies = {}
+        self._hedge_tokens = {}
+        self.hedges = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def breaker(self, endpoint):
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = self._breaker_factory()
+        return self._breakers[endpoint]
+
+    def latencies(self, endpoint):
+        if endpoint not in self._latencies:
+            self._latencies[endpoint] = LatencyWindow()
+        return self._latencies[endpoint]
+
+    def backoff(self, attempts):
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
+
+    def hedge_delay(self, endpoint):
+        """
+        Seconds to wait for a call before hedging it, None to not hedge.
+        """
+        latencies = self.latencies(endpoint)
+        if self.hedge_percentile <= 0 or len(latencies) < self.hedge_min_samples:
+            return None
+        return max(latencies.percentile(self.hedge_percentile), self.hedge_min_delay)
+
+    def _take_hedge(self, endpoint):
+        tokens = self._hedge_tokens.get(endpoint, 0)
+        if tokens < 1:
+            return False
+        self._hedge_tokens[endpoint] = tokens - 1
+        return True
+
+    def _hedged(self, endpoint, send):
+        import gevent
+        from gevent import Timeout
+
+        start_time = time.perf_counter()
+        # every call earns a share of a hedge, up to a burst of 10.
+        self._hedge_tokens[endpoint] = min(self._hedge_tokens.get(endpoint, 0) + self.hedge_budget, 10)
+        delay = self.hedge_delay(endpoint)
+        if delay is None:
+            result = send()
+            self.latencies(endpoint).add(time.perf_counter() - start_time)
+            return result
+
+        attempts = [gevent.spawn(send)]
+        winner = None
+        try:
+            if not gevent.wait(attempts, timeout=delay, count=1) and self._take_hedge(endpoint):
+                self.hedges += 1
+                HEDGES.inc(endpoint=endpoint)
+                attempts.append(gevent.spawn(send))
+            pending = list(attempts)
+            while True:
+                finished = gevent.wait(pending, count=1)[0]
+                pending.remove(finished)
+                if finished.successful():
+                    winner = finished
+                    self.latencies(endpoint).add(time.perf_counter() - start_time)
+                    return finished.value
+                if not pending:
+                    raise finished.exception
+        except Timeout:
+            # the deadline of the caller ran out. If no attempt got past the limiter, nothing was sent.
+            gevent.killall(attempts, exception=Timeout)
+            if all(isinstance(attempt.exception, LimiterTimeout) for attempt in attempts):
+                raise attempts[0].exception
+            raise
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    # the kill is not waited for, a loser may still complete, or have completed already.
+                    attempt.link_value(close_response)
+            gevent.killall(attempts, block=False)
+
+    def _allow(self, endpoint, breaker):
+        if not breaker.allow():
+            self.rejected += 1
+            CIRCUIT_OPEN.set(1, endpoint=endpoint)
+            raise CircuitOpenError(f"Processing API {endpoint} is failing. Not calling it for a while.")
+
+    def _failed(self, endpoint, breaker, error, attempts):
+        """
+        Record a failed attempt of a call and tell whether it is retried.
+        A 4xx tells nothing of the endpoint, it only releases a half open probe.
+        """
+        retryable = is_retryable(error)
+        if retryable:
+            breaker.record(False)
+        else:
+            breaker.release()
+        if not retryable or attempts >= self.retries:
+            return False
+        self.retried += 1
+        RETRIES.inc(endpoint=endpoint)
+        LOGGER.info(f"Retrying {endpoint} after {type(error).__name__}, attempt {attempts + 1} of {self.retries}.")
+        return True
+
+    def _succeeded(self, endpoint, breaker):
+        breaker.record(True)
+        CIRCUIT_OPEN.set(0, endpoint=endpoint)
+
+    def call(self, endpoint, send):
+        """
+        Make an idempotent call through the breaker, with retries and hedging.
+        @param send: callable making one attempt of the call.
+        """
+        import gevent
+        from gevent import Timeout
+
+        breaker = self.breaker(endpoint)
+        attempts = 0
+        while True:
+            self._allow(endpoint, breaker)
+            try:
+                result = self._hedged(endpoint, send)
+            except LimiterTimeout:
+                # our own queue was full, not the processing API.
+                breaker.release()
+                raise
+            except Timeout:
+                # the deadline of the caller ran out.
+                breaker.record(False)
+                raise
+            except Exception as e:
+                if not self._failed(endpoint, breaker, e, attempts):
+                    raise
+                attempts += 1
+                gevent.sleep(self.backoff(attempts))
+                continue
+            self._succeeded(endpoint, breaker)
+            return result
+
+    async def call_async(self, endpoint, send):
+        """
+        The asyncio twin of call(), through the same breakers and counters. Calls are not hedged.
+        @param send: coroutine function making one attempt of the call.
+        """
+        breaker = self.breaker(endpoint)
+        attempts = 0
+        while True:
+            self._allow(endpoint, breaker)
+            try:
+                result = await send()
+            except asyncio.CancelledError:
+                # a scan task that is no longer needed, or the deadline of the caller, tells nothing of the endpoint.
+                breaker.release()
+                raise
+            except Exception as e:
+                if not self._failed(endpoint, breaker, e, attempts):
+                    raise
+                attempts += 1
+                await asyncio.sleep(self.backoff(attempts))
+                continue
+            self._succeeded(endpoint, breaker)
+            return result
+
+    def stats(self):
+        return {
+            'hedges': self.hedges,
+            'retries': self.retried,
+            'rejected': self.rejected,
+            'circuits': {endpoint: breaker.state for endpoint, breaker in self._breakers.items()},
+        }
+
+
+UPSTREAM_POLICY = UpstreamPolicy()
@@ -0,0 +1,153 @@
+import os
+import re
+import math
+import logging
+
+from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
+
+from api.models import SearchPostingModel, SegmentModel
+
+LOGGER = logging.getLogger(__name__)
+SEARCH_RESULTS_SIZE = int(os.environ.get('SEARCH_RESULTS_SIZE', 20))
+# postings read per query term, the ones with the highest term frequency first.
+SEARCH_MAX_POSTINGS = int(os.environ.get('SEARCH_MAX_POSTINGS', 10000))
+# score multiplier of segments where the query terms are spoken as a phrase.
+SEARCH_PHRASE_BOOST = float(os.environ.get('SEARCH_PHRASE_BOOST', 2.0))
+# BM25 term frequency saturation.
+K1 = 1.2
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it',
+    'no', 'not', 'of', 'on', 'or', 'so', 'that', 'the', 'their', 'then', 'there', 'these', 'they',
+    'this', 'to', 'was', 'will', 'with',
+))
+
+
+def tokenize(text):
+    """
+    Lowercase words of a text with their positions, stopwords dropped.
+    Positions count stopwords too so that phrases stay adjacent.
+    """
+    return [(position, token) for position, token in enumerate(TOKEN_RE.findall((text or '').lower()))
+            if token not in STOPWORDS]
+
+
+class SearchIndex(object):
+    """
+    An inverted index of the segment texts of stored files:
+    term -> (fileId, fileSegmentId, startTime) postings, ranked with BM25 style idf
+    weights and a boost for segments where the query is spoken as a phrase.
+    """
+    def __init__(self, model=SearchPostingModel, segment_model=SegmentModel):
+        self.model = model
+        self.segment_model = segment_model
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def postings(self, file_id, segments):
+        documents = []
+        for segment in segments or []:
+            positions = {}
+            for position, token in tokenize(segment.get('segmentText')):
+                positions.setdefault(token, []).append(position)
+            for term, term_positions in positions.items():
+                documents.append({
+                    'term': term,
+                    'fileId': file_id,
+                    'fileSegmentId': segment.get('fileSegmentId'),
+                    'startTime': segment.get('startTime'),
+                    'endTime': segment.get('endTime'),
+                    'tf': len(term_positions),
+                    'positions': term_positions,
+                })
+        return documents
+
+    def index_file(self, file_id, segments, replace=True):
+        """
+        Replace the postings of a file.
+
+        @param replace: pass False to add the postings of more segments of the file, e.g. of a streamed chunk.
+        """
+        documents = self.postings(file_id, segments)
+        try:
+            if replace:
+                self._collection.delete_many({'fileId': file_id})
+            if documents:
+                self._collection.insert_many(documents, ordered=False)
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not index segments of {file_id}. {str(e)}.")
+            return 0
+        LOGGER.info(f"Indexed {len(documents)} postings of {file_id}.")
+        return len(documents)
+
+    def idf(self, df, total):
+        return math.log(1 + (total - df + 0.5) / (df + 0.5))
+
+    def is_phrase(self, positions):
+        """
+        True if the terms occur one after the other, stopwords in between allowed.
+        positions: list of position lists, one per query term in query order.
+        """
+        first, rest = positions[0], positions[1:]
+        for start in first:
+            previous = start
+            for term_positions in rest:
+                following = [p for p in term_positions if previous < p <= previous + 3]
+                if not following:
+                    break
+                previous = following[0]
+            else:
+                return True
+        return False
+
+    def search(self, query, limit=SEARCH_RESULTS_SIZE):
+        """
+        Ranked segments matching a query, best first.
+        """
+        terms = list(dict.fromkeys(token for _, token in tokenize(query)))
+        if not terms:
+            return []
+
+        total = max(self.segment_model._mongometa.collection.estimated_document_count(), 1)
+        scores, positions, hits = {}, {}, {}
+        for term in terms:
+            postings = list(self._collection.find(
+                {'term': term}, projection={'_id': 0, 'term': 0}
+            ).sort('tf', DESCENDING).limit(SEARCH_MAX_POSTINGS))
+            idf = self.idf(len(postings), total)
+            for posting in postings:
+                key = (posting['fileId'], posting['fileSegmentId'])
+                scores[key] = scores.get(key, 0) + idf * posting['tf'] * (K1 + 1) / (posting['tf'] + K1)
+                positions.setdefault(key, {})[term] = posting['positions']
+                hits[key] = posting
+
+        if len(terms) > 1:
+            for key, term_positions in positions.items():
+                if len(term_positions) == len(terms) and self.is_phrase([term_positions[t] for t in terms]):
+                    scores[key] *= SEARCH_PHRASE_BOOST
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        texts = self.segment_texts([key for key, _ in ranked])
+        return [{
+            'fileId': key[0],
+            'fileSegmentId': key[1],
+            'startTime': hits[key]['startTime'],
+            'endTime': hits[key]['endTime'],
+            'segmentText': texts.get(key),
+            'score': round(score, 4),
+        } for key, score in ranked]
+
+    def segment_texts(self, keys):
+        if not keys:
+            return {}
+        segments = self.segment_model._mongometa.collection.find(
+            {'$or': [{'fileId': f, 'fileSegmentId': s} for f, s in keys]},
+            projection={'_id': 0, 'fileId': 1, 'fileSegmentId': 1, 'segmentText': 1}
+        )
+        return {(s['fileId'], s['fileSegmentId']): s.get('segmentText') for s in segments}
+
+
+SEARCH_INDEX = SearchIndex()
@@ -0,0 +1,100 @@
+import os
+import logging
+
+from pymongo import ASCENDING, ReplaceOne
+
+from api.models import SegmentModel
+
+LOGGER = logging.getLogger(__name__)
+SEGMENTS_PAGE_SIZE = int(os.environ.get('SEGMENTS_PAGE_SIZE', 100))
+SEGMENTS_PAGE_MAX = int(os.environ.get('SEGMENTS_PAGE_MAX', 1000))
+SEGMENT_FIELDS = ('fileSegmentId', 'fileId', 'segmentText', 'startTime', 'endTime')
+
+
+class SegmentStore(object):
+    """
+    Segments of stored files in their own collection, indexed on (fileId, startTime, fileSegmentId)
+    so that the segments overlapping a time window can be read on their own, in order.
+    """
+    def __init__(self, model=SegmentModel):
+        self.model = model
+
+    @property
+    def _collection(self):
+        return self.model._mongometa.collection
+
+    def save(self, file_id, segments):
+        """
+        Replace the segments of a file. Segments the file no longer has are removed.
+        """
+        self.prune(file_id, self.write(file_id, segments))
+
+    def write(self, file_id, segments, generation=None):
+        """
+        Upsert some segments of a file, e.g. a chunk of a streamed file.
+        Returns their fileSegmentIds.
+
+        @param generation: tag of the write the segments are part of, see prune_generation().
+        """
+        segment_ids, operations = [], []
+        for segment in segments or []:
+            document = {f: segment.get(f) for f in SEGMENT_FIELDS}
+            document['fileId'] = file_id
+            if generation is not None:
+                document['generation'] = generation
+            segment_ids.append(document['fileSegmentId'])
+            operations.append(ReplaceOne(
+                {'fileId': file_id, 'fileSegmentId': document['fileSegmentId']}, document, upsert=True
+            ))
+        if operations:
+            self._collection.bulk_write(operations, ordered=False)
+        return segment_ids
+
+    def prune(self, file_id, segment_ids):
+        """
+        Remove the segments of a file but the given ones.
+        """
+        self._collection.delete_many({'fileId': file_id, 'fileSegmentId': {'$nin': segment_ids}})
+
+    def prune_generation(self, file_id, generation):
+        """
+        Remove the segments of a file but those written with the given generation.
+        """
+        self._collection.delete_many({'fileId': file_id, 'generation': {'$ne': generation}})
+
+    def has(self, file_id):
+        return self._collection.find_one({'fileId': file_id}, projection={'_id': 1}) is not None
+
+    def find(self, file_id, start_time=0, end_time=None, after=None, limit=SEGMENTS_PAGE_SIZE):
+        """
+        Segments of a file overlapping the [start_time, end_time] millisecond window,
+        ordered by (startTime, fileSegmentId), the order of the index, and paginated
+        by the fileSegmentId of the last segment of a page.
+        Returns (segments, next) where next is the `after` of the next page or None.
+        """
+        query = {'fileId': file_id, 'endTime': {'$gte': start_time}}
+        start = {}
+        if end_time is not None:
+            start['$lte'] = end_time
+        if after is not None:
+            last = self._collection.find_one({'fileId': file_id, 'fileSegmentId': after}, projection={'startTime': 1})
+            if last is None:
+                # the segment is gone, e.g. the file was refreshed in between pages.
+                query['fileSegmentId'] = {'$gt': after}
+            else:
+                start['$gte'] = last['startTime']
+                query['$or'] = [{'startTime': {'$gt': last['startTime']}}, {'fileSegmentId': {'$gt': after}}]
+        if start:
+            query['startTime'] = start
+
+        projection = {'_id': 0}
+        projection.update({f: 1 for f in SEGMENT_FIELDS})
+        order = [('startTime', ASCENDING), ('fileSegmentId', ASCENDING)]
+        cursor = self._collection.find(query, projection=projection).sort(order).limit(limit + 1)
+        segments = list(cursor)
+        if len(segments) > limit:
+            return segments[:limit], segments[limit - 1]['fileSegmentId']
+        return segments, None
+
+
+SEGMENT_STORE = SegmentStore()
@@ -0,0 +1,11 @@
+import os
+
+# gevent serves api.app with GeventJobs, asyncio serves api.asgi with AsyncioJobs.
+JOBS_STRATEGY = os.environ.get('JOBS_STRATEGY', 'gevent')
+
+if JOBS_STRATEGY == 'asyncio':
+    from api.asgi import app  # noqa: F401
+elif JOBS_STRATEGY == 'gevent':
+    from api.app import app  # noqa: F401
+else:
+    raise ValueError(f"Unknown JOBS_STRATEGY {JOBS_STRATEGY}, use gevent or asyncio.")
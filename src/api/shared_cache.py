@@ -0,0 +1,542 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+MAGIC = b'SNKCACHE'
+VERSION = 1
+WAYS = 8
+MIN_CHUNK = 1024
+MAX_KEY = 64
+# magic, version, ways, buckets, page size, pages, generation, page hand.
+HEADER = struct.Struct('<8sIIIIIxxxxQQ')
+# per slab class: free list head, clock hand.
+SLAB_CLASS = struct.Struct('<QQ')
+# seq, referenced, key length, key hash, key, value offset, value length, expires at.
+ENTRY = struct.Struct('<IBBxxQ64sQIxxxxd')
+# owner entry, next free chunk, or next chunk of the value for a value of many pages.
+CHUNK = struct.Struct('<QQ')
+EPOCH = datetime.datetime(1970, 1, 1)
+# seconds between attempts to take the flock of the file, doubling up to the max.
+LOCK_POLL = 0.0001
+LOCK_POLL_MAX = 0.01
+
+
+def slab_classes(page_size):
+    """
+    Chunk sizes of the slab classes, doubling from MIN_CHUNK up to a page.
+    """
+    sizes = []
+    size = MIN_CHUNK
+    while size < page_size:
+        sizes.append(size)
+        size *= 2
+    return sizes + [page_size]
+
+
+def key_hash(key):
+    # the hash of a key must be the same in every worker, hash() is salted per process.
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class SharedMemoryCache(object):
+    """
+    A cache of bytes shared by the workers of a host through an mmap'd file,
+    e.g. in /dev/shm, so that a file is cached once per host and memory stays
+    the same whatever the no. of workers.
+
+    The file holds a set associative hash index of WAYS entries per bucket and
+    an arena of pages. A page is given to a slab class the first time the class
+    needs room and is cut into chunks of the class size (memcached style), a
+    value takes one chunk. A value larger than a page takes a chain of chunks
+    of the largest class, a page each, up to half of the pages. A class that
+    is full evicts with a clock over its chunks: an entry read since the hand
+    last passed gets a second chance, expired entries go first. A class without
+    any page takes one from the others with a clock over the pages.
+
+    Writers hold a thread lock and an flock of the file, waiting for the flock
+    without blocking the other green threads of the worker. Readers take neither:
+    every index entry has a sequence number that writers make odd while they
+    change the entry or its chunks, and a read is retried if the sequence was
+    odd or moved. Values of one chunk are decoded straight from the mapping, see get().
+    Clocks are wall clock seconds so that expiry means the same in every worker.
+    """
+    def __init__(self, path, max_entries, max_bytes, ttl, page_size=1024 * 1024, clock=time.time, read_retries=4):
+        self.path = path
+        self.ttl = ttl
+        self.page_size = page_size
+        self.ways = WAYS
+        self.buckets = max(-(-max_entries // WAYS), 1)
+        self.pages = max(max_bytes // page_size, 1)
+        self.classes = slab_classes(page_size)
+        self._clock = clock
+        self._read_retries = read_retries
+        self._lock = threading.RLock()
+        self._pid = None
+        self._fd = None
+        # layout of the file.
+        self._classes_at = HEADER.size
+        self._page_table_at = self._classes_at + SLAB_CLASS.size * len(self.classes)
+        self._index_at = self._aligned(self._page_table_at + self.pages)
+        self._arena_at = self._aligned(self._index_at + ENTRY.size * self.buckets * self.ways, page_size=4096)
+        self.size = self._arena_at + self.pages * page_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._open()
+
+    @staticmethod
+    def _aligned(offset, page_size=8):
+        return -(-offset // page_size) * page_size
+
+    def _lock_fd(self):
+        # an flock is shared by the processes an fd was inherited by, a forked worker opens its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        return self._fd
+
+    @staticmethod
+    def _flock(fd):
+        """
+        Take the flock of the file, polling so that a gevent worker waiting for
+        another process to let go of it keeps serving its other green threads.
+        """
+        import gevent
+
+        delay = LOCK_POLL
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                gevent.sleep(delay)
+                delay = min(delay * 2, LOCK_POLL_MAX)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fd = self._lock_fd()
+            self._flock(fd)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            fd = self._lock_fd()
+            header = os.pread(fd, HEADER.size, 0) if os.fstat(fd).st_size == self.size else b''
+            expected = (MAGIC, VERSION, self.ways, self.buckets, self.page_size, self.pages)
+            if len(header) != HEADER.size or HEADER.unpack(header)[:6] != expected:
+                LOGGER.info(f"Creating the shared cache {self.path} of {self.size} bytes.")
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, HEADER.pack(*expected, 0, 0), 0)
+            self._map = mmap.mmap(fd, self.size)
+        self._view = memoryview(self._map)
+
+    # header and slab class state, written under the lock only.
+
+    def generation(self):
+        """
+        See LRUCache.generation(). The generation is shared, so an invalidation in
+        any worker drops the reads of the other workers that were in flight.
+        """
+        return struct.unpack_from('<Q', self._map, HEADER.size - 16)[0]
+
+    def _bump_generation(self):
+        struct.pack_into('<Q', self._map, HEADER.size - 16, self.generation() + 1)
+
+    def _page_hand(self):
+        return struct.unpack_from('<Q', self._map, HEADER.size - 8)[0]
+
+    def _set_page_hand(self, page):
+        struct.pack_into('<Q', self._map, HEADER.size - 8, page)
+
+    def _slab_class(self, k):
+        return SLAB_CLASS.unpack_from(self._map, self._classes_at + k * SLAB_CLASS.size)
+
+    def _set_slab_class(self, k, free_head, hand):
+        SLAB_CLASS.pack_into(self._map, self._classes_at + k * SLAB_CLASS.size, free_head, hand)
+
+    def _page_class(self, page):
+        # 0 is a free page, class k is stored as k + 1.
+        return self._map[self._page_table_at + page] - 1
+
+    def _set_page_class(self, page, k):
+        self._map[self._page_table_at + page] = k + 1
+
+    # chunks are addressed by their offset in the arena + 1, 0 is none.
+
+    def _chunk_at(self, chunk):
+        return self._arena_at + chunk - 1
+
+    def _chunk_owner(self, chunk):
+        return CHUNK.unpack_from(self._map, self._chunk_at(chunk))[0]
+
+    def _set_chunk(self, chunk, owner, next_free=0):
+        CHUNK.pack_into(self._map, self._chunk_at(chunk), owner, next_free)
+
+    def _free_chunk(self, chunk):
+        k = self._page_class((chunk - 1) // self.page_size)
+        free_head, hand = self._slab_class(k)
+        self._set_chunk(chunk, 0, free_head)
+        self._set_slab_class(k, chunk, hand)
+
+    # index entries are addressed by bucket * WAYS + way + 1, 0 is none.
+
+    def _entry_at(self, entry):
+        return self._index_at + (entry - 1) * ENTRY.size
+
+    def _read_entry(self, entry):
+        return ENTRY.unpack_from(self._map, self._entry_at(entry))
+
+    def _write_entry(self, entry, *fields):
+        """
+        Replace an entry, its seq is odd while it changes.
+        """
+        self._begin_write(entry)
+        self._end_write(entry, *fields)
+
+    def _begin_write(self, entry):
+        """
+        Make the seq of an entry odd before its chunk or fields change, see _end_write().
+        """
+        at = self._entry_at(entry)
+        seq = struct.unpack_from('<I', self._map, at)[0]
+        struct.pack_into('<I', self._map, at, (seq + 1) & 0xffffffff)
+
+    def _end_write(self, entry, *fields):
+        at = self._entry_at(entry)
+        seq = struct.unpack_from('<I', self._map, at)[0]
+        ENTRY.pack_into(self._map, at, seq, *fields)
+        struct.pack_into('<I', self._map, at, (seq + 1) & 0xffffffff)
+
+    def _bucket(self, key):
+        h = key_hash(key)
+        first = (h % self.buckets) * self.ways + 1
+        return h, range(first, first + self.ways)
+
+    def _remove(self, entry):
+        _, _, _, _, _, chunk, _, _ = self._read_entry(entry)
+        self._write_entry(entry, 0, 0, 0, b'', 0, 0, 0.0)
+        while chunk:
+            next_chunk = CHUNK.unpack_from(self._map, self._chunk_at(chunk))[1]
+            self._free_chunk(chunk)
+            chunk = next_chunk
+
+    def _evict(self, entry, now):
+        if self._read_entry(entry)[7] <= now:
+            self.expirations += 1
+        else:
+            self.evictions += 1
+        self._remove(entry)
+
+    def _page_chunks(self, page, k):
+        size = self.classes[k]
+        first = page * self.page_size + 1
+        return range(first, first + self.page_size - size + 1, size)
+
+    def _carve(self, page, k):
+        """
+        Give a free page to slab class k and put its chunks on the free list of the class.
+        """
+        self._set_page_class(page, k)
+        for chunk in self._page_chunks(page, k):
+            self._free_chunk(chunk)
+
+    def _reclaim_page(self, now, keep=()):
+        """
+        Take a page from the slab classes with the page clock and return it emptied.
+        @param keep: pages not to take, see _allocate().
+        """
+        page = self._page_hand() % self.pages
+        while page in keep:
+            page = (page + 1) % self.pages
+        self._set_page_hand(page + 1)
+        k = self._page_class(page)
+        chunks = set(self._page_chunks(page, k))
+        for chunk in chunks:
+            owner = self._chunk_owner(chunk)
+            if owner:
+                self._evict(owner, now)
+        # unlink the chunks of the page from the free list of its class.
+        free_head, hand = self._slab_class(k)
+        kept = []
+        while free_head:
+            if free_head not in chunks:
+                kept.append(free_head)
+            free_head = CHUNK.unpack_from(self._map, self._chunk_at(free_head))[1]
+        self._set_slab_class(k, 0, 0 if hand in chunks else hand)
+        for chunk in reversed(kept):
+            self._free_chunk(chunk)
+        self._set_page_class(page, -1)
+        return page
+
+    def _next_chunk(self, k, chunk):
+        """
+        The chunk of slab class k after chunk, in page order and wrapping around.
+        """
+        size = self.classes[k]
+        page = (chunk - 1) // self.page_size if chunk else -1
+        if chunk and (chunk - 1) % self.page_size + 2 * size <= self.page_size:
+            return chunk + size
+        for i in range(1, self.pages + 1):
+            candidate = (page + i) % self.pages
+            if self._page_class(candidate) == k:
+                return candidate * self.page_size + 1
+        return 0
+
+    def _allocate(self, k, now, keep=()):
+        """
+        A free chunk of slab class k, evicting with the clock of the class if it is full.
+        @param keep: pages of the chunks already taken for the value being stored. They
+        have no owner yet, so the clock skips them, and they are not reclaimed.
+        """
+        free_head, hand = self._slab_class(k)
+        if not free_head:
+            free = [p for p in range(self.pages) if self._page_class(p) == -1]
+            if free:
+                self._carve(free[0], k)
+            elif not any(self._page_class(p) == k and p not in keep for p in range(self.pages)):
+                self._carve(self._reclaim_page(now, keep), k)
+            else:
+                self._sweep(k, now)
+            free_head, hand = self._slab_class(k)
+        next_free = CHUNK.unpack_from(self._map, self._chunk_at(free_head))[1]
+        self._set_slab_class(k, next_free, hand)
+        return free_head
+
+    def _sweep(self, k, now):
+        """
+        Move the clock hand of slab class k until an entry is evicted. An entry
+        read since the hand last passed it is skipped once.
+        """
+        _, hand = self._slab_class(k)
+        chunk = self._next_chunk(k, hand)
+        while True:
+            owner = self._chunk_owner(chunk)
+            if owner:
+                at = self._entry_at(owner)
+                if self._map[at + 4] and self._read_entry(owner)[7] > now:
+                    self._map[at + 4] = 0
+                else:
+                    self._evict(owner, now)
+                    free_head, _ = self._slab_class(k)
+                    self._set_slab_class(k, free_head, chunk)
+                    return
+            chunk = self._next_chunk(k, chunk)
+
+    def _victim(self, ways, now):
+        """
+        The way of a full bucket to evict: expired first, then not recently read, then the first to expire.
+        """
+        entries = [(entry, self._read_entry(entry)) for entry in ways]
+        expired = [entry for entry, fields in entries if fields[7] <= now]
+        if expired:
+            return expired[0]
+        cold = [(fields[7], entry) for entry, fields in entries if not fields[1]]
+        if cold:
+            return min(cold)[1]
+        for entry, _ in entries:
+            self._map[self._entry_at(entry) + 4] = 0
+        return min((fields[7], entry) for entry, fields in entries)[1]
+
+    def _value(self, chunk, length):
+        """
+        A memoryview of a value in the mapping, or of a copy of it if it takes a
+        chain of pages. Raises ValueError if the chain is changed under the read.
+        """
+        capacity = self.page_size - CHUNK.size
+        start = self._chunk_at(chunk) + CHUNK.size
+        if length <= capacity:
+            return self._view[start:start + length]
+        copy = bytearray(length)
+        at = 0
+        while at < length:
+            # the chunks of a chain are whole pages.
+            if not 0 < chunk <= self.pages * self.page_size or (chunk - 1) % self.page_size:
+                raise ValueError("Changed chain.")
+            start = self._chunk_at(chunk) + CHUNK.size
+            part = min(capacity, length - at)
+            copy[at:at + part] = self._view[start:start + part]
+            at += part
+            chunk = CHUNK.unpack_from(self._map, self._chunk_at(chunk))[1]
+        return memoryview(copy)
+
+    def get(self, key, decode=bytes):
+        """
+        @param decode: makes the cached value out of a memoryview of it in the
+        mapping and must copy what it keeps, the view is only valid until the
+        entry changes. If a writer changed the entry meanwhile the read is retried,
+        and counted as a miss after read_retries attempts.
+        """
+        key = key.encode('utf-8')
+        h, ways = self._bucket(key)
+        for _ in range(self._read_retries):
+            retry = False
+            for entry in ways:
+                at = self._entry_at(entry)
+                seq, _, key_length, entry_hash, entry_key, chunk, length, expires_at = ENTRY.unpack_from(self._map, at)
+                if seq & 1:
+                    retry = True
+                    continue
+                if entry_hash != h or entry_key[:key_length] != key or not chunk:
+                    continue
+                try:
+                    value = decode(self._value(chunk, length))
+                except (struct.error, ValueError, UnicodeDecodeError):
+                    value = None
+                if struct.unpack_from('<I', self._map, at)[0] != seq or value is None:
+                    retry = True
+                    break
+                if expires_at <= self._clock():
+                    self.expirations += 1
+                    self.misses += 1
+                    return None
+                # the clock gives the entry a second chance. A lost write only costs it one.
+                self._map[at + 4] = 1
+                self.hits += 1
+                return value
+            if not retry:
+                break
+        self.misses += 1
+        return None
+
+    def set(self, key, value, generation=None, size=None):
+        """
+        @param value: bytes or a memoryview.
+        @param size: ignored, the cache counts the bytes it stores.
+        """
+        key = key.encode('utf-8')
+        capacity = self.page_size - CHUNK.size
+        # a value larger than a page takes a chain of pages.
+        count = max(-(-len(value) // capacity), 1)
+        k = next((i for i, s in enumerate(self.classes) if s >= len(value) + CHUNK.size), len(self.classes) - 1)
+        if count > max(self.pages // 2, 1) or len(key) > MAX_KEY or not key:
+            return False
+        h, ways = self._bucket(key)
+        with self._locked():
+            if generation is not None and generation != self.generation():
+                return False
+            now = self._clock()
+            for entry in ways:
+                fields = self._read_entry(entry)
+                if fields[3] == h and fields[4][:fields[2]] == key:
+                    self._remove(entry)
+            chunks = []
+            for _ in range(count):
+                chunks.append(self._allocate(k, now, keep={(c - 1) // self.page_size for c in chunks}))
+            empty = [entry for entry in ways if not self._read_entry(entry)[5]]
+            entry = empty[0] if empty else self._victim(ways, now)
+            if self._read_entry(entry)[5]:
+                self._evict(entry, now)
+            self._begin_write(entry)
+            for i, chunk in enumerate(chunks):
+                self._set_chunk(chunk, entry, chunks[i + 1] if i + 1 < count else 0)
+                start = self._chunk_at(chunk) + CHUNK.size
+                part = value[i * capacity:(i + 1) * capacity]
+                self._view[start:start + len(part)] = part
+            self._end_write(entry, 0, len(key), h, key, chunks[0], len(value), now + self.ttl)
+            return True
+
+    def invalidate(self, key):
+        key = key.encode('utf-8')
+        h, ways = self._bucket(key)
+        with self._locked():
+            self._bump_generation()
+            for entry in ways:
+                fields = self._read_entry(entry)
+                if fields[5] and fields[3] == h and fields[4][:fields[2]] == key:
+                    self._remove(entry)
+
+    def clear(self):
+        with self._locked():
+            self._bump_generation()
+            for entry in range(1, self.buckets * self.ways + 1):
+                if self._read_entry(entry)[5]:
+                    self._write_entry(entry, 0, 0, 0, b'', 0, 0, 0.0)
+            for k in range(len(self.classes)):
+                self._set_slab_class(k, 0, 0)
+            for page in range(self.pages):
+                self._set_page_class(page, -1)
+            self._set_page_hand(0)
+
+    def stats(self):
+        """
+        Entries and bytes are those of the host, hits, misses, evictions and expirations those of this worker.
+        """
+        entries = [self._read_entry(entry) for entry in range(1, self.buckets * self.ways + 1)]
+        stored = [fields for fields in entries if fields[5]]
+        return {
+            'entries': len(stored),
+            'bytes': sum(fields[6] for fields in stored),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+# etag length, fetchedAt in microseconds since the epoch (-1 for none), no. of bodies.
+RESPONSE = struct.Struct('<HqB')
+# encoding length, body length.
+BODY = struct.Struct('<BI')
+
+
+class SharedResponseCache(SharedMemoryCache):
+    """
+    SharedMemoryCache of the (etag, bodies, fetchedAt) presentation responses
+    that FILE_CACHE holds. A hit copies the bodies out of the mapping once and
+    decodes nothing else.
+    """
+    def get(self, key, decode=None):
+        return super().get(key, decode or self.decode)
+
+    def set(self, key, value, generation=None, size=None):
+        return super().set(key, self.encode(value), generation)
+
+    @staticmethod
+    def encode(value):
+        etag, bodies, fetched_at = value
+        etag = etag.encode('utf-8')
+        fetched_at = -1 if fetched_at is None else (fetched_at - EPOCH) // datetime.timedelta(microseconds=1)
+        parts = [RESPONSE.pack(len(etag), fetched_at, len(bodies)), etag]
+        for encoding, body in bodies.items():
+            encoding = encoding.encode('ascii')
+            parts.extend([BODY.pack(len(encoding), len(body)), encoding])
+        parts.extend(bodies.values())
+        return b''.join(parts)
+
+    @staticmethod
+    def decode(view):
+        etag_length, fetched_at, count = RESPONSE.unpack_from(view)
+        at = RESPONSE.size
+        etag = bytes(view[at:at + etag_length]).decode('utf-8')
+        at += etag_length
+        lengths = []
+        for _ in range(count):
+            encoding_length, body_length = BODY.unpack_from(view, at)
+            at += BODY.size
+            lengths.append((bytes(view[at:at + encoding_length]).decode('ascii'), body_length))
+            at += encoding_length
+        bodies = {}
+        for encoding, body_length in lengths:
+            if at + body_length > len(view):
+                raise ValueError("Truncated response.")
+            bodies[encoding] = bytes(view[at:at + body_length])
+            at += body_length
+        fetched_at = None if fetched_at < 0 else EPOCH + datetime.timedelta(microseconds=fetched_at)
+        return etag, bodies, fetched_at
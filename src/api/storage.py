@@ -0,0 +1,252 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+
+import gridfs
+from bson import BSON, decode_file_iter
+from pymodm.errors import ValidationError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from api.cache import FILE_CACHE
+from api.columnar import pack_segments, unpack_chunks, unpack_segments
+from api.metrics import STAGE_LATENCY
+from api.models import FileModel
+from api.search import SEARCH_INDEX
+from api.segments import SEGMENT_STORE
+from api.serialization import render
+
+LOGGER = logging.getLogger(__name__)
+SEGMENTS_LIST = 'list'
+SEGMENTS_PACKED = 'packed'
+# how the segments of a file are stored in its document: list (a subdocument per segment) or packed, see api.columnar.
+SEGMENTS_FORMAT = os.environ.get('SEGMENTS_FORMAT', SEGMENTS_LIST)
+# bytes of a file document past which its rendered body, then its packed segments, are moved to GridFS. 0 never does.
+FILE_DOCUMENT_MAX_BYTES = int(os.environ.get('FILE_DOCUMENT_MAX_BYTES', 8 * 1024 * 1024))
+# GridFS bucket of the parts of file documents that did not fit.
+OVERFLOW_BUCKET = 'fileOverflow'
+# fields stored with a file that are not part of its presentation.
+INTERNAL_FIELDS = ('etag', 'rendered', 'fetchedAt', 'segmentsPacked', 'renderedFile')
+# header fields of packed segments kept in the document when their columns move to GridFS.
+PACKED_HEADER = ('v', 'count', 'keys')
+OVERFLOW_PROJECTION = {'_id': 1, 'renderedFile': 1, 'segmentsPacked.file': 1, 'segmentsPacked.chunks': 1}
+
+
+def canonical_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def document_etag(son):
+    """
+    Strong ETag of a file document, a hash of its canonical JSON.
+    """
+    son = {k: v for k, v in son.items() if k not in INTERNAL_FIELDS}
+    return hashlib.sha256(canonical_json(son).encode('utf-8')).hexdigest()[:32]
+
+
+def presentation(son):
+    """
+    The document of a stored file as the presentation API serves it.
+    """
+    for field in INTERNAL_FIELDS:
+        son.pop(field, None)
+    return son
+
+
+def render_file(son, fetched_at=None):
+    """
+    Add the ETag and the pre-rendered presentation body to a file document.
+    A hit on a stored file then serves the bytes as they are, without the ODM or a JSON encoder.
+
+    @param fetched_at: when the file was fetched from the processing API, see api.refresh.
+    The ETag does not depend on it, so a refresh that changes nothing keeps the ETag.
+    """
+    if fetched_at is not None:
+        son['fetchedAt'] = fetched_at
+    son['etag'] = document_etag(son)
+    son['rendered'] = render(presentation(dict(son)))
+    return son
+
+
+def overflow(model=FileModel):
+    return gridfs.GridFS(model._mongometa.collection.database, collection=OVERFLOW_BUCKET)
+
+
+def pack_file(son, model=FileModel, segments_format=None, max_bytes=None):
+    """
+    Shape a rendered file document for storage. Packed, the segments are stored
+    as columns, see api.columnar, unless they cannot be packed without losing anything.
+    A document still larger than max_bytes has its rendered body, then the columns
+    of its segments, moved to GridFS. Pack after render_file(), so the ETag and
+    the body are the same whatever the format.
+
+    @param segments_format, max_bytes: SEGMENTS_FORMAT and FILE_DOCUMENT_MAX_BYTES by default.
+    """
+    segments_format = segments_format or SEGMENTS_FORMAT
+    max_bytes = FILE_DOCUMENT_MAX_BYTES if max_bytes is None else max_bytes
+    if segments_format == SEGMENTS_PACKED and son.get('segments') is not None:
+        packed = pack_segments(son['_id'], son['segments'])
+        if packed is not None:
+            del son['segments']
+            son['segmentsPacked'] = packed
+    if max_bytes <= 0 or len(BSON.encode(son)) <= max_bytes:
+        return son
+
+    if son.get('rendered') is not None:
+        son['renderedFile'] = overflow(model).put(son.pop('rendered'), fileId=son['_id'])
+    if 'segmentsPacked' in son and len(BSON.encode(son)) > max_bytes:
+        packed = son['segmentsPacked']
+        columns = {key: packed.pop(key) for key in list(packed) if key not in PACKED_HEADER}
+        packed['file'] = overflow(model).put(BSON.encode(columns), fileId=son['_id'])
+    return son
+
+
+def overflow_ids(son):
+    """
+    Ids of the GridFS files a stored file document refers to, it may be read with OVERFLOW_PROJECTION.
+    """
+    son = son or {}
+    packed = son.get('segmentsPacked') or {}
+    return {i for i in (son.get('renderedFile'), packed.get('file'), packed.get('chunks')) if i is not None}
+
+
+def drop_overflow(replaced, son, model=FileModel):
+    """
+    Delete what the replaced version of a file moved to GridFS and the new one does not refer to.
+    """
+    dropped = overflow_ids(replaced) - overflow_ids(son)
+    if dropped:
+        bucket = overflow(model)
+        for grid_id in dropped:
+            bucket.delete(grid_id)
+
+
+def unpack_file(son, model=FileModel, start=0, stop=None):
+    """
+    The inverse of pack_file(): a stored file document with its segments and
+    rendered body back in it, as far as they were read.
+
+    @param start, stop: the page of the segments to unpack, all of them by default.
+    """
+    if son.get('renderedFile') is not None:
+        son['rendered'] = overflow(model).get(son.pop('renderedFile')).read()
+    packed = son.pop('segmentsPacked', None)
+    if packed is not None and 'chunks' in packed:
+        records = decode_file_iter(overflow(model).get(packed['chunks']))
+        son['segments'] = unpack_chunks(son['_id'], records, start, stop)
+    elif packed is not None:
+        if 'file' in packed:
+            packed = dict(packed, **BSON(overflow(model).get(packed['file']).read()).decode())
+        son['segments'] = unpack_segments(son['_id'], packed, start, stop)
+    return son
+
+
+def render_stored_file(file_id, model=FileModel):
+    """
+    Pre-render a file stored before its body was, and keep the body.
+    Returns the updated document, None if the file is not stored.
+    """
+    collection = model._mongometa.collection
+    son = collection.find_one({'_id': file_id})
+    if son is None:
+        return None
+    son = render_file(unpack_file(son, model))
+    collection.update_one({'_id': file_id}, {'$set': {'etag': son['etag'], 'rendered': son['rendered']}})
+    return son
+
+
+def index_segments(file_id, segments):
+    """
+    Copy the segments of a saved file to their own collection for time window
+    queries and index them for search. Both are derived from the stored document,
+    a file whose copy failed is backfilled by the segments API.
+    """
+    try:
+        SEGMENT_STORE.save(file_id, segments)
+    except PyMongoError as e:
+        LOGGER.warning(f"Could not copy segments of {file_id}. {str(e)}.")
+    SEARCH_INDEX.index_file(file_id, segments)
+
+
+def index_segments_async(file_id, segments):
+    """
+    index_segments() in a green thread so that the save path does not wait for it.
+    """
+    import gevent
+
+    return gevent.spawn(index_segments, file_id, segments)
+
+
+def save_file(the_file, model=FileModel, index=True):
+    """
+    Save a file fetched from the processing API and invalidate what we cached of it.
+    The segments are copied to their own collection and indexed for search
+    in the background, see index_segments().
+    The ETag and the JSON body of the document are computed once here and saved with it,
+    along with fetchedAt. The document is replaced in one write, so a refresh is atomic.
+    It is stored in SEGMENTS_FORMAT, see pack_file().
+
+    @param index: pass False to call index_segments() yourself, e.g. outside of gevent.
+    """
+    with STAGE_LATENCY.time(stage='save'):
+        instance = model(**the_file)
+        instance.full_clean()
+        son = pack_file(render_file(instance.to_son(), datetime.datetime.utcnow()), model)
+        replaced = model._mongometa.collection.find_one_and_replace(
+            {'_id': instance.pk}, son, projection=OVERFLOW_PROJECTION, upsert=True
+        )
+        drop_overflow(replaced, son, model)
+    if index:
+        index_segments_async(the_file['fileId'], the_file.get('segments'))
+    FILE_CACHE.invalidate(the_file['fileId'])
+
+
+def save_files(files, model=FileModel, index=True):
+    """
+    Save many files fetched from the processing API with one unordered bulk upsert.
+    Files are validated like save() would, one invalid file does not stop the others.
+
+    @param index: pass False to call index_segments() yourself, e.g. outside of gevent.
+
+    Returns a dict of fileId -> error for the files that could not be saved.
+    """
+    errors = {}
+    segments = {}
+    sons = {}
+    file_ids, operations = [], []
+    fetched_at = datetime.datetime.utcnow()
+    for the_file in files:
+        instance = model(**the_file)
+        try:
+            instance.full_clean()
+        except ValidationError as e:
+            errors[the_file['fileId']] = e
+            continue
+        son = pack_file(render_file(instance.to_son(), fetched_at), model)
+        file_ids.append(son['_id'])
+        sons[son['_id']] = son
+        segments[son['_id']] = the_file.get('segments')
+        operations.append(ReplaceOne({'_id': son['_id']}, son, upsert=True))
+
+    if operations:
+        # only documents that moved something to GridFS match, usually none.
+        replaced = {son['_id']: son for son in model._mongometa.collection.find(
+            {'_id': {'$in': file_ids}, '$or': [{k: {'$exists': True}} for k in OVERFLOW_PROJECTION if k != '_id']},
+            projection=OVERFLOW_PROJECTION,
+        )}
+        try:
+            model._mongometa.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                errors[file_ids[error['index']]] = Exception(error.get('errmsg'))
+            LOGGER.warning(f"Could not save {len(errors)} of {len(files)} files.")
+
+    for file_id in file_ids:
+        if file_id not in errors:
+            drop_overflow(replaced.get(file_id), sons[file_id], model)
+            if index:
+                index_segments_async(file_id, segments[file_id])
+        FILE_CACHE.invalidate(file_id)
+    return errors
@@ -0,0 +1,292 @@
+import os
+import hashlib
+import logging
+import datetime
+from itertools import islice
+
+from bson import BSON, ObjectId
+from pymongo.errors import PyMongoError
+
+from api.cache import FILE_CACHE
+from api.columnar import VERSION, pack_segments
+from api.metrics import METRICS
+from api.models import FileModel
+from api.search import SEARCH_INDEX
+from api.segments import SEGMENT_STORE
+from api.serialization import render
+from api.storage import INTERNAL_FIELDS, OVERFLOW_PROJECTION, canonical_json, drop_overflow, overflow, presentation
+
+LOGGER = logging.getLogger(__name__)
+# segments of a streamed file sent to the client and written to storage at a time.
+SEGMENTS_STREAM_CHUNK = int(os.environ.get('SEGMENTS_STREAM_CHUNK', 1000))
+# chunks sent but not yet stored a stream may buffer. A file whose storage falls further behind is not stored.
+SEGMENTS_STREAM_BUFFER = int(os.environ.get('SEGMENTS_STREAM_BUFFER', 4))
+STREAMS = METRICS.counter('segment_streams_total', "Files fetched with their segments streamed, by outcome.", ['outcome'])
+EMPTY_SEGMENTS = '"segments":[]'
+
+
+def around_segments(body):
+    """
+    What goes before and after the segments in a body rendered with empty segments.
+    """
+    empty = EMPTY_SEGMENTS.encode('utf-8') if isinstance(body, bytes) else EMPTY_SEGMENTS
+    before, after = body.split(empty, 1)
+    return before + empty[:-1], empty[-1:] + after
+
+
+def chunked(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StreamWriter(object):
+    """
+    Stores a file a chunk of segments at a time, the way save_file() stores it whole.
+
+    The rendered body and the segments go to GridFS as they come: the body as it
+    is sent, the segments as a sequence of packed chunks, see api.columnar.unpack_chunks().
+    The ETag is hashed along. The segments are written to their collection and
+    indexed chunk by chunk, tagged with the generation of the writer so that the
+    segments the file no longer has are pruned without keeping their ids.
+    The file document is replaced once the last chunk is in.
+    """
+    def __init__(self, son, model=FileModel):
+        self.son = son
+        self.model = model
+        self.file_id = son['_id']
+        self.count = 0
+        self.stored = False
+        self.generation = ObjectId()
+        bucket = overflow(model)
+        self.rendered = bucket.new_file(fileId=self.file_id)
+        self.chunks = bucket.new_file(fileId=self.file_id)
+        self.etag = hashlib.sha256()
+
+        canonical, self.canonical_after = around_segments(
+            canonical_json({k: v for k, v in son.items() if k not in INTERNAL_FIELDS})
+        )
+        self.etag.update(canonical.encode('utf-8'))
+        rendered, self.rendered_after = around_segments(render(presentation(dict(son))))
+        self.rendered.write(rendered)
+
+    def write(self, segments, rendered):
+        """
+        @param rendered: the segments as the body renders them, without the brackets.
+        """
+        self.model.segments.validate(segments)
+        segments = self.model.segments.to_mongo(segments)
+        separator = ',' if self.count else ''
+        self.rendered.write(separator.encode('utf-8') + rendered)
+        self.etag.update((separator + canonical_json(segments)[1:-1]).encode('utf-8'))
+        self.chunks.write(BSON.encode(pack_segments(self.file_id, segments) or {'count': len(segments), 'segments': segments}))
+        SEGMENT_STORE.write(self.file_id, segments, self.generation)
+        SEARCH_INDEX.index_file(self.file_id, segments, replace=not self.count)
+        self.count += len(segments)
+
+    def finish(self):
+        if not self.count:
+            # a file without segments does not validate, as in save_file().
+            self.model.segments.validate([])
+        self.rendered.write(self.rendered_after)
+        self.rendered.close()
+        self.chunks.close()
+        self.etag.update(self.canonical_after.encode('utf-8'))
+
+        son = self.son
+        del son['segments']
+        son['fetchedAt'] = datetime.datetime.utcnow()
+        son['etag'] = self.etag.hexdigest()[:32]
+        son['renderedFile'] = self.rendered._id
+        son['segmentsPacked'] = {'v': VERSION, 'count': self.count, 'chunks': self.chunks._id}
+        replaced = self.model._mongometa.collection.find_one_and_replace(
+            {'_id': self.file_id}, son, projection=OVERFLOW_PROJECTION, upsert=True
+        )
+        self.stored = True
+        drop_overflow(replaced, son, self.model)
+        SEGMENT_STORE.prune_generation(self.file_id, self.generation)
+        if not self.count:
+            SEARCH_INDEX.index_file(self.file_id, [])
+        FILE_CACHE.invalidate(self.file_id)
+
+    def abort(self):
+        """
+        Drop what was written, unless the file document refers to it already.
+        The segments written so far are removed too, the segments of a file
+        stored before are backfilled from its document on first use.
+        """
+        if self.stored:
+            return
+        try:
+            self.rendered.abort()
+            self.chunks.abort()
+            SEGMENT_STORE.prune(self.file_id, [])
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not clean up the streamed file {self.file_id}. {str(e)}.")
+
+
+class StreamedFile(object):
+    """
+    A file fetched on a cold miss whose segments are too large to be read whole.
+
+    The segments are parsed from the processing API response as they arrive, see
+    api.external_api.SegmentStream, and go out to the client a chunk of chunk_size
+    segments at a time. Each chunk sent is handed to a green thread that stores it,
+    so a slow write does not hold up the client nor the upstream connection.
+    A request holds at most buffer_size chunks not yet stored in memory whatever the
+    no. of segments, a file whose storage falls further behind is sent but not stored.
+    The body is the same bytes render() makes of the whole file. A file that does not
+    validate, or that storage fails for, is still sent but not stored.
+
+    One request of the worker claims the stream and sends it, the others wait()
+    until it is stored and read it from storage.
+    """
+    def __init__(self, the_file, segments, model=FileModel, chunk_size=SEGMENTS_STREAM_CHUNK,
+                 buffer_size=SEGMENTS_STREAM_BUFFER, on_done=None):
+        """
+        @param the_file: the file with its details, without its segments.
+        @param segments: iterable of the segments, closed once read.
+        @param on_done: called once the file is stored or will not be, e.g. to release its fetch lease.
+        """
+        from gevent.event import Event
+
+        self.the_file = the_file
+        self.segments = segments
+        self.model = model
+        self.chunk_size = chunk_size
+        self.buffer_size = max(buffer_size, 1)
+        self.on_done = on_done
+        self.file_id = the_file['fileId']
+        self.stored = False
+        self._sent = False
+        self._started = False
+        self._claimed = False
+        self._done = Event()
+
+    def claim(self):
+        if self._claimed:
+            return False
+        self._claimed = True
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Block until the file is stored or will not be. Returns whether it was stored.
+        """
+        self._done.wait(timeout)
+        return self.stored
+
+    def drain(self):
+        """
+        Read and store the file without sending it.
+        """
+        for _ in self.body():
+            pass
+        return self.wait()
+
+    def close(self):
+        """
+        Let go of a stream that was claimed but not sent.
+        """
+        if not self._started:
+            self._started = True
+            self.segments.close()
+            self._finish()
+
+    def _finish(self):
+        """
+        The file is stored or will not be.
+        """
+        STREAMS.inc(outcome=('stored' if self.stored else 'not_stored') if self._sent else 'aborted')
+        self._done.set()
+        if self.on_done is not None:
+            try:
+                self.on_done()
+            except Exception as e:
+                LOGGER.warning(f"Callback of the streamed file {self.file_id} failed. {str(e)}.")
+
+    def _writer(self):
+        try:
+            instance = self.model(**dict(self.the_file, segments=[]))
+            # the segments are validated a chunk at a time.
+            instance.full_clean(exclude=['segments'])
+            return StreamWriter(instance.to_son(), self.model)
+        except Exception as e:
+            LOGGER.error(f"Not storing streamed file {self.file_id}. {str(e)}.")
+            return None
+
+    def _write(self, writer, segments, rendered):
+        try:
+            writer.write(segments, rendered)
+            return writer
+        except Exception as e:
+            LOGGER.error(f"Not storing streamed file {self.file_id}. {str(e)}.")
+            writer.abort()
+            return None
+
+    def _store(self, writer, chunks):
+        """
+        Write the chunks body() queues until it puts whether the body was sent whole.
+        """
+        try:
+            while True:
+                chunk = chunks.get()
+                if isinstance(chunk, bool):
+                    break
+                if writer is not None:
+                    writer = self._write(writer, *chunk)
+            if chunk and writer is not None:
+                writer.finish()
+        except Exception as e:
+            LOGGER.error(f"Could not store streamed file {self.file_id}. {str(e)}.")
+        finally:
+            if writer is not None:
+                writer.abort()
+                self.stored = writer.stored
+            self._finish()
+
+    def body(self):
+        """
+        The response body, generated a chunk of segments at a time. The file is stored after the last one.
+        """
+        import gevent
+        from gevent.queue import Queue
+
+        self._started = True
+        chunks = None
+        writer = self._writer()
+        if writer is not None:
+            chunks = Queue()
+            gevent.spawn(self._store, writer, chunks)
+        try:
+            before, after = around_segments(render(dict(self.the_file, segments=[])))
+            yield before
+            count = 0
+            for segments in chunked(self.segments, self.chunk_size):
+                rendered = render(segments)[1:-1]
+                yield (b',' if count else b'') + rendered
+                count += len(segments)
+                if chunks is not None and chunks.qsize() >= self.buffer_size:
+                    LOGGER.error(f"Not storing streamed file {self.file_id}, storage falls behind.")
+                    chunks.put(False)
+                    chunks = None
+                if chunks is not None:
+                    chunks.put((segments, rendered))
+                    # let the writer start on it, sending does not yield if the socket takes the chunk at once.
+                    gevent.sleep(0)
+            yield after
+            self._sent = True
+            LOGGER.info(f"Streamed {count} segments of {self.file_id}.")
+        except Exception as e:
+            # the client gets a truncated body.
+            LOGGER.error(f"Streaming the segments of {self.file_id} failed. {str(e)}.")
+            raise
+        finally:
+            self.segments.close()
+            if chunks is not None:
+                chunks.put(self._sent)
+            elif writer is None:
+                self._finish()
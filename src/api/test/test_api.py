@@ -59,13 +59,23 @@ SEGMENTS = {
 class FileDetailsAPITestCase(unittest.TestCase):
     def setUp(self):
         from pymodm import connect
-        from api.models import FileModel
+        from api.models import CatalogEntryModel, FileModel, NegativeCacheModel
 
         self.model = FileModel
+        self.catalog_model = CatalogEntryModel
+        self.negative_cache_model = NegativeCacheModel
         connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
 
     def tearDown(self):
+        from api.cache import FILE_CACHE
+        from api.write_behind import SAVE_QUEUE
+
+        # saves queued by the test land before the collections are emptied.
+        SAVE_QUEUE.drain()
         self.model.objects.all().delete()
+        self.catalog_model.objects.all().delete()
+        self.negative_cache_model.objects.all().delete()
+        FILE_CACHE.clear()
 
     @patch('api.jobs.ProcessingAPIAdapter')
     def test_processing_file_is_bad_request(self, MockAPIClass):
@@ -139,6 +149,25 @@ class FileDetailsAPITestCase(unittest.TestCase):
             rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
             self.assertEqual(rv.status_code, 201)
 
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_fetched_file_is_saved_after_the_response(self, MockAPIClass):
+        from api.write_behind import SAVE_QUEUE
+
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        mock_instance.fetch_segments.return_value = SEGMENTS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(rv.status_code, 201)
+            # the file is served from the queue until it is saved, without another upstream fetch.
+            queued = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(queued.status_code, 200)
+            self.assertEqual(queued.get_json()['seriesTitle'], rv.get_json()['seriesTitle'])
+            self.assertEqual(mock_instance.fetch_details.call_count, 1)
+        SAVE_QUEUE.drain()
+        self.assertEqual(self.model.objects.raw({'_id': '4a551eec-7dac-46d2-8f17-b6972b864b34'}).count(), 1)
+
     @patch('api.jobs.ProcessingAPIAdapter')
     def test_value_in_storage_is_not_fetched_from_api(self, MockAPIClass):
         the_file = {
@@ -167,3 +196,108 @@ class FileDetailsAPITestCase(unittest.TestCase):
         with app.test_client() as c:
             rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
             self.assertEqual(rv.status_code, 200)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_processing_file_is_negatively_cached(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/3cd97393-b441-4d7c-a58f-ec40fa2fee50')
+            self.assertEqual(rv.status_code, 400)
+            calls = mock_instance.fetch_all.call_count
+            rv = c.get('/api/presentation/files/3cd97393-b441-4d7c-a58f-ec40fa2fee50')
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual(mock_instance.fetch_all.call_count, calls)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_not_found_file_is_negatively_cached(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/abcd1234')
+            self.assertEqual(rv.status_code, 404)
+            calls = mock_instance.fetch_all.call_count
+            rv = c.get('/api/presentation/files/abcd1234')
+            self.assertEqual(rv.status_code, 404)
+            self.assertEqual(mock_instance.fetch_all.call_count, calls)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_refresh_skips_negative_cache(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        mock_instance.fetch_segments.return_value = SEGMENTS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        with app.test_client() as c:
+            mock_instance.fetch_all.return_value = []
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(rv.status_code, 404)
+            mock_instance.fetch_all.return_value = FILES
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(rv.status_code, 404)
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34?refresh=true')
+            self.assertEqual(rv.status_code, 201)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_batch_resolves_each_file(self, MockAPIClass):
+        self.model(
+            fileId="08448513-b980-4267-abeb-2445b4069a0c", processingStatus="FINISHED", fileName="stored"
+        ).save()
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        mock_instance.fetch_segments.return_value = SEGMENTS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        file_ids = [
+            "08448513-b980-4267-abeb-2445b4069a0c",
+            "4a551eec-7dac-46d2-8f17-b6972b864b34",
+            "3cd97393-b441-4d7c-a58f-ec40fa2fee50",
+            "abcd1234",
+        ]
+        with app.test_client() as c:
+            rv = c.post('/api/presentation/files:batch', json={'fileIds': file_ids})
+            self.assertEqual(rv.status_code, 200)
+            statuses = [f['status'] for f in rv.get_json()['files']]
+            self.assertEqual(statuses, [200, 201, 400, 404])
+        self.assertEqual(self.model.objects.raw({'_id': '4a551eec-7dac-46d2-8f17-b6972b864b34'}).count(), 1)
+
+    def test_batch_without_file_ids_is_bad_request(self):
+        with app.test_client() as c:
+            rv = c.post('/api/presentation/files:batch', json={'fileIds': []})
+            self.assertEqual(rv.status_code, 400)
+
+    def test_sparse_fields_are_projected(self):
+        from api.storage import save_file
+
+        save_file(dict(
+            FILE_DETAILS['4a551eec-7dac-46d2-8f17-b6972b864b34'],
+            fileId='4a551eec-7dac-46d2-8f17-b6972b864b34',
+            processingStatus='FINISHED',
+            segments=SEGMENTS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        ))
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34?fields=processingStatus,seriesTitle&segments=count')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json(), {
+                'fileId': '4a551eec-7dac-46d2-8f17-b6972b864b34',
+                'processingStatus': 'FINISHED',
+                'seriesTitle': 'Royally Obsessed',
+                'segmentCount': 1,
+            })
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_cold_miss_without_segments_defers_segments(self, MockAPIClass):
+        import gevent
+
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        mock_instance.fetch_segments.return_value = SEGMENTS['4a551eec-7dac-46d2-8f17-b6972b864b34']
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34?fields=mp3Path')
+            self.assertEqual(rv.status_code, 201)
+            self.assertNotIn('segments', rv.get_json())
+            mock_instance.fetch_segments.assert_not_called()
+
+        # the segments are fetched and the whole file stored in the background.
+        gevent.sleep(0.1)
+        mock_instance.fetch_segments.assert_called_once()
+        self.assertEqual(len(self.model.objects.get({'_id': '4a551eec-7dac-46d2-8f17-b6972b864b34'}).segments), 1)
@@ -0,0 +1,153 @@
+import json
+import asyncio
+import logging
+import unittest
+from itertools import count
+from unittest.mock import MagicMock, patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.asgi import PresentationASGI
+from api.async_jobs import AsyncioJobs
+from api.coalesce import AsyncFetchCoalescer
+from api.test.test_async_jobs import FILE_ID, FakeAPI, FakeCatalog, run
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FakeLease(object):
+    poll_interval = 0.01
+
+    def __init__(self):
+        self.tokens = count()
+        self.released = []
+
+    def acquire(self, key):
+        return next(self.tokens)
+
+    def release(self, key, token):
+        self.released.append(key)
+
+    def is_held(self, key):
+        return False
+
+
+class FakeCursor(object):
+    async def to_list(self, length):
+        return []
+
+
+class FakeCollection(object):
+    """
+    A motor collection of an empty database.
+    """
+    async def find_one(self, *args, **kwargs):
+        return None
+
+    def find(self, *args, **kwargs):
+        return FakeCursor()
+
+
+class FakeDatabase(object):
+    def collection(self, model):
+        return FakeCollection()
+
+
+async def call(app, method, path, query=b'', body=b''):
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': []}
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(b''.join(m.get('body', b'') for m in sent[1:]))
+
+
+@patch('api.asgi.index_segments')
+@patch('api.asgi.save_files', return_value={})
+@patch('api.asgi.save_file')
+@patch('api.asgi.NEGATIVE_CACHE', **{'check_many.return_value': {}})
+@patch('api.asgi.SAVE_QUEUE', **{'put.return_value': False, 'pending.return_value': None})
+class PresentationASGITestCase(unittest.TestCase):
+    """
+    The requests the Flask app would answer with green threads are served on the event loop.
+    """
+    def setUp(self):
+        self.api = FakeAPI(found_at=0)
+        self.lease = FakeLease()
+        model = MagicMock()
+        # nothing stored.
+        model._mongometa.collection.find_one.return_value = None
+        model._mongometa.collection.aggregate.return_value = []
+        self.app = PresentationASGI(
+            strategy_class=lambda: AsyncioJobs(processing_api=self.api, catalog=FakeCatalog()),
+            model=model,
+            database=FakeDatabase(),
+            coalescer=AsyncFetchCoalescer(lease=self.lease),
+        )
+        self.app._fallback = None
+
+    def request(self, method, path, query=b'', body=b''):
+        async def handle():
+            response = await call(self.app, method, path, query, body)
+            # the background tasks of the request.
+            await asyncio.gather(*self.app._tasks)
+            return response
+        return run(handle())
+
+    def test_sparse_cold_miss(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        status, body = self.request('GET', f'/api/presentation/files/{FILE_ID}', b'fields=fileName&segments=count')
+        self.assertEqual(status, 201)
+        self.assertEqual(body, {'fileId': FILE_ID, 'fileName': "name", 'segmentCount': 1})
+        self.assertEqual(save_file.call_args[0][0]['segments'], [{"fileSegmentId": 1}])
+
+    def test_deferred_segments_are_stored_in_a_task(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        status, body = self.request('GET', f'/api/presentation/files/{FILE_ID}', b'fields=fileName')
+        self.assertEqual(status, 201)
+        self.assertEqual(body, {'fileId': FILE_ID, 'fileName': "name"})
+        self.assertEqual(save_file.call_args[0][0]['segments'], [{"fileSegmentId": 1}])
+
+    def test_deferred_fetch_is_coalesced_and_keeps_the_lease(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        self.api.delay = 0.01
+        path = f'/api/presentation/files/{FILE_ID}'
+
+        async def handle():
+            deferring = asyncio.ensure_future(call(self.app, 'GET', path, b'fields=fileName'))
+            while FILE_ID not in self.app._coalescer._calls:
+                await asyncio.sleep(0.001)
+            responses = await asyncio.gather(deferring, call(self.app, 'GET', path, b'fields=fileName'), call(self.app, 'GET', path))
+            await asyncio.gather(*self.app._tasks)
+            return responses
+
+        sparse, other, full = run(handle())
+        self.assertEqual(sparse, (201, {'fileId': FILE_ID, 'fileName': "name"}))
+        self.assertEqual(other, sparse)
+        # one scan deferring the segments, shared by the sparse requests. The full request
+        # scans again as FakeLease never makes it wait for the held lease.
+        self.assertEqual(self.api.pages.count(0), 2)
+        # the full request joined the deferred fetch and waited for the segments.
+        self.assertEqual(full[1]['segments'], [{"fileSegmentId": 1}])
+        self.assertEqual(self.lease.released, [FILE_ID, FILE_ID])
+
+    def test_invalid_fieldset(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        status, body = self.request('GET', f'/api/presentation/files/{FILE_ID}', b'segments=some')
+        self.assertEqual(status, 400)
+        self.assertTrue(body['error'].startswith("Invalid query parameter."))
+
+    def test_batch(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        status, body = self.request(
+            'POST', '/api/presentation/files:batch', body=json.dumps({'fileIds': [FILE_ID, 'missing']}).encode()
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual([(f['fileId'], f['status']) for f in body['files']], [(FILE_ID, 201), ('missing', 404)])
+        self.assertEqual([f['fileId'] for f in save_files.call_args[0][0]], [FILE_ID])
+
+    def test_batch_without_file_ids(self, save_queue, negative_cache, save_file, save_files, index_segments):
+        status, body = self.request('POST', '/api/presentation/files:batch', body=b'not json')
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': "fileIds must be a non empty list of file ids."})
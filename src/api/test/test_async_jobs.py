@@ -0,0 +1,164 @@
+import time
+import asyncio
+import logging
+import unittest
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.async_jobs import CATALOG_WRITES, AsyncioJobs
+from api.exceptions import APIException, FileInvalidStatusError, FileNotFound
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class FakeAPI(object):
+    """
+    A processing API with a file on one page, answering after delay seconds.
+    """
+    def __init__(self, found_at=None, status='FINISHED', delay=0, error=None):
+        self.found_at = found_at
+        self.status = status
+        self.delay = delay
+        self.error = error
+        self.pages = []
+        self.cancelled = 0
+
+    async def call(self, value):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return value
+
+    async def fetch_all(self, limit=5, offset=0):
+        self.pages.append(offset)
+        if offset == self.found_at:
+            return await self.call([{"fileId": FILE_ID, "processingStatus": self.status}])
+        return await self.call([{"fileId": f"other-{offset}", "processingStatus": "FINISHED"}])
+
+    async def fetch_details(self, file_id):
+        return await self.call({"fileName": "name"})
+
+    async def fetch_segments(self, file_id):
+        return await self.call([{"fileSegmentId": 1}])
+
+
+class FakeCatalog(object):
+    def __init__(self, offset=None):
+        self.offset = offset
+        self.recorded = []
+
+    async def lookup(self, file_id, limit=5):
+        return self.offset
+
+    async def lookup_many(self, file_ids, limit=5):
+        return {f: self.offset for f in file_ids} if self.offset is not None else {}
+
+    async def record_pages(self, pages):
+        self.recorded.extend(pages)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AsyncioJobsScanTestCase(unittest.TestCase):
+    def strategy(self, api, catalog=None):
+        return AsyncioJobs(processing_api=api, catalog=catalog or FakeCatalog())
+
+    def test_scan_stops_after_window_with_finished_file(self):
+        api = FakeAPI(found_at=7)
+        catalog = FakeCatalog()
+        the_file = run(self.strategy(api, catalog).scan_file(FILE_ID, max_pages=200, window=5, pool_size=5))
+        self.assertEqual(the_file['fileId'], FILE_ID)
+        self.assertEqual(len(api.pages), 10)
+        # the pages are recorded in a task of their own.
+        run(asyncio.gather(*CATALOG_WRITES))
+        self.assertIn(7, [offset for _, offset, _ in catalog.recorded])
+
+    def test_scan_without_finished_file_is_invalid_status(self):
+        api = FakeAPI(found_at=150, status='PROCESSING')
+        with self.assertRaises(FileInvalidStatusError):
+            run(self.strategy(api).scan_file(FILE_ID, max_pages=200, window=5, pool_size=5))
+        self.assertEqual(len(api.pages), 201)
+
+    def test_scan_without_file_is_not_found(self):
+        with self.assertRaises(FileNotFound):
+            run(self.strategy(FakeAPI()).scan_file(FILE_ID, max_pages=20, window=5, pool_size=2))
+
+    def test_scan_with_all_errors_is_api_exception(self):
+        with self.assertRaises(APIException):
+            run(self.strategy(FakeAPI(error=APIException())).scan_file(FILE_ID, max_pages=20, window=5, pool_size=5))
+
+    def test_catalog_page_is_fetched_first(self):
+        api = FakeAPI(found_at=42)
+        the_file = run(self.strategy(api, FakeCatalog(offset=42)).fetch_file(FILE_ID))
+        self.assertEqual(the_file['fileId'], FILE_ID)
+        self.assertEqual(api.pages, [42])
+
+
+class AsyncioJobsBundleTestCase(unittest.TestCase):
+    def test_bundle_fetches_details_and_segments_alongside_scan(self):
+        strategy = AsyncioJobs(processing_api=FakeAPI(found_at=0, delay=0.2), catalog=FakeCatalog())
+        start_time = time.time()
+        the_file = run(strategy.fetch_file_bundle(FILE_ID, max_pages=0))
+        self.assertLess(time.time() - start_time, 0.5)
+        self.assertEqual(the_file['fileName'], "name")
+        self.assertEqual(the_file['segments'], [{"fileSegmentId": 1}])
+
+    def test_bundle_without_segments(self):
+        strategy = AsyncioJobs(processing_api=FakeAPI(found_at=0), catalog=FakeCatalog())
+        the_file = run(strategy.fetch_file_bundle(FILE_ID, max_pages=0, segments=False))
+        self.assertNotIn('segments', the_file)
+
+    def test_bundle_cancels_speculative_calls_when_not_found(self):
+        api = FakeAPI(delay=0.05)
+        api.fetch_details = lambda file_id: asyncio.sleep(10)
+        strategy = AsyncioJobs(processing_api=api, catalog=FakeCatalog())
+        start_time = time.time()
+        with self.assertRaises(FileNotFound):
+            run(strategy.fetch_file_bundle(FILE_ID, max_pages=2))
+        self.assertLess(time.time() - start_time, 1)
+
+    def test_details_error_is_api_exception(self):
+        api = FakeAPI(found_at=0)
+
+        async def fail(file_id):
+            raise ConnectionError()
+        api.fetch_details = fail
+        with self.assertRaises(APIException):
+            run(AsyncioJobs(processing_api=api, catalog=FakeCatalog()).fetch_file_bundle(FILE_ID, max_pages=0))
+
+
+class AsyncioJobsBatchTestCase(unittest.TestCase):
+    def test_batch_shares_one_scan(self):
+        api = FakeAPI(found_at=3)
+        results = run(AsyncioJobs(processing_api=api, catalog=FakeCatalog()).fetch_files_bundle(
+            [FILE_ID, 'other-1', 'missing'], max_pages=5
+        ))
+        self.assertEqual(results[FILE_ID]['segments'], [{"fileSegmentId": 1}])
+        self.assertEqual(results['other-1']['fileName'], "name")
+        self.assertIsInstance(results['missing'], FileNotFound)
+        self.assertEqual(sorted(api.pages), [0, 1, 2, 3, 4, 5])
+
+    def test_batch_stops_once_every_file_is_seen(self):
+        api = FakeAPI(found_at=0)
+        results = run(AsyncioJobs(processing_api=api, catalog=FakeCatalog(offset=0)).fetch_files_bundle([FILE_ID]))
+        self.assertEqual(results[FILE_ID]['fileName'], "name")
+        self.assertEqual(api.pages, [0])
+
+    def test_batch_details_error_is_per_file(self):
+        api = FakeAPI(found_at=0, status='PROCESSING')
+
+        async def fail(file_id):
+            raise ConnectionError()
+        api.fetch_details = fail
+        results = run(AsyncioJobs(processing_api=api, catalog=FakeCatalog()).fetch_files_bundle(
+            [FILE_ID, 'other-1'], max_pages=1
+        ))
+        self.assertIsInstance(results[FILE_ID], FileInvalidStatusError)
+        self.assertIsInstance(results['other-1'], APIException)
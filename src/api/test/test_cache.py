@@ -0,0 +1,283 @@
+import os
+import fcntl
+import datetime
+import logging
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import gevent
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.cache import LRUCache
+from api.compression import brotli
+from api.shared_cache import SharedMemoryCache, SharedResponseCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_evicts_least_recently_used_by_count(self):
+        cache = LRUCache(max_entries=2, max_bytes=1024, ttl=60, clock=self.clock)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('a')
+        cache.set('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evicts_by_total_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=10, ttl=60, clock=self.clock)
+        cache.set('a', b'x' * 6)
+        cache.set('b', b'x' * 6)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 6)
+        self.assertFalse(cache.set('c', b'x' * 11))
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(max_entries=10, max_bytes=1024, ttl=60, clock=self.clock)
+        cache.set('a', b'1')
+        self.clock.now = 61
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_set_after_invalidation_is_dropped(self):
+        cache = LRUCache(max_entries=10, max_bytes=1024, ttl=60, clock=self.clock)
+        generation = cache.generation()
+        cache.invalidate('a')
+        self.assertFalse(cache.set('a', b'stale', generation))
+        self.assertIsNone(cache.get('a'))
+
+
+class SharedMemoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache(self, cls=SharedMemoryCache, max_bytes=4096):
+        # one 4 KiB page, 4 chunks of the 1 KiB slab class.
+        return cls(self.path, max_entries=64, max_bytes=max_bytes, ttl=60, page_size=4096, clock=self.clock)
+
+    def test_workers_share_entries(self):
+        worker, other = self.cache(), self.cache()
+        worker.set('a', b'1')
+        self.assertEqual(other.get('a'), b'1')
+        other.invalidate('a')
+        self.assertIsNone(worker.get('a'))
+        self.assertEqual(worker.stats()['entries'], 0)
+
+    def test_forked_worker_shares_entries(self):
+        cache = self.cache()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if cache.set('a', b'from child') else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(cache.get('a'), b'from child')
+
+    def test_clock_gives_read_entries_a_second_chance(self):
+        cache = self.cache()
+        for key in 'abcd':
+            self.assertTrue(cache.set(key, b'x' * 900))
+        for key in 'acd':
+            cache.get(key)
+        cache.set('e', b'x' * 900)
+        self.assertIsNone(cache.get('b'))
+        for key in 'acde':
+            self.assertIsNotNone(cache.get(key))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_slab_class_without_a_page_takes_one(self):
+        cache = self.cache()
+        cache.set('small', b'x' * 900)
+        self.assertTrue(cache.set('large', b'x' * 3000))
+        self.assertIsNone(cache.get('small'))
+        self.assertEqual(len(cache.get('large')), 3000)
+        self.assertFalse(cache.set('huge', b'x' * 4096))
+
+    def test_entries_expire_after_ttl(self):
+        cache = self.cache()
+        cache.set('a', b'1')
+        self.clock.now = 61
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_values_larger_than_a_page_take_a_chain_of_pages(self):
+        cache = self.cache(max_bytes=4 * 4096)
+        big = bytes(range(256)) * 30
+        self.assertTrue(cache.set('big', big))
+        self.assertEqual(cache.get('big'), big)
+        # at most half of the pages.
+        self.assertFalse(cache.set('huge', b'x' * 3 * 4096))
+        self.assertTrue(cache.set('other', b'y' * 7000))
+        cache.get('other')
+        # evicting a chain frees all of its pages.
+        self.assertTrue(cache.set('third', b'z' * 7000))
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual(cache.get('other'), b'y' * 7000)
+        self.assertEqual(cache.get('third'), b'z' * 7000)
+        self.assertEqual(cache.stats()['bytes'], 14000)
+        for i in range(8):
+            self.assertTrue(cache.set(f'small{i}', b's' * 900))
+        self.assertEqual(cache.get('small7'), b's' * 900)
+
+    def test_writer_waits_for_the_flock_without_blocking_the_worker(self):
+        cache = self.cache()
+        # another worker holds the lock.
+        fd = os.open(self.path, os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        writer = gevent.spawn(cache.set, 'a', b'1')
+        gevent.sleep(0.02)
+        self.assertFalse(writer.ready())
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        self.assertTrue(writer.get(timeout=1))
+        self.assertEqual(cache.get('a'), b'1')
+
+    def test_set_after_invalidation_in_another_worker_is_dropped(self):
+        worker, other = self.cache(), self.cache()
+        generation = worker.generation()
+        other.invalidate('a')
+        self.assertFalse(worker.set('a', b'stale', generation))
+        self.assertIsNone(other.get('a'))
+
+    def test_changed_settings_recreate_the_file(self):
+        self.cache().set('a', b'1')
+        self.assertIsNone(self.cache(max_bytes=8192).get('a'))
+
+    def test_responses_round_trip(self):
+        cache = self.cache(SharedResponseCache)
+        value = ('etag', {'identity': b'{"fileId": "a"}', 'gzip': b'\x1f\x8b'}, datetime.datetime(2021, 3, 1, 12, 0, 0, 123456))
+        self.assertTrue(cache.set('a', value, cache.generation(), size=17))
+        self.assertEqual(cache.get('a'), value)
+        cache.set('b', ('etag', {'identity': b'{}'}, None))
+        self.assertEqual(cache.get('b'), ('etag', {'identity': b'{}'}, None))
+
+    def test_large_responses_round_trip(self):
+        cache = self.cache(SharedResponseCache, max_bytes=4 * 4096)
+        value = ('etag', {'identity': b'{"segments": []}' * 400}, None)
+        self.assertTrue(cache.set('a', value))
+        self.assertEqual(cache.get('a'), value)
+
+
+class FileCacheAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel
+
+        self.model = FileModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+
+        self.model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_cache_hit_skips_storage(self, MockAPIClass):
+        from api.app import app
+
+        self.model(fileId="4a551eec-7dac-46d2-8f17-b6972b864b34", processingStatus="FINISHED", fileName="name").save()
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(rv.status_code, 200)
+            with patch.object(self.model, 'objects') as objects:
+                cached = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+                objects.get.assert_not_called()
+            self.assertEqual(cached.status_code, 200)
+            self.assertEqual(cached.get_data(), rv.get_data())
+
+    def test_matching_etag_is_not_modified(self):
+        from api.app import app
+        from api.storage import save_file
+
+        save_file({"fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34", "processingStatus": "FINISHED", "fileName": "name"})
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            self.assertEqual(rv.status_code, 200)
+            self.assertIsNotNone(rv.headers.get('ETag'))
+            self.assertNotIn(b'etag', rv.get_data())
+
+            with patch.object(self.model, 'objects') as objects:
+                not_modified = c.get(
+                    '/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34',
+                    headers={'If-None-Match': rv.headers['ETag']}
+                )
+                objects.get.assert_not_called()
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.get_data(), b'')
+
+    def test_compressed_body_is_cached(self):
+        import gzip
+        from api.app import app
+        from api.compression import compress
+        from api.storage import save_file
+
+        segments = [
+            {"fileSegmentId": i, "fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34",
+             "segmentText": "the quick brown fox", "startTime": i * 1000, "endTime": i * 1000 + 999}
+            for i in range(50)
+        ]
+        save_file({"fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34", "processingStatus": "FINISHED",
+                   "fileName": "name", "segments": segments})
+        with app.test_client() as c:
+            plain = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            with patch('api.app.compress', wraps=compress) as mock_compress:
+                for _ in range(2):
+                    rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34',
+                               headers={'Accept-Encoding': 'gzip'})
+                    self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+                    self.assertEqual(gzip.decompress(rv.get_data()), plain.get_data())
+                self.assertEqual(mock_compress.call_count, 1)
+            self.assertNotEqual(rv.headers['ETag'], plain.headers['ETag'])
+
+    @unittest.skipIf(brotli is None, "brotli is not installed.")
+    def test_brotli_is_served_to_clients_accepting_it(self):
+        from api.app import app
+        from api.storage import save_file
+
+        segments = [
+            {"fileSegmentId": i, "fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34",
+             "segmentText": "the quick brown fox", "startTime": i * 1000, "endTime": i * 1000 + 999}
+            for i in range(50)
+        ]
+        save_file({"fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34", "processingStatus": "FINISHED",
+                   "fileName": "name", "segments": segments})
+        with app.test_client() as c:
+            plain = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+            rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34',
+                       headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(rv.headers['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(rv.get_data()), plain.get_data())
+
+    def test_storage_hit_serves_pre_rendered_body(self):
+        import json
+        from api.app import app
+        from api.storage import save_file
+
+        save_file({"fileId": "4a551eec-7dac-46d2-8f17-b6972b864b34", "processingStatus": "FINISHED", "fileName": "name"})
+        with app.test_client() as c:
+            with patch.object(self.model, 'objects') as objects:
+                rv = c.get('/api/presentation/files/4a551eec-7dac-46d2-8f17-b6972b864b34')
+                objects.get.assert_not_called()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.get_data())['fileName'], "name")
+        self.assertNotIn(b'rendered', rv.get_data())
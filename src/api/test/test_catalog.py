@@ -0,0 +1,78 @@
+import logging
+import unittest
+from unittest.mock import patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.app import app
+from api.jobs import SCAN_WINDOW
+from api.test.test_api import FILES, FILE_DETAILS, SEGMENTS
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class FileCatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import CatalogEntryModel, FileModel
+
+        self.model = FileModel
+        self.catalog_model = CatalogEntryModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+        from api.write_behind import SAVE_QUEUE
+
+        # saves queued by the test land before the collections are emptied.
+        SAVE_QUEUE.drain()
+        self.model.objects.all().delete()
+        self.catalog_model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    def mock_api(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS[FILE_ID]
+        mock_instance.fetch_segments.return_value = SEGMENTS[FILE_ID]
+        return mock_instance
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_page_scan_records_catalog(self, MockAPIClass):
+        self.mock_api(MockAPIClass)
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 201)
+        entry = self.catalog_model.objects.get({'_id': FILE_ID})
+        self.assertEqual(entry.offset, 0)
+        self.assertEqual(entry.processingStatus, 'FINISHED')
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_catalog_hit_fetches_only_known_page(self, MockAPIClass):
+        import datetime
+
+        self.catalog_model(
+            fileId=FILE_ID, offset=7, limit=5, processingStatus='FINISHED', updatedAt=datetime.datetime.utcnow()
+        ).save()
+        mock_instance = self.mock_api(MockAPIClass)
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 201)
+        mock_instance.fetch_all.assert_called_once_with(5, 7)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_catalog_stale_page_falls_back_to_full_scan(self, MockAPIClass):
+        import datetime
+
+        self.catalog_model(
+            fileId=FILE_ID, offset=3, limit=5, processingStatus='FINISHED', updatedAt=datetime.datetime.utcnow()
+        ).save()
+        mock_instance = self.mock_api(MockAPIClass)
+        mock_instance.fetch_all.side_effect = lambda limit, offset: [] if offset == 3 else FILES
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 201)
+        # the stale catalog page, then the first window, every page of which has the file.
+        self.assertEqual(mock_instance.fetch_all.call_count, 1 + SCAN_WINDOW)
+        self.assertEqual(self.catalog_model.objects.get({'_id': FILE_ID}).offset, 0)
@@ -0,0 +1,208 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.coalesce import FetchCoalescer
+from api.test.test_api import FILES, FILE_DETAILS, SEGMENTS
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class FetchCoalescerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lease = MagicMock()
+        self.lease.acquire.return_value = 'token'
+        self.coalescer = FetchCoalescer(lease=self.lease)
+
+    def slow_fetch(self, result):
+        fetch = MagicMock()
+
+        def call():
+            import gevent
+
+            gevent.sleep(0.1)
+            return result
+        fetch.side_effect = call
+        return fetch
+
+    def test_concurrent_fetches_in_worker_share_one_call(self):
+        import gevent
+
+        fetch = self.slow_fetch(('file', 201))
+        jobs = [gevent.spawn(self.coalescer.fetch, FILE_ID, fetch, lambda: None) for _ in range(10)]
+        gevent.joinall(jobs)
+        self.assertEqual([j.value for j in jobs], [('file', 201)] * 10)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(self.coalescer.stats()['coalesced'], 9)
+
+    def test_followers_get_the_leader_exception(self):
+        import gevent
+        from api.exceptions import FileNotFound
+
+        def not_found():
+            gevent.sleep(0.1)
+            raise FileNotFound(f"File {FILE_ID} not found.")
+
+        fetch = MagicMock(side_effect=not_found)
+        jobs = [gevent.spawn(self.coalescer.fetch, FILE_ID, fetch, lambda: None) for _ in range(3)]
+        gevent.joinall(jobs)
+        self.assertTrue(all(isinstance(j.exception, FileNotFound) for j in jobs))
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_followers_are_released_when_the_leader_is_killed(self):
+        import gevent
+
+        fetch = self.slow_fetch(('file', 201))
+        leader = gevent.spawn(self.coalescer.fetch, FILE_ID, fetch, lambda: None)
+        gevent.sleep(0)
+        followers = [gevent.spawn(self.coalescer.fetch, FILE_ID, fetch, lambda: None) for _ in range(3)]
+        gevent.sleep(0)
+        leader.kill()
+        self.assertEqual(len(gevent.joinall(followers, timeout=1)), 3)
+        # gevent takes a GreenletExit for the value of a greenlet.
+        self.assertTrue(all(isinstance(j.value, gevent.GreenletExit) for j in followers))
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(self.coalescer._calls, {})
+
+    def test_lease_held_by_another_worker_serves_its_stored_file(self):
+        self.lease.acquire.return_value = None
+        fetch = self.slow_fetch(('file', 201))
+        result = self.coalescer.fetch(FILE_ID, fetch, lambda: ('stored', 200))
+        self.assertEqual(result, ('stored', 200))
+        self.lease.wait.assert_called_once_with(FILE_ID)
+        fetch.assert_not_called()
+
+
+class MemoryLease(object):
+    """
+    A FetchLease the workers of a test share, kept in memory.
+    """
+    poll_interval = 0.01
+
+    def __init__(self):
+        self.holders = {}
+
+    def acquire(self, key):
+        if key in self.holders:
+            return None
+        self.holders[key] = f'token-{len(self.holders)}'
+        return self.holders[key]
+
+    def release(self, key, token):
+        if self.holders.get(key) == token:
+            del self.holders[key]
+
+    def is_held(self, key):
+        return key in self.holders
+
+    def wait(self, key):
+        import gevent
+
+        while self.is_held(key):
+            gevent.sleep(self.poll_interval)
+
+
+@patch('api.write_behind.index_segments')
+@patch('api.write_behind.save_files')
+class LeaseHeldUntilStoredTestCase(unittest.TestCase):
+    """
+    Two workers sharing storage and the fetch lease, each with its own write-behind queue.
+    """
+    def setUp(self):
+        from api.write_behind import WriteBehindQueue
+
+        patcher = patch.object(WriteBehindQueue, '_ensure_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lease = MemoryLease()
+        self.stored = {}
+        self.upstream_calls = 0
+        self.workers = [(FetchCoalescer(lease=self.lease), WriteBehindQueue()) for _ in range(2)]
+
+    def save_files(self, files, model, index=True):
+        for the_file in files:
+            self.stored[the_file['fileId']] = the_file
+        return {}
+
+    def request(self, worker):
+        coalescer, queue = self.workers[worker]
+
+        def fetch():
+            self.upstream_calls += 1
+            the_file = {'fileId': FILE_ID, 'seriesTitle': "Royally Obsessed"}
+            queue.put(the_file, coalescer.hold(FILE_ID))
+            return the_file, 201
+
+        def load():
+            the_file = queue.pending(FILE_ID) or self.stored.get(FILE_ID)
+            return (the_file, 200) if the_file is not None else None
+
+        return coalescer.fetch(FILE_ID, fetch, load)
+
+    def test_other_worker_waits_for_the_queued_save(self, save_files, index_segments):
+        import gevent
+
+        save_files.side_effect = self.save_files
+        self.assertEqual(self.request(0)[1], 201)
+        self.assertTrue(self.lease.is_held(FILE_ID))
+        # the fetching worker answers from its queue meanwhile.
+        self.assertEqual(self.request(0)[1], 200)
+
+        other = gevent.spawn(self.request, 1)
+        gevent.sleep(0.05)
+        self.assertFalse(other.ready())
+        self.assertEqual(self.workers[0][1].flush(), 1)
+        other.join(1)
+        self.assertEqual(other.value[1], 200)
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertFalse(self.lease.is_held(FILE_ID))
+        self.assertEqual(self.workers[0][0].stats()['held'], 0)
+
+    def test_dropped_save_releases_the_lease(self, save_files, index_segments):
+        from pymodm.errors import ValidationError
+
+        save_files.return_value = {FILE_ID: ValidationError("invalid")}
+        self.request(0)
+        self.workers[0][1].flush()
+        self.assertFalse(self.lease.is_held(FILE_ID))
+
+
+class CoalescedFileDetailsAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel
+
+        self.model = FileModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+        from api.write_behind import SAVE_QUEUE
+
+        # saves queued by the test land before the collections are emptied.
+        SAVE_QUEUE.drain()
+        self.model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_concurrent_requests_cost_one_upstream_fetch(self, MockAPIClass):
+        import gevent
+        from api.app import app
+
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = FILES
+        mock_instance.fetch_details.return_value = FILE_DETAILS[FILE_ID]
+        mock_instance.fetch_segments.return_value = SEGMENTS[FILE_ID]
+
+        def request():
+            with app.test_client() as c:
+                return c.get(f'/api/presentation/files/{FILE_ID}').status_code
+
+        jobs = [gevent.spawn(request) for _ in range(10)]
+        gevent.joinall(jobs)
+        self.assertEqual(set(j.value for j in jobs), {201})
+        self.assertEqual(mock_instance.fetch_details.call_count, 1)
+        self.assertEqual(mock_instance.fetch_segments.call_count, 1)
@@ -0,0 +1,181 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from bson import BSON, ObjectId
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.columnar import pack_segments, unpack_segments
+from api.storage import SEGMENTS_LIST, SEGMENTS_PACKED, pack_file, presentation, render_file, unpack_file
+from api.test.test_api import FILE_DETAILS, SEGMENTS
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+SEGMENT = SEGMENTS[FILE_ID][0]
+
+
+def segments(count):
+    return [
+        dict(SEGMENT, fileSegmentId=SEGMENT['fileSegmentId'] + i, startTime=i * 4000, endTime=i * 4000 + 3999,
+             segmentText=f"{SEGMENT['segmentText']} Épisode {i} ✓")
+        for i in range(count)
+    ]
+
+
+def document(count):
+    return dict({'_id': FILE_ID, 'processingStatus': 'FINISHED', 'segments': segments(count)}, **FILE_DETAILS[FILE_ID])
+
+
+class FakeBucket(object):
+    """
+    The part of GridFS pack_file() and unpack_file() use.
+    """
+    def __init__(self):
+        self.files = {}
+
+    def put(self, data, **kwargs):
+        grid_id = ObjectId()
+        self.files[grid_id] = data
+        return grid_id
+
+    def get(self, grid_id):
+        return MagicMock(read=MagicMock(return_value=self.files[grid_id]))
+
+
+class ColumnarTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        for count in (0, 1, 100):
+            packed = pack_segments(FILE_ID, segments(count))
+            self.assertEqual(packed['count'], count)
+            self.assertEqual(unpack_segments(FILE_ID, packed), segments(count))
+
+    def test_page(self):
+        packed = pack_segments(FILE_ID, segments(10))
+        self.assertEqual(unpack_segments(FILE_ID, packed, 3, 5), segments(10)[3:5])
+        self.assertEqual(unpack_segments(FILE_ID, packed, 8, 20), segments(10)[8:])
+        self.assertEqual(unpack_segments(FILE_ID, packed, 20, 30), [])
+
+    def test_wide_ints_and_missing_keys(self):
+        wide = [{'fileSegmentId': 2 ** 40 + i, 'startTime': -i} for i in range(3)]
+        self.assertEqual(unpack_segments(FILE_ID, pack_segments(FILE_ID, wide)), wide)
+
+    def test_segments_that_would_not_round_trip_are_not_packed(self):
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, speaker='host')]))
+        self.assertIsNone(pack_segments(FILE_ID, [SEGMENT, {'fileSegmentId': 1}]))
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, fileId='another')]))
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, startTime=1.5)]))
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, startTime=True)]))
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, startTime=2 ** 64)]))
+        self.assertIsNone(pack_segments(FILE_ID, [dict(SEGMENT, segmentText=None)]))
+
+
+class PackFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket()
+        patcher = patch('api.storage.overflow', return_value=self.bucket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self, son, segments_format, max_bytes):
+        son = pack_file(render_file(son), segments_format=segments_format, max_bytes=max_bytes)
+        # what a read of the document returns.
+        return BSON(BSON.encode(son)).decode()
+
+    def test_packed_document_is_smaller_and_reads_back_the_same(self):
+        as_list = self.stored(document(200), SEGMENTS_LIST, 0)
+        packed = self.stored(document(200), SEGMENTS_PACKED, 0)
+        self.assertNotIn('segments', packed)
+        self.assertLess(len(BSON.encode(dict(packed, rendered=b''))), len(BSON.encode(dict(as_list, rendered=b''))) / 2)
+        self.assertEqual(packed['etag'], as_list['etag'])
+        self.assertEqual(bytes(packed['rendered']), bytes(as_list['rendered']))
+        self.assertEqual(unpack_file(packed), as_list)
+
+    def test_unpackable_segments_are_stored_as_a_list(self):
+        son = dict(document(2), segments=[dict(SEGMENT, speaker='host')])
+        self.assertEqual(self.stored(son, SEGMENTS_PACKED, 0)['segments'], son['segments'])
+
+    def test_large_document_moves_body_then_segments_to_gridfs(self):
+        body = render_file(document(200))['rendered']
+        as_list = self.stored(document(200), SEGMENTS_LIST, 1)
+        self.assertNotIn('rendered', as_list)
+        self.assertIn('segments', as_list)
+        packed = self.stored(document(200), SEGMENTS_PACKED, 1)
+        self.assertNotIn('rendered', packed)
+        self.assertEqual(set(packed['segmentsPacked']), {'v', 'count', 'keys', 'file'})
+        self.assertEqual(len(self.bucket.files), 3)
+
+        son = unpack_file(packed)
+        self.assertEqual(bytes(son['rendered']), body)
+        self.assertEqual(son['segments'], document(200)['segments'])
+        self.assertEqual(presentation(son), presentation(unpack_file(as_list)))
+
+    def test_document_under_the_threshold_stays_whole(self):
+        packed = self.stored(document(10), SEGMENTS_PACKED, 16 * 1024 * 1024)
+        self.assertIn('rendered', packed)
+        self.assertIn('text', packed['segmentsPacked'])
+        self.assertEqual(self.bucket.files, {})
+
+
+class PackedStorageAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel
+
+        self.model = FileModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+
+        self.model.objects.all().delete()
+        for suffix in ('files', 'chunks'):
+            self.overflow_collection(suffix).delete_many({})
+        FILE_CACHE.clear()
+
+    def overflow_collection(self, suffix='files'):
+        from api.storage import OVERFLOW_BUCKET
+
+        return self.model._mongometa.collection.database[f'{OVERFLOW_BUCKET}.{suffix}']
+
+    def responses(self):
+        from api.app import app
+        from api.cache import FILE_CACHE
+
+        FILE_CACHE.clear()
+        with app.test_client() as c:
+            return [c.get(f'/api/presentation/files/{FILE_ID}{query}').data for query in (
+                '', '?fields=seriesTitle,segments', '?segments=count', '?segments=page&offset=5&limit=10'
+            )] + [c.post('/api/presentation/files:batch', json={'fileIds': [FILE_ID]}).data]
+
+    def save(self, segments_format, max_bytes):
+        from api.storage import save_file
+
+        with patch('api.storage.SEGMENTS_FORMAT', segments_format), patch('api.storage.FILE_DOCUMENT_MAX_BYTES', max_bytes):
+            save_file(dict(document(50), fileId=FILE_ID), self.model)
+
+    def test_responses_are_byte_identical(self):
+        self.save(SEGMENTS_LIST, 16 * 1024 * 1024)
+        expected = self.responses()
+        for segments_format, max_bytes in ((SEGMENTS_PACKED, 16 * 1024 * 1024), (SEGMENTS_PACKED, 1), (SEGMENTS_LIST, 1)):
+            self.save(segments_format, max_bytes)
+            self.assertEqual(self.responses(), expected)
+
+    def test_replaced_overflow_is_deleted(self):
+        self.save(SEGMENTS_PACKED, 1)
+        self.assertEqual(self.overflow_collection().count_documents({}), 2)
+        self.save(SEGMENTS_PACKED, 16 * 1024 * 1024)
+        self.assertEqual(self.overflow_collection().count_documents({}), 0)
+
+    def test_migration_keeps_the_responses(self):
+        from api.migrate_segments import migrate
+
+        self.save(SEGMENTS_LIST, 16 * 1024 * 1024)
+        expected = self.responses()
+        report = migrate(SEGMENTS_PACKED, self.model)
+        self.assertEqual(report['migrated'], 1)
+        self.assertLess(report['bytesAfter'], report['bytesBefore'])
+        self.assertIn('segmentsPacked', self.model._mongometa.collection.find_one({'_id': FILE_ID}))
+        self.assertEqual(self.responses(), expected)
+        self.assertEqual(migrate(SEGMENTS_LIST, self.model)['migrated'], 1)
+        self.assertEqual(self.responses(), expected)
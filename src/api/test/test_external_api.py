@@ -0,0 +1,55 @@
+import json
+import logging
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.external_api import PooledSession, ProcessingAPIAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FilesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps([]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PooledSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FilesHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def adapter(self, session_pool):
+        api = ProcessingAPIAdapter(session_pool=session_pool)
+        api._host = f'http://127.0.0.1:{self.server.server_port}'
+        return api
+
+    def test_sequential_calls_reuse_connection(self):
+        session_pool = PooledSession(pool_maxsize=2, keepalive_timeout=30)
+        for offset in range(5):
+            self.adapter(session_pool).fetch_all(offset=offset)
+        self.assertEqual(session_pool.stats(), {'requests': 5, 'new_connections': 1, 'reused_connections': 4})
+
+    def test_idle_session_is_dropped_after_keepalive_timeout(self):
+        session_pool = PooledSession(pool_maxsize=2, keepalive_timeout=30)
+        self.adapter(session_pool).fetch_all()
+        session_pool._last_used -= 60
+        self.adapter(session_pool).fetch_all()
+        self.assertEqual(session_pool.stats(), {'requests': 2, 'new_connections': 2, 'reused_connections': 0})
@@ -0,0 +1,50 @@
+import logging
+import unittest
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.fieldsets import FieldSet, SEGMENTS_ALL, SEGMENTS_COUNT, SEGMENTS_NONE
+from api.test.test_api import SEGMENTS
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+DOCUMENT = {
+    "_id": FILE_ID,
+    "processingStatus": "FINISHED",
+    "fileName": "name",
+    "seriesTitle": "Royally Obsessed",
+    "segments": [dict(SEGMENTS[FILE_ID][0], fileSegmentId=i) for i in range(3)],
+}
+
+
+class FieldSetTestCase(unittest.TestCase):
+    def test_defaults_are_the_full_document(self):
+        self.assertTrue(FieldSet.parse().is_full)
+
+    def test_fields_without_segments_leave_segments_out(self):
+        field_set = FieldSet.parse('processingStatus,seriesTitle')
+        self.assertEqual(field_set.segments, SEGMENTS_NONE)
+        self.assertFalse(field_set.needs_segments)
+        self.assertEqual(field_set.projection(), {'_id': 1, 'processingStatus': 1, 'seriesTitle': 1})
+        self.assertEqual(FieldSet.parse('seriesTitle,segments').segments, SEGMENTS_ALL)
+
+    def test_unknown_field_or_option_is_rejected(self):
+        with self.assertRaises(ValueError):
+            FieldSet.parse('seriesTitle,etag')
+        with self.assertRaises(ValueError):
+            FieldSet.parse(segments='some')
+
+    def test_segments_page_is_sliced(self):
+        field_set = FieldSet.parse('seriesTitle', 'page', offset=1, limit=1)
+        self.assertEqual(field_set.projection()['segments'], {'$slice': [1, 1]})
+        result = field_set.apply(DOCUMENT)
+        self.assertEqual(result['fileId'], FILE_ID)
+        self.assertEqual(result['segments'], DOCUMENT['segments'][1:2])
+        self.assertNotIn('processingStatus', result)
+
+    def test_segments_count(self):
+        field_set = FieldSet.parse(segments=SEGMENTS_COUNT)
+        self.assertNotIn('segments', field_set.projection())
+        result = field_set.apply(DOCUMENT)
+        self.assertEqual(result['segmentCount'], 3)
+        self.assertEqual(result['fileName'], "name")
@@ -0,0 +1,81 @@
+import logging
+import unittest
+from unittest.mock import patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.exceptions import APIException
+from api.ingestion import IngestionQueue, IngestionWorker, JobState
+from api.test.test_api import FILE_DETAILS, SEGMENTS
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class IngestionBackoffTestCase(unittest.TestCase):
+    def test_backoff_grows_and_is_capped(self):
+        queue = IngestionQueue(backoff_base=2, backoff_max=10)
+        for attempts in range(1, 10):
+            delay = queue.backoff(attempts)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10, 2 * 2 ** (attempts - 1)))
+
+
+class IngestionTestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel, IngestionJobModel
+
+        self.model = FileModel
+        self.job_model = IngestionJobModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+        self.queue = IngestionQueue(backoff_base=0, max_attempts=2)
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+
+        self.model.objects.all().delete()
+        self.job_model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    def test_notification_is_queued(self):
+        from api.app import app
+
+        with app.test_client() as c:
+            rv = c.post('/api/ingestion/files', json={'fileId': FILE_ID, 'processingStatus': 'FINISHED'})
+            self.assertEqual(rv.status_code, 202)
+        self.assertEqual(self.queue.depth()[JobState.PENDING], 1)
+
+    def test_unfinished_notification_is_bad_request(self):
+        from api.app import app
+
+        with app.test_client() as c:
+            rv = c.post('/api/ingestion/files', json={'fileId': FILE_ID, 'processingStatus': 'PROCESSING'})
+            self.assertEqual(rv.status_code, 400)
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_worker_stores_file_ahead_of_demand(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_details.return_value = FILE_DETAILS[FILE_ID]
+        mock_instance.fetch_segments.return_value = SEGMENTS[FILE_ID]
+        self.queue.enqueue(FILE_ID)
+
+        worker = IngestionWorker(queue=self.queue)
+        self.assertTrue(worker.run_once())
+        self.assertFalse(worker.run_once())
+        self.assertEqual(self.model.objects.get({'_id': FILE_ID}).seriesTitle, "Royally Obsessed")
+        self.assertEqual(self.queue.depth()[JobState.DONE], 1)
+        mock_instance.fetch_all.assert_not_called()
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_failed_job_is_retried_then_given_up(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_details.side_effect = APIException
+        mock_instance.fetch_segments.return_value = SEGMENTS[FILE_ID]
+        self.queue.enqueue(FILE_ID)
+
+        worker = IngestionWorker(queue=self.queue)
+        self.assertTrue(worker.run_once())
+        self.assertEqual(self.queue.depth()[JobState.PENDING], 1)
+        self.assertTrue(worker.run_once())
+        self.assertEqual(self.queue.depth()[JobState.FAILED], 1)
@@ -0,0 +1,148 @@
+import logging
+import unittest
+from unittest.mock import MagicMock
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.exceptions import APIException, FileInvalidStatusError, FileNotFound
+from api.jobs import GeventJobs
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class GeventJobsScanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.api = MagicMock()
+        self.catalog = MagicMock()
+        self.catalog.lookup.return_value = None
+        self.strategy = GeventJobs(processing_api=self.api, catalog=self.catalog)
+
+    def page(self, found_at, status='FINISHED'):
+        def fetch_all(limit, offset):
+            if offset == found_at:
+                return [{"fileId": FILE_ID, "processingStatus": status}]
+            return [{"fileId": f"other-{offset}", "processingStatus": "FINISHED"}]
+        return fetch_all
+
+    def test_scan_stops_after_window_with_finished_file(self):
+        self.api.fetch_all.side_effect = self.page(found_at=7)
+        the_file = self.strategy.scan_file(FILE_ID, max_pages=200, window=5, pool_size=5)
+        self.assertEqual(the_file['fileId'], FILE_ID)
+        self.assertEqual(self.api.fetch_all.call_count, 10)
+
+    def test_pages_are_recorded_off_the_request_path(self):
+        import gevent
+
+        self.api.fetch_all.side_effect = self.page(found_at=7)
+        self.strategy.scan_file(FILE_ID, max_pages=200, window=5, pool_size=5)
+        self.catalog.record_pages.assert_not_called()
+        gevent.sleep(0)
+        self.assertEqual(sorted(offset for _, offset, _ in self.catalog.record_pages.call_args[0][0]), list(range(10)))
+
+    def test_scan_without_finished_file_is_invalid_status(self):
+        self.api.fetch_all.side_effect = self.page(found_at=150, status='PROCESSING')
+        with self.assertRaises(FileInvalidStatusError):
+            self.strategy.scan_file(FILE_ID, max_pages=200, window=5, pool_size=5)
+        self.assertEqual(self.api.fetch_all.call_count, 201)
+
+    def test_scan_without_file_is_not_found(self):
+        self.api.fetch_all.side_effect = self.page(found_at=None)
+        with self.assertRaises(FileNotFound):
+            self.strategy.scan_file(FILE_ID, max_pages=20, window=5, pool_size=2)
+
+    def test_scan_with_all_errors_is_api_exception(self):
+        self.api.fetch_all.side_effect = APIException
+        with self.assertRaises(APIException):
+            self.strategy.scan_file(FILE_ID, max_pages=20, window=5, pool_size=5)
+
+
+class GeventJobsBundleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.api = MagicMock()
+        self.catalog = MagicMock()
+        self.catalog.lookup.return_value = None
+        self.strategy = GeventJobs(processing_api=self.api, catalog=self.catalog)
+
+    def slow(self, value, delay=0.2):
+        def call(*args):
+            import gevent
+
+            gevent.sleep(delay)
+            return value
+        return call
+
+    def test_bundle_fetches_details_and_segments_alongside_scan(self):
+        import time
+
+        self.api.fetch_all.side_effect = self.slow([{"fileId": FILE_ID, "processingStatus": "FINISHED"}])
+        self.api.fetch_details.side_effect = self.slow({"fileName": "name"})
+        self.api.fetch_segments.side_effect = self.slow([{"fileSegmentId": 1}])
+        start_time = time.time()
+        the_file = self.strategy.fetch_file_bundle(FILE_ID, max_pages=0)
+        self.assertLess(time.time() - start_time, 0.5)
+        self.assertEqual(the_file['fileName'], "name")
+        self.assertEqual(the_file['segments'], [{"fileSegmentId": 1}])
+
+    def test_bundle_discards_speculative_results_when_not_finished(self):
+        self.api.fetch_all.return_value = [{"fileId": FILE_ID, "processingStatus": "PROCESSING"}]
+        self.api.fetch_details.side_effect = self.slow({"fileName": "name"})
+        self.api.fetch_segments.side_effect = self.slow([{"fileSegmentId": 1}])
+        with self.assertRaises(FileInvalidStatusError):
+            self.strategy.fetch_file_bundle(FILE_ID, max_pages=0)
+
+
+class GeventJobsBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.api = MagicMock()
+        self.catalog = MagicMock()
+        self.catalog.lookup_many.return_value = {}
+        self.strategy = GeventJobs(processing_api=self.api, catalog=self.catalog)
+
+    def pages(self, files):
+        def fetch_all(limit, offset):
+            return [r for r in files if r['page'] == offset]
+        return fetch_all
+
+    def test_one_scan_resolves_every_file(self):
+        self.api.fetch_all.side_effect = self.pages([
+            {"fileId": "a", "processingStatus": "FINISHED", "page": 2},
+            {"fileId": "b", "processingStatus": "PROCESSING", "page": 30},
+            {"fileId": "c", "processingStatus": "FINISHED", "page": 45},
+        ])
+        results = self.strategy.fetch_files(["a", "b", "c", "d"], max_pages=50)
+        self.assertEqual(results["a"]["fileId"], "a")
+        self.assertIsInstance(results["b"], FileInvalidStatusError)
+        self.assertEqual(results["c"]["fileId"], "c")
+        self.assertIsInstance(results["d"], FileNotFound)
+        self.assertEqual(self.api.fetch_all.call_count, 51)
+
+    def test_scan_stops_once_every_file_is_finished(self):
+        self.api.fetch_all.side_effect = self.pages([
+            {"fileId": "a", "processingStatus": "FINISHED", "page": 2},
+            {"fileId": "b", "processingStatus": "FINISHED", "page": 8},
+        ])
+        results = self.strategy.fetch_files(["a", "b"], max_pages=200)
+        self.assertEqual(set(results), {"a", "b"})
+        self.assertEqual(self.api.fetch_all.call_count, 20)
+
+    def test_catalog_pages_are_fetched_first(self):
+        self.catalog.lookup_many.return_value = {"a": 120}
+        self.api.fetch_all.side_effect = self.pages([{"fileId": "a", "processingStatus": "FINISHED", "page": 120}])
+        results = self.strategy.fetch_files(["a"], max_pages=200)
+        self.assertEqual(results["a"]["fileId"], "a")
+        self.api.fetch_all.assert_called_once_with(5, 120)
+
+    def test_bundle_reports_details_errors_per_file(self):
+        self.api.fetch_all.side_effect = self.pages([
+            {"fileId": "a", "processingStatus": "FINISHED", "page": 0},
+            {"fileId": "b", "processingStatus": "FINISHED", "page": 0},
+        ])
+        self.api.fetch_details.side_effect = lambda file_id: {"fileName": file_id} if file_id == "a" else self.fail_call()
+        self.api.fetch_segments.return_value = []
+        results = self.strategy.fetch_files_bundle(["a", "b"], max_pages=0)
+        self.assertEqual(results["a"]["fileName"], "a")
+        self.assertIsInstance(results["b"], APIException)
+
+    def fail_call(self):
+        raise APIException("Upstream failed.")
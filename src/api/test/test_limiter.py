@@ -0,0 +1,157 @@
+import logging
+import unittest
+
+import gevent
+import requests
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.exceptions import LimiterTimeout
+from api.limiter import AdaptiveLimiter
+from api.resilience import CircuitBreaker, UpstreamPolicy
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, initial=2, **kwargs):
+        kwargs.setdefault('min_limit', 1)
+        kwargs.setdefault('max_limit', 10)
+        return AdaptiveLimiter(initial=initial, clock=self.clock, **kwargs)
+
+    def test_calls_over_the_window_wait(self):
+        limiter = self.limiter(initial=2)
+        sent = []
+
+        def call(flow, name):
+            with limiter.slot(flow):
+                sent.append(name)
+                gevent.sleep(0.01)
+
+        jobs = [gevent.spawn(call, 'a', i) for i in range(4)]
+        gevent.sleep(0)
+        self.assertEqual(sent, [0, 1])
+        self.assertEqual(limiter.stats()['queued'], 2)
+        gevent.joinall(jobs)
+        self.assertEqual(sorted(sent), [0, 1, 2, 3])
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_flows_are_served_round_robin(self):
+        limiter = self.limiter(initial=1)
+        sent = []
+
+        def call(flow, name):
+            with limiter.slot(flow):
+                sent.append(name)
+                gevent.sleep(0.001)
+
+        # a page scan queues up before the details call of another request.
+        jobs = [gevent.spawn(call, 'scan', f'page{i}') for i in range(4)]
+        jobs.append(gevent.spawn(call, 'other', 'details'))
+        gevent.joinall(jobs)
+        self.assertEqual(sent[:3], ['page0', 'page1', 'details'])
+
+    def test_window_grows_on_fast_calls(self):
+        limiter = self.limiter(initial=2)
+        for _ in range(4):
+            with limiter.slot('a'):
+                pass
+        self.assertGreaterEqual(limiter.limit, 3)
+
+    def test_window_shrinks_on_congestion_once_per_burst(self):
+        limiter = self.limiter(initial=8, backoff=0.5)
+        started = []
+
+        def fail():
+            with limiter.slot('a'):
+                started.append(1)
+                gevent.sleep(0.001)
+                raise requests.exceptions.ConnectionError()
+
+        jobs = [gevent.spawn(fail) for _ in range(4)]
+        gevent.joinall(jobs)
+        self.clock.now += 1
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.decreases, 1)
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            fail()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_slow_calls_shrink_the_window(self):
+        limiter = self.limiter(initial=8, backoff=0.5, tolerance=2)
+        limiter.release(limiter._clock(), 0.01, True)
+        limiter.in_flight += 1
+        self.clock.now += 1
+        limiter.release(self.clock.now, 0.1, True)
+        self.assertLess(limiter.limit, 8)
+
+    def test_endpoints_have_baselines_of_their_own(self):
+        limiter = self.limiter(initial=8, backoff=0.5, tolerance=2)
+
+        def call(endpoint, latency):
+            with limiter.slot('a', endpoint):
+                self.clock.now += latency
+
+        for _ in range(5):
+            call('file/details', 0.01)
+            call('file/segments', 1.0)
+        self.assertEqual(limiter.decreases, 0)
+        self.assertGreater(limiter.limit, 8)
+
+        call('file/segments', 3.0)
+        self.assertEqual(limiter.decreases, 1)
+
+    def test_client_errors_are_not_congestion(self):
+        limiter = self.limiter(initial=4)
+        response = requests.models.Response()
+        response.status_code = 404
+        with self.assertRaises(requests.exceptions.HTTPError):
+            with limiter.slot('a'):
+                raise requests.exceptions.HTTPError(response=response)
+        self.assertEqual(limiter.decreases, 0)
+
+    def test_timed_out_waiter_leaves_the_queue(self):
+        limiter = self.limiter(initial=1)
+        holder = gevent.spawn(limiter.acquire, 'a')
+        holder.join()
+        with self.assertRaises(LimiterTimeout):
+            with gevent.Timeout(0.01):
+                limiter.acquire('b')
+        self.assertEqual(limiter.stats()['queued'], 0)
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_queue_saturation_does_not_open_the_circuit(self):
+        for hedge_min_samples in (1000, 1):
+            limiter = self.limiter(initial=1)
+            breaker = CircuitBreaker(failure_rate=0.5, min_calls=1)
+            policy = UpstreamPolicy(
+                retries=2, backoff_base=0, hedge_percentile=95, hedge_min_delay=0.001,
+                hedge_min_samples=hedge_min_samples, breaker_factory=lambda: breaker
+            )
+            policy.latencies('file/all').add(0.001)
+
+            def send():
+                with limiter.slot('b', 'file/all'):
+                    return 'ok'
+
+            # a call of another flow holds the only slot.
+            limiter.acquire('a')
+            with self.assertRaises(LimiterTimeout):
+                with gevent.Timeout(0.01):
+                    policy.call('file/all', send)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            self.assertEqual(policy.stats()['retries'], 0)
+            self.assertEqual(limiter.stats()['queued'], 0)
+            self.assertEqual(limiter.in_flight, 1)
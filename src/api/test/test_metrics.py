@@ -0,0 +1,78 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.metrics import MetricsRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def registry(self):
+        registry = MetricsRegistry(directory=self.directory)
+        registry.counter('requests_total', "Requests.", ['endpoint'])
+        registry.histogram('request_seconds', "Latency.", ['endpoint'], buckets=(0.1, 1))
+        registry.gauge('in_flight', "In flight.")
+        return registry
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = self.registry()
+        histogram = registry.histogram('request_seconds', "Latency.", ['endpoint'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, endpoint='files')
+
+        text = registry.render()
+        self.assertIn('request_seconds_bucket{endpoint="files",le="0.1"} 1.0', text)
+        self.assertIn('request_seconds_bucket{endpoint="files",le="1.0"} 2.0', text)
+        self.assertIn('request_seconds_bucket{endpoint="files",le="+Inf"} 3.0', text)
+        self.assertIn('request_seconds_count{endpoint="files"} 3.0', text)
+        self.assertIn('# TYPE request_seconds histogram', text)
+
+    def test_workers_are_added_up(self):
+        workers = [self.registry(), self.registry()]
+        for worker in workers:
+            worker.counter('requests_total', "Requests.", ['endpoint']).inc(endpoint='files')
+            worker.gauge('in_flight', "In flight.").set(2)
+        workers[1].flush()
+
+        text = workers[0].render()
+        self.assertIn('requests_total{endpoint="files"} 2.0', text)
+        self.assertIn('in_flight 4.0', text)
+
+    def test_dead_workers_keep_their_counters_but_not_their_gauges(self):
+        scraper, dead = self.registry(), self.registry()
+        for worker in (scraper, dead):
+            worker.counter('requests_total', "Requests.", ['endpoint']).inc(endpoint='files')
+            worker.histogram('request_seconds', "Latency.", ['endpoint'], buckets=(0.1, 1)).observe(0.5, endpoint='files')
+            worker.gauge('in_flight', "In flight.").set(2)
+        dead.flush()
+        # a worker that gets the pid of the dead one does not count its gauges.
+        os.rename(dead._path, os.path.join(self.directory, '4242-dead.json'))
+        scraper.mark_process_dead(4242)
+        scraper.mark_process_dead(4242)
+
+        text = scraper.render()
+        self.assertIn('requests_total{endpoint="files"} 2.0', text)
+        self.assertIn('request_seconds_count{endpoint="files"} 2.0', text)
+        self.assertIn('in_flight 2.0', text)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(['dead.json', os.path.basename(scraper._path)]))
+
+        scraper.clear()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_labels_must_match(self):
+        registry = self.registry()
+        with self.assertRaises(ValueError):
+            registry.counter('requests_total', "Requests.", ['endpoint']).inc(status=200)
+        with self.assertRaises(ValueError):
+            registry.gauge('requests_total', "Requests.")
@@ -0,0 +1,165 @@
+import datetime
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.exceptions import APIException
+from api.refresh import EXPIRED, FRESH, STALE, FileRefresher, freshness, unexpired
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+NOW = datetime.datetime(2021, 3, 1, 12, 0, 0)
+DETAILS = {
+    "fileName": "1a4bae87-1eec-46de-9efb-657be6eaa8fa",
+    "fileLength": 2870700,
+    "seriesTitle": "Royally Obsessed"
+}
+SEGMENTS = [{"fileSegmentId": 1342, "fileId": FILE_ID, "segmentText": "Hey", "startTime": 1730, "endTime": 16080}]
+
+
+def ago(seconds):
+    return NOW - datetime.timedelta(seconds=seconds)
+
+
+class FreshnessTestCase(unittest.TestCase):
+    def test_states(self):
+        self.assertEqual(freshness(ago(10), NOW, soft_ttl=60, hard_ttl=600), FRESH)
+        self.assertEqual(freshness(ago(60), NOW, soft_ttl=60, hard_ttl=600), STALE)
+        self.assertEqual(freshness(ago(600), NOW, soft_ttl=60, hard_ttl=600), EXPIRED)
+
+    def test_files_stored_before_fetched_at_are_stale(self):
+        self.assertEqual(freshness(None, NOW, soft_ttl=60, hard_ttl=600), STALE)
+
+    def test_zero_ttls_never_age(self):
+        self.assertEqual(freshness(ago(10 ** 8), NOW, soft_ttl=0, hard_ttl=0), FRESH)
+
+    def test_unexpired_query(self):
+        self.assertEqual(unexpired(FILE_ID, NOW, hard_ttl=600), {'_id': FILE_ID, 'fetchedAt': {'$not': {'$lte': ago(600)}}})
+        self.assertEqual(unexpired(FILE_ID, NOW, hard_ttl=0), {'_id': FILE_ID})
+
+
+class FileRefresherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model = MagicMock()
+        self.collection = self.model._mongometa.collection
+        self.collection.find_one.return_value = {'_id': FILE_ID, 'processingStatus': 'FINISHED'}
+        self.lease = MagicMock()
+        self.lease.acquire.return_value = 'token'
+        self.strategy = MagicMock()
+        self.strategy.fetch_details_bundle.side_effect = lambda f: dict(f, segments=SEGMENTS, **DETAILS)
+        self.refresher = FileRefresher(strategy_factory=lambda: self.strategy, lease=self.lease)
+
+    @patch('api.refresh.save_file')
+    def test_stale_file_is_refetched_and_saved(self, save_file):
+        self.assertTrue(self.refresher.refresh(FILE_ID, self.model))
+        save_file.assert_called_once()
+        saved = save_file.call_args[0][0]
+        self.assertEqual(saved['fileId'], FILE_ID)
+        self.assertEqual(saved['seriesTitle'], "Royally Obsessed")
+        self.assertEqual(saved['segments'], SEGMENTS)
+        self.lease.release.assert_called_once_with(FILE_ID, 'token')
+        self.assertEqual(self.refresher.stats()['refreshed'], 1)
+
+    @patch('api.refresh.save_file')
+    def test_file_refreshed_meanwhile_is_skipped(self, save_file):
+        self.collection.find_one.return_value = {
+            '_id': FILE_ID, 'processingStatus': 'FINISHED', 'fetchedAt': datetime.datetime.utcnow()
+        }
+        self.assertFalse(self.refresher.refresh(FILE_ID, self.model))
+        save_file.assert_not_called()
+
+    @patch('api.refresh.save_file')
+    def test_file_fetched_by_another_worker_is_skipped(self, save_file):
+        self.lease.acquire.return_value = None
+        self.assertFalse(self.refresher.refresh(FILE_ID, self.model))
+        self.strategy.fetch_details_bundle.assert_not_called()
+        self.lease.release.assert_not_called()
+
+    @patch('api.refresh.save_file')
+    def test_failed_refresh_keeps_the_stored_file(self, save_file):
+        self.strategy.fetch_details_bundle.side_effect = APIException("down")
+        self.assertFalse(self.refresher.refresh(FILE_ID, self.model))
+        save_file.assert_not_called()
+        self.lease.release.assert_called_once_with(FILE_ID, 'token')
+        self.assertEqual(self.refresher.stats()['failed'], 1)
+
+    @patch('api.refresh.save_file')
+    def test_one_refresh_per_file_at_a_time(self, save_file):
+        first = self.refresher.refresh_async(FILE_ID, self.model)
+        self.assertIsNone(self.refresher.refresh_async(FILE_ID, self.model))
+        first.join()
+        self.assertEqual(self.refresher.stats(), {'refreshing': 0, 'refreshed': 1, 'failed': 0})
+
+
+class StaleWhileRevalidateAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel
+
+        self.model = FileModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+        from api.write_behind import SAVE_QUEUE
+
+        # saves queued by the test land before the collections are emptied.
+        SAVE_QUEUE.drain()
+        self.model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    def store(self, fetched_at, series_title="Royally Obsessed"):
+        from api.storage import save_file
+
+        save_file(dict({'fileId': FILE_ID, 'processingStatus': 'FINISHED', 'segments': SEGMENTS}, **dict(DETAILS, seriesTitle=series_title)), self.model)
+        self.model._mongometa.collection.update_one({'_id': FILE_ID}, {'$set': {'fetchedAt': fetched_at}})
+
+    def mock_api(self, MockAPIClass):
+        mock_instance = MockAPIClass.return_value
+        mock_instance.fetch_all.return_value = [{"fileId": FILE_ID, "processingStatus": "FINISHED"}]
+        mock_instance.fetch_details.return_value = dict(DETAILS, seriesTitle="Corrected Title")
+        mock_instance.fetch_segments.return_value = SEGMENTS
+        return mock_instance
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_stale_file_is_served_and_refreshed_in_background(self, MockAPIClass):
+        import gevent
+        from api.app import app
+        from api.refresh import FILE_SOFT_TTL
+
+        self.mock_api(MockAPIClass)
+        self.store(datetime.datetime.utcnow() - datetime.timedelta(seconds=FILE_SOFT_TTL + 1))
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()['seriesTitle'], "Royally Obsessed")
+            gevent.sleep(0.5)
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.get_json()['seriesTitle'], "Corrected Title")
+        self.assertNotIn('fetchedAt', rv.get_json())
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_expired_file_is_refetched_on_request(self, MockAPIClass):
+        from api.app import app
+        from api.refresh import FILE_HARD_TTL
+
+        self.mock_api(MockAPIClass)
+        self.store(datetime.datetime.utcnow() - datetime.timedelta(seconds=FILE_HARD_TTL + 1))
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 201)
+            self.assertEqual(rv.get_json()['seriesTitle'], "Corrected Title")
+
+    @patch('api.jobs.ProcessingAPIAdapter')
+    def test_expired_file_is_served_when_upstream_fails(self, MockAPIClass):
+        from api.app import app
+        from api.refresh import FILE_HARD_TTL
+
+        self.mock_api(MockAPIClass).fetch_all.side_effect = APIException
+        self.store(datetime.datetime.utcnow() - datetime.timedelta(seconds=FILE_HARD_TTL + 1))
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()['seriesTitle'], "Royally Obsessed")
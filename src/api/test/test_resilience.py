@@ -0,0 +1,316 @@
+import json
+import asyncio
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import aiohttp
+import gevent
+from gevent.event import Event
+import requests
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.exceptions import CircuitOpenError
+from api.external_api import PooledSession, ProcessingAPIAdapter
+from api.resilience import CircuitBreaker, UpstreamPolicy
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def http_error(status):
+    response = requests.models.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=10, cooldown=5, clock=self.clock)
+
+    def test_opens_once_failure_rate_is_crossed(self):
+        for ok in (True, False, True):
+            self.breaker.record(ok)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_old_failures_leave_the_window(self):
+        for _ in range(3):
+            self.breaker.record(False)
+        self.clock.now += 11
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_one_probe_after_cooldown(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.clock.now += 5
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_released_probe_lets_another_through(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.clock.now += 5
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.clock.now += 5
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+
+class UpstreamPolicyTestCase(unittest.TestCase):
+    def policy(self, **kwargs):
+        kwargs.setdefault('backoff_base', 0)
+        kwargs.setdefault('hedge_percentile', 0)
+        return UpstreamPolicy(**kwargs)
+
+    def flaky(self, errors, value='ok'):
+        calls = []
+
+        def send():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return value
+        return send, calls
+
+    def test_retries_connection_errors_and_5xx(self):
+        send, calls = self.flaky([requests.exceptions.ConnectionError(), http_error(503)])
+        policy = self.policy(retries=2)
+        self.assertEqual(policy.call('file/details', send), 'ok')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(policy.stats()['retries'], 2)
+
+    def test_gives_up_after_retries(self):
+        send, calls = self.flaky([requests.exceptions.ConnectionError()] * 3)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.policy(retries=1).call('file/details', send)
+        self.assertEqual(len(calls), 2)
+
+    def test_4xx_is_not_retried(self):
+        send, calls = self.flaky([http_error(404)])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.policy(retries=2).call('file/details', send)
+        self.assertEqual(len(calls), 1)
+
+    def test_open_circuit_fails_fast(self):
+        clock = FakeClock()
+        policy = self.policy(
+            retries=0,
+            breaker_factory=lambda: CircuitBreaker(failure_rate=0.5, min_calls=2, window=10, cooldown=5, clock=clock)
+        )
+        send, calls = self.flaky([requests.exceptions.ConnectionError()] * 2)
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                policy.call('file/all', send)
+
+        with self.assertRaises(CircuitOpenError):
+            policy.call('file/all', send)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(policy.stats()['circuits'], {'file/all': 'open'})
+
+        clock.now += 5
+        self.assertEqual(policy.call('file/all', send), 'ok')
+        self.assertEqual(policy.stats()['circuits'], {'file/all': 'closed'})
+
+    def test_4xx_probe_does_not_keep_the_circuit_half_open(self):
+        clock = FakeClock()
+        policy = self.policy(
+            retries=0,
+            breaker_factory=lambda: CircuitBreaker(failure_rate=0.5, min_calls=2, window=10, cooldown=5, clock=clock)
+        )
+        send, calls = self.flaky([requests.exceptions.ConnectionError()] * 2 + [http_error(404)])
+        for error in (requests.exceptions.ConnectionError, requests.exceptions.ConnectionError):
+            with self.assertRaises(error):
+                policy.call('file/all', send)
+
+        clock.now += 5
+        with self.assertRaises(requests.exceptions.HTTPError):
+            policy.call('file/all', send)
+        # the next call probes right away instead of failing fast for a cooldown.
+        self.assertEqual(policy.call('file/all', send), 'ok')
+        self.assertEqual(policy.stats()['circuits'], {'file/all': 'closed'})
+
+    def test_async_4xx_probe_does_not_keep_the_circuit_half_open(self):
+        clock = FakeClock()
+        policy = self.policy(
+            retries=1,
+            breaker_factory=lambda: CircuitBreaker(failure_rate=0.5, min_calls=2, window=10, cooldown=5, clock=clock)
+        )
+        not_found = aiohttp.ClientResponseError(MagicMock(), (), status=404)
+        send, calls = self.flaky([aiohttp.ClientConnectionError()] * 2 + [not_found])
+
+        async def send_async():
+            return send()
+
+        def call():
+            return asyncio.get_event_loop().run_until_complete(policy.call_async('file/all', send_async))
+
+        # the connection errors are retried and open the circuit.
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            call()
+        with self.assertRaises(CircuitOpenError):
+            call()
+        self.assertEqual(policy.stats()['retries'], 1)
+        self.assertEqual(policy.stats()['rejected'], 1)
+
+        clock.now += 5
+        with self.assertRaises(aiohttp.ClientResponseError):
+            call()
+        # the next call probes right away instead of failing fast for a cooldown.
+        self.assertEqual(call(), 'ok')
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(policy.stats()['circuits'], {'file/all': 'closed'})
+
+    def hedging_policy(self, samples=20, latency=0.01):
+        policy = self.policy(hedge_percentile=95, hedge_min_delay=0.01, hedge_min_samples=samples, hedge_budget=1)
+        for _ in range(samples):
+            policy.latencies('file/details').add(latency)
+        return policy
+
+    def test_slow_call_is_hedged(self):
+        delays = [1, 0]
+        sent = []
+
+        def send():
+            delay = delays[len(sent)]
+            sent.append(delay)
+            gevent.sleep(delay)
+            return delay
+
+        policy = self.hedging_policy()
+        with gevent.Timeout(0.5):
+            self.assertEqual(policy.call('file/details', send), 0)
+        self.assertEqual(sent, [1, 0])
+        self.assertEqual(policy.stats()['hedges'], 1)
+
+    def test_responses_of_losing_attempts_are_closed(self):
+        hedged = Event()
+        responses = []
+
+        def send():
+            response = MagicMock()
+            responses.append(response)
+            if len(responses) == 1:
+                # answers right after the hedge, before its kill is delivered.
+                hedged.wait()
+            else:
+                hedged.set()
+            return response
+
+        policy = self.hedging_policy()
+        self.assertIs(policy.call('file/details', send), responses[1])
+        gevent.sleep(0.05)
+        responses[0].close.assert_called_once_with()
+        responses[1].close.assert_not_called()
+
+    def test_fast_call_is_not_hedged(self):
+        sent = []
+
+        def send():
+            sent.append(1)
+            return 'ok'
+
+        policy = self.hedging_policy()
+        self.assertEqual(policy.call('file/details', send), 'ok')
+        gevent.sleep(0.05)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(policy.stats()['hedges'], 0)
+
+    def test_no_hedging_without_enough_samples(self):
+        sent = []
+
+        def send():
+            sent.append(1)
+            gevent.sleep(0.05)
+            return 'ok'
+
+        policy = self.hedging_policy(samples=20)
+        policy.hedge_min_samples = 21
+        self.assertEqual(policy.call('file/details', send), 'ok')
+        self.assertEqual(len(sent), 1)
+
+    def test_hedges_are_capped_by_budget(self):
+        sent = []
+
+        def send():
+            sent.append(1)
+            gevent.sleep(0.05)
+            return 'ok'
+
+        policy = self.hedging_policy(samples=100)
+        policy.hedge_budget = 0.5
+        for _ in range(4):
+            policy.call('file/details', send)
+        self.assertEqual(policy.stats()['hedges'], 2)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+
+    def do_GET(self):
+        if FlakyHandler.failures > 0:
+            FlakyHandler.failures -= 1
+            status, body = 503, b'{}'
+        else:
+            status, body = 200, json.dumps([]).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AdapterRetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        FlakyHandler.failures = 0
+        self.server.shutdown()
+        self.server.server_close()
+
+    def adapter(self, policy):
+        api = ProcessingAPIAdapter(session_pool=PooledSession(), policy=policy)
+        api._host = f'http://127.0.0.1:{self.server.server_port}'
+        return api
+
+    def test_503_is_retried(self):
+        FlakyHandler.failures = 2
+        policy = UpstreamPolicy(retries=2, backoff_base=0, hedge_percentile=0)
+        self.assertEqual(self.adapter(policy).fetch_all(), [])
+        self.assertEqual(policy.stats()['retries'], 2)
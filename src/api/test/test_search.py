@@ -0,0 +1,68 @@
+import logging
+import unittest
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.search import SearchIndex, tokenize
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+SEGMENTS = [
+    {"fileSegmentId": 1, "fileId": FILE_ID, "segmentText": "Welcome back to royally obsessed.", "startTime": 0, "endTime": 4000},
+    {"fileSegmentId": 2, "fileId": FILE_ID, "segmentText": "Obsessed with news, royally late.", "startTime": 4000, "endTime": 8000},
+    {"fileSegmentId": 3, "fileId": FILE_ID, "segmentText": "Nothing to see here.", "startTime": 8000, "endTime": 12000},
+]
+
+
+class TokenizerTestCase(unittest.TestCase):
+    def test_tokens_keep_positions_without_stopwords(self):
+        self.assertEqual(tokenize("Welcome back to Royally Obsessed!"), [
+            (0, 'welcome'), (1, 'back'), (3, 'royally'), (4, 'obsessed')
+        ])
+
+    def test_postings_count_terms_per_segment(self):
+        postings = SearchIndex().postings(FILE_ID, [
+            {"fileSegmentId": 1, "segmentText": "news news today", "startTime": 0, "endTime": 1}
+        ])
+        self.assertEqual({p['term']: p['tf'] for p in postings}, {'news': 2, 'today': 1})
+
+    def test_phrase_allows_stopwords_in_between(self):
+        index = SearchIndex()
+        self.assertTrue(index.is_phrase([[1], [3]]))
+        self.assertFalse(index.is_phrase([[3], [1]]))
+
+
+class SearchAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import SearchPostingModel, SegmentModel
+
+        self.posting_model = SearchPostingModel
+        self.segment_model = SegmentModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        self.posting_model.objects.all().delete()
+        self.segment_model.objects.all().delete()
+
+    def test_phrase_match_ranks_first(self):
+        from api.app import app
+        from api.search import SEARCH_INDEX
+        from api.segments import SEGMENT_STORE
+
+        SEGMENT_STORE.save(FILE_ID, SEGMENTS)
+        SEARCH_INDEX.index_file(FILE_ID, SEGMENTS)
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/search?q=royally obsessed')
+            self.assertEqual(rv.status_code, 200)
+            hits = rv.get_json()['hits']
+        self.assertEqual([h['fileSegmentId'] for h in hits], [1, 2])
+        self.assertEqual(hits[0]['startTime'], 0)
+        self.assertEqual(hits[0]['segmentText'], SEGMENTS[0]['segmentText'])
+
+    def test_search_without_query_is_bad_request(self):
+        from api.app import app
+
+        with app.test_client() as c:
+            rv = c.get('/api/presentation/search')
+            self.assertEqual(rv.status_code, 400)
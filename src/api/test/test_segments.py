@@ -0,0 +1,106 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.app import app
+from api.models import FileModel
+from api.storage import save_file
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+SEGMENTS = [
+    {
+        "fileSegmentId": 1000 + i,
+        "fileId": FILE_ID,
+        "segmentText": f"Segment {i}",
+        "startTime": i * 1000,
+        "endTime": (i + 1) * 1000
+    }
+    for i in range(10)
+]
+
+
+class FileSegmentsAPITestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import FileModel, SegmentModel
+
+        self.model = FileModel
+        self.segment_model = SegmentModel
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+
+        self.model.objects.all().delete()
+        self.segment_model.objects.all().delete()
+        FILE_CACHE.clear()
+
+    def save_file(self):
+        from api.storage import save_file
+
+        save_file({"fileId": FILE_ID, "processingStatus": "FINISHED", "fileName": "name", "segments": SEGMENTS})
+
+    def test_segments_overlapping_window(self):
+        self.save_file()
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments?from=2500&to=4000')
+            self.assertEqual(rv.status_code, 200)
+            ids = [s['fileSegmentId'] for s in rv.get_json()['segments']]
+            self.assertEqual(ids, [1002, 1003, 1004])
+
+    def test_segments_are_paginated_by_segment_id(self):
+        self.save_file()
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments?limit=4')
+            body = rv.get_json()
+            self.assertEqual(len(body['segments']), 4)
+            self.assertEqual(body['next'], 1003)
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments?limit=4&after=1007')
+            body = rv.get_json()
+            self.assertEqual([s['fileSegmentId'] for s in body['segments']], [1008, 1009])
+            self.assertIsNone(body['next'])
+
+    def test_segments_of_legacy_file_are_backfilled(self):
+        self.model(fileId=FILE_ID, processingStatus="FINISHED", fileName="name", segments=SEGMENTS).save()
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments?from=9500')
+            self.assertEqual([s['fileSegmentId'] for s in rv.get_json()['segments']], [1009])
+        self.assertEqual(self.segment_model.objects.raw({'fileId': FILE_ID}).count(), 10)
+
+    def test_segments_of_unknown_file_is_not_found(self):
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments')
+            self.assertEqual(rv.status_code, 404)
+
+    def test_invalid_window_is_bad_request(self):
+        with app.test_client() as c:
+            rv = c.get(f'/api/presentation/files/{FILE_ID}/segments?from=abc')
+            self.assertEqual(rv.status_code, 400)
+
+
+@patch('api.storage.index_segments_async')
+@patch('api.storage.SEGMENT_STORE')
+class SaveFileSegmentsTestCase(unittest.TestCase):
+    """
+    The segments are copied off the request path, with the search index.
+    """
+    def setUp(self):
+        self.model = MagicMock(side_effect=FileModel, segments=FileModel.segments)
+        self.model._mongometa.collection.find_one_and_replace.return_value = None
+
+    def the_file(self):
+        return {"fileId": FILE_ID, "processingStatus": "FINISHED", "fileName": "name", "segments": SEGMENTS}
+
+    def test_segments_are_copied_in_the_background(self, segment_store, index_segments_async):
+        save_file(self.the_file(), self.model)
+        self.model._mongometa.collection.find_one_and_replace.assert_called_once()
+        segment_store.save.assert_not_called()
+        index_segments_async.assert_called_once_with(FILE_ID, SEGMENTS)
+
+    def test_segments_are_left_to_the_caller(self, segment_store, index_segments_async):
+        save_file(self.the_file(), self.model, index=False)
+        segment_store.save.assert_not_called()
+        index_segments_async.assert_not_called()
@@ -0,0 +1,229 @@
+import io
+import json
+import random
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from bson import ObjectId
+from gevent.event import Event
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.external_api import SegmentStream, is_large
+from api.jsonstream import iter_json_array
+from api.models import FileModel
+from api.serialization import render
+from api.storage import document_etag, presentation, render_file, unpack_file
+from api.streaming import StreamedFile
+from api.test.test_columnar import FILE_ID, document, segments
+
+LOGGER = logging.getLogger(__name__)
+
+
+def split(data, rng):
+    """
+    The bytes cut at random places, multibyte characters included.
+    """
+    cuts = sorted(rng.sample(range(1, len(data)), min(len(data) - 1, rng.randint(0, 20))))
+    return [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+
+
+class FakeGridIn(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._id = ObjectId()
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.bucket.files[self._id] = self.data
+
+    def abort(self):
+        self.bucket.aborted += 1
+
+
+class FakeStreamBucket(object):
+    """
+    The part of GridFS the streamed files are written and read with.
+    """
+    def __init__(self):
+        self.files = {}
+        self.aborted = 0
+
+    def new_file(self, **kwargs):
+        return FakeGridIn(self)
+
+    def get(self, grid_id):
+        return io.BytesIO(self.files[grid_id])
+
+    def delete(self, grid_id):
+        del self.files[grid_id]
+
+
+class FakeSegments(object):
+    def __init__(self, items, fail_after=None):
+        self.items = items
+        self.fail_after = fail_after
+        self.closed = False
+
+    def __iter__(self):
+        for i, item in enumerate(self.items):
+            if i == self.fail_after:
+                raise ValueError("Connection broken.")
+            yield item
+
+    def close(self):
+        self.closed = True
+
+
+class IterJsonArrayTestCase(unittest.TestCase):
+    def test_items_are_the_same_whatever_the_chunks(self):
+        rng = random.Random(7)
+        items = segments(30) + [2.5, -1e3, 0, True, None, "a ] , [ \" é", [], {}, [1, [2]]]
+        data = json.dumps(items, ensure_ascii=False, indent=rng.choice([None, 2])).encode('utf-8')
+        for _ in range(200):
+            self.assertEqual(list(iter_json_array(split(data, rng))), items)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array([b' [ ', b' ] '])), [])
+
+    def test_invalid_arrays_raise(self):
+        for data in (b'', b'{}', b'[1', b'[1,]', b'[1 2]', b'[1] 2', b'[1,,2]', b'[tru]'):
+            with self.assertRaises(ValueError, msg=data):
+                list(iter_json_array([data]))
+
+
+class SegmentStreamTestCase(unittest.TestCase):
+    def response(self, body, length=None):
+        response = MagicMock(headers={} if length is None else {'Content-Length': str(length)})
+        response.iter_content.return_value = iter(split(body, random.Random(3)))
+        return response
+
+    def test_segments_are_parsed_and_response_closed(self):
+        body = json.dumps(segments(50)).encode('utf-8')
+        response = self.response(body)
+        stream = SegmentStream(response, read_size=100, read_timeout=5)
+        self.assertEqual(list(stream), segments(50))
+        self.assertEqual(stream.bytes_read, len(body))
+        response.iter_content.assert_called_once_with(100)
+        response.close.assert_called_once_with()
+
+    def test_is_large(self):
+        self.assertTrue(is_large(self.response(b'[]', 2048), 1024))
+        self.assertFalse(is_large(self.response(b'[]', 512), 1024))
+        # chunked responses say nothing of their length.
+        self.assertTrue(is_large(self.response(b'[]'), 1024))
+        self.assertFalse(is_large(self.response(b'[]'), 0))
+
+
+@patch('api.streaming.SEARCH_INDEX')
+@patch('api.streaming.SEGMENT_STORE')
+class StreamedFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bucket = FakeStreamBucket()
+        for target in ('api.streaming.overflow', 'api.storage.overflow'):
+            patcher = patch(target, return_value=self.bucket)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.model = MagicMock(side_effect=FileModel, segments=FileModel.segments)
+        self.model._mongometa.collection.find_one_and_replace.return_value = None
+
+    def the_file(self, count):
+        the_file = dict(document(count), fileId=FILE_ID)
+        del the_file['_id']
+        return the_file
+
+    def stream(self, count, chunk_size=7, fail_after=None, **kwargs):
+        the_file = self.the_file(count)
+        items = FakeSegments(the_file.pop('segments'), fail_after)
+        return StreamedFile(the_file, items, self.model, chunk_size, **kwargs), items
+
+    def stored(self):
+        return self.model._mongometa.collection.find_one_and_replace.call_args[0][1]
+
+    def test_body_and_stored_file_are_those_of_the_whole_file(self, segment_store, search_index):
+        for count in (1, 7, 50):
+            on_done = MagicMock()
+            stream, items = self.stream(count, on_done=on_done)
+            self.assertTrue(stream.claim())
+            self.assertFalse(stream.claim())
+            self.assertEqual(b''.join(stream.body()), render(self.the_file(count)))
+            self.assertTrue(stream.wait(5))
+            self.assertTrue(items.closed)
+            on_done.assert_called_once_with()
+
+            whole = render_file(FileModel(**self.the_file(count)).to_son())
+            son = dict(self.stored())
+            self.assertEqual(son['etag'], whole['etag'])
+            self.assertEqual(son['etag'], document_etag(whole))
+            self.assertEqual(son['segmentsPacked']['count'], count)
+            son = unpack_file(son, self.model)
+            self.assertEqual(bytes(son['rendered']), whole['rendered'])
+            self.assertEqual(son['segments'], whole['segments'])
+            self.assertEqual(unpack_file(dict(self.stored()), self.model, 5, 9)['segments'], whole['segments'][5:9])
+            self.assertEqual(presentation(son), presentation(dict(whole)))
+            generation = segment_store.write.call_args[0][2]
+            self.assertEqual({c[0][2] for c in segment_store.write.call_args_list[-((count + 6) // 7):]}, {generation})
+            segment_store.prune_generation.assert_called_with(FILE_ID, generation)
+
+    def test_invalid_segments_are_sent_but_not_stored(self, segment_store, search_index):
+        the_file = self.the_file(20)
+        items = the_file.pop('segments')
+        items[12] = "not a segment"
+        stream = StreamedFile(the_file, FakeSegments(items), self.model, chunk_size=5)
+        self.assertEqual(b''.join(stream.body()), render(dict(the_file, segments=items)))
+        self.assertFalse(stream.wait(5))
+        self.model._mongometa.collection.find_one_and_replace.assert_not_called()
+        self.assertEqual(self.bucket.aborted, 2)
+        segment_store.prune.assert_called_with(FILE_ID, [])
+
+    def test_file_without_segments_is_not_stored(self, segment_store, search_index):
+        stream, items = self.stream(0)
+        self.assertEqual(b''.join(stream.body()), render(self.the_file(0)))
+        self.assertFalse(stream.wait(5))
+        self.model._mongometa.collection.find_one_and_replace.assert_not_called()
+
+    def test_upstream_failure_truncates_the_body_and_stores_nothing(self, segment_store, search_index):
+        stream, items = self.stream(20, chunk_size=5, fail_after=12)
+        body = stream.body()
+        with self.assertRaises(ValueError):
+            for _ in body:
+                pass
+        self.assertFalse(stream.wait(5))
+        self.assertTrue(items.closed)
+        self.model._mongometa.collection.find_one_and_replace.assert_not_called()
+        self.assertEqual(self.bucket.aborted, 2)
+
+    def test_closed_before_it_is_sent(self, segment_store, search_index):
+        on_done = MagicMock()
+        stream, items = self.stream(20, on_done=on_done)
+        stream.claim()
+        stream.close()
+        self.assertTrue(items.closed)
+        self.assertFalse(stream.wait(0))
+        segment_store.write.assert_not_called()
+        on_done.assert_called_once_with()
+
+    def test_body_does_not_wait_for_storage(self, segment_store, search_index):
+        # storage is blocked until the whole body is sent.
+        blocked = Event()
+        segment_store.write.side_effect = lambda *args: blocked.wait()
+        stream, items = self.stream(50, chunk_size=5, buffer_size=20)
+        self.assertEqual(b''.join(stream.body()), render(self.the_file(50)))
+        self.assertFalse(stream.wait(0))
+        blocked.set()
+        self.assertTrue(stream.wait(5))
+
+    def test_file_storage_falls_behind_is_sent_but_not_stored(self, segment_store, search_index):
+        blocked = Event()
+        segment_store.write.side_effect = lambda *args: blocked.wait()
+        stream, items = self.stream(50, chunk_size=5, buffer_size=2)
+        self.assertEqual(b''.join(stream.body()), render(self.the_file(50)))
+        blocked.set()
+        self.assertFalse(stream.wait(5))
+        self.assertLessEqual(segment_store.write.call_count, 3)
+        self.model._mongometa.collection.find_one_and_replace.assert_not_called()
+        self.assertEqual(self.bucket.aborted, 2)
@@ -0,0 +1,65 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.test.test_api import FILES, FILE_DETAILS, SEGMENTS
+from api.warmer import CatalogWarmer, RateLimiter
+
+LOGGER = logging.getLogger(__name__)
+FILE_ID = "4a551eec-7dac-46d2-8f17-b6972b864b34"
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_acquire_waits_for_tokens(self):
+        now = [0.0]
+        limiter = RateLimiter(rate=2, burst=2, clock=lambda: now[0])
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        with patch('gevent.sleep', side_effect=sleep) as mock_sleep:
+            limiter.acquire(2)
+            mock_sleep.assert_not_called()
+            limiter.acquire(1)
+            self.assertAlmostEqual(now[0], 0.5)
+
+
+class CatalogWarmerTestCase(unittest.TestCase):
+    def setUp(self):
+        from pymodm import connect
+        from api.models import CatalogEntryModel, FileModel, WarmerReportModel
+
+        self.model = FileModel
+        self.models = [FileModel, CatalogEntryModel, WarmerReportModel]
+        connect("mongodb://mongosnack:kcansognom@db:27017/testdb?authSource=admin")
+
+    def tearDown(self):
+        from api.cache import FILE_CACHE
+
+        for model in self.models:
+            model._mongometa.collection.delete_many({})
+        FILE_CACHE.clear()
+
+    def test_sweep_stores_missing_finished_files(self):
+        from api.warmer import last_report
+
+        api = MagicMock()
+        api.fetch_all.side_effect = lambda limit, offset: FILES if offset == 0 else []
+        api.fetch_details.side_effect = lambda file_id: dict(FILE_DETAILS[FILE_ID], fileId=file_id)
+        api.fetch_segments.return_value = SEGMENTS[FILE_ID]
+
+        warmer = CatalogWarmer(processing_api=api, rate=1000, max_pages=2)
+        report = warmer.crawl()
+
+        self.assertEqual(report['finished'], 3)
+        self.assertEqual(report['fetched'], 3)
+        self.assertEqual(report['coverage'], 100.0)
+        self.assertEqual(self.model.objects.count(), 3)
+        self.assertEqual(last_report()['fetched'], 3)
+
+        # the next sweep finds everything stored already.
+        report = warmer.crawl()
+        self.assertEqual(report['stored'], 3)
+        self.assertEqual(report['fetched'], 0)
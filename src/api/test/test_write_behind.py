@@ -0,0 +1,146 @@
+import time
+import logging
+import unittest
+from unittest.mock import patch
+
+from pymodm.errors import ValidationError
+from pymongo.errors import AutoReconnect
+
+from core.logging_setup import setup_logging
+setup_logging()
+from api.write_behind import WriteBehindQueue
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def a_file(file_id, title="Royally Obsessed"):
+    return {"fileId": file_id, "processingStatus": "FINISHED", "seriesTitle": title, "segments": []}
+
+
+@patch('api.write_behind.index_segments')
+@patch('api.write_behind.save_files')
+class WriteBehindQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        # the tests flush themselves.
+        patcher = patch.object(WriteBehindQueue, '_ensure_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = WriteBehindQueue(max_size=3, batch_size=2, max_attempts=3, backoff=1, backoff_max=10, clock=self.clock)
+
+    def test_files_are_saved_in_batches(self, save_files, index_segments):
+        save_files.return_value = {}
+        for file_id in 'abc':
+            self.assertTrue(self.queue.put(a_file(file_id)))
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual([[f['fileId'] for f in c[0][0]] for c in save_files.call_args_list], [['a', 'b'], ['c']])
+        self.assertEqual(index_segments.call_count, 3)
+        self.assertEqual(self.queue.stats(), {'depth': 0, 'saved': 3, 'retried': 0, 'dropped': 0, 'rejected': 0})
+
+    def test_files_are_deduplicated_by_file_id(self, save_files, index_segments):
+        save_files.return_value = {}
+        self.queue.put(a_file('a', "Old"))
+        self.queue.put(a_file('a', "New"))
+        self.assertEqual(self.queue.depth(), 1)
+        self.assertEqual(self.queue.pending('a')['seriesTitle'], "New")
+        self.queue.flush()
+        self.assertEqual(save_files.call_args[0][0], [a_file('a', "New")])
+        self.assertIsNone(self.queue.pending('a'))
+
+    def test_failed_saves_are_retried_with_backoff(self, save_files, index_segments):
+        save_files.side_effect = AutoReconnect("down")
+        self.queue.put(a_file('a'))
+        self.queue.flush()
+        self.assertEqual(self.queue.pending('a'), a_file('a'))
+        self.assertEqual(self.queue.flush(), 0)
+        self.clock.now = 1
+        save_files.side_effect = None
+        save_files.return_value = {}
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(self.queue.stats()['retried'], 1)
+        self.assertEqual(self.queue.stats()['saved'], 1)
+
+    def test_saves_failing_every_attempt_are_dropped(self, save_files, index_segments):
+        save_files.return_value = {'a': Exception("E11000")}
+        self.queue.put(a_file('a'))
+        for _ in range(3):
+            self.clock.now += 10
+            self.queue.flush()
+        self.assertEqual(self.queue.depth(), 0)
+        self.assertEqual(self.queue.stats()['dropped'], 1)
+        index_segments.assert_not_called()
+
+    def test_invalid_files_are_not_retried(self, save_files, index_segments):
+        save_files.return_value = {'a': ValidationError("mp3Path is not a URL")}
+        self.queue.put(a_file('a'))
+        self.queue.put(a_file('b'))
+        self.queue.flush()
+        self.assertEqual(self.queue.depth(), 0)
+        self.assertEqual(self.queue.stats()['dropped'], 1)
+        self.assertEqual(self.queue.stats()['saved'], 1)
+
+    def test_retry_does_not_replace_a_newer_file(self, save_files, index_segments):
+        def fail_and_requeue(files, model, index):
+            self.queue.put(a_file('a', "New"))
+            raise AutoReconnect("down")
+
+        save_files.side_effect = fail_and_requeue
+        self.queue.put(a_file('a', "Old"))
+        self.queue.flush()
+        self.assertEqual(self.queue.pending('a')['seriesTitle'], "New")
+
+    def test_on_stored_is_called_once_the_file_is_written(self, save_files, index_segments):
+        save_files.side_effect = AutoReconnect("down")
+        stored = []
+        self.queue.put(a_file('a', "Old"), lambda: stored.append("Old"))
+        self.queue.flush()
+        self.assertEqual(stored, [])
+        # the copy it replaces is stored with it.
+        self.queue.put(a_file('a', "New"), lambda: stored.append("New"))
+        self.clock.now = 10
+        save_files.side_effect = None
+        save_files.return_value = {}
+        self.queue.flush()
+        self.assertEqual(stored, ["Old", "New"])
+
+    def test_full_or_closed_queue_rejects_files(self, save_files, index_segments):
+        save_files.return_value = {}
+        for file_id in 'abc':
+            self.queue.put(a_file(file_id))
+        self.assertFalse(self.queue.put(a_file('d')))
+        self.assertTrue(self.queue.put(a_file('a')))
+        self.assertEqual(self.queue.close(), 0)
+        self.assertEqual(save_files.call_count, 2)
+        self.assertFalse(self.queue.put(a_file('e')))
+        self.assertEqual(self.queue.stats()['rejected'], 2)
+
+    def test_drain_ignores_backoff(self, save_files, index_segments):
+        save_files.side_effect = AutoReconnect("down")
+        self.queue.put(a_file('a'))
+        self.queue.flush()
+        save_files.side_effect = None
+        save_files.return_value = {}
+        self.assertEqual(self.queue.drain(timeout=1), 0)
+        self.assertEqual(self.queue.stats()['saved'], 1)
+
+
+@patch('api.write_behind.index_segments')
+@patch('api.write_behind.save_files', return_value={})
+class WriteBehindFlusherTestCase(unittest.TestCase):
+    def test_flusher_saves_queued_files(self, save_files, index_segments):
+        queue = WriteBehindQueue(batch_size=100, flush_interval=0.01)
+        queue.put(a_file('a'))
+        deadline = time.monotonic() + 5
+        while queue.depth() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(queue.stats()['saved'], 1)
+        queue.close()
@@ -0,0 +1,177 @@
+if __name__ == '__main__':
+    # patch before requests/pymongo get imported so that their sockets are cooperative.
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
+import time
+import logging
+import datetime
+
+from pymongo.errors import PyMongoError
+
+from api.coalesce import FetchLease
+from api.crawler import CatalogCrawler
+from api.jobs import GeventJobs
+from api.models import FileModel, WarmerReportModel
+from api.storage import save_file
+from api.utils import FileStatus
+
+LOGGER = logging.getLogger(__name__)
+# upstream calls per second the warmer may make, pages and details/segments calls alike.
+WARMER_RATE = float(os.environ.get('WARMER_RATE', 5))
+WARMER_CONCURRENCY = int(os.environ.get('WARMER_CONCURRENCY', 4))
+# seconds between two sweeps.
+WARMER_INTERVAL = int(os.environ.get('WARMER_INTERVAL', 600))
+
+
+class RateLimiter(object):
+    """
+    A token bucket refilled at `rate` tokens per second that holds at most `burst` tokens.
+    acquire() puts the green thread to sleep until enough tokens are available.
+    """
+    def __init__(self, rate=WARMER_RATE, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        import gevent
+
+        while True:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+            gevent.sleep((tokens - self._tokens) / self.rate)
+
+
+class CatalogWarmer(CatalogCrawler):
+    """
+    A background job that sweeps the paginated processing API at a limited rate,
+    records what it sees in the catalog and fetches and stores the FINISHED files
+    we do not hold yet, so that they never hit the cold path of a live request.
+    Run it as a separate process with `python -m api.warmer`.
+    """
+    def __init__(self, processing_api=None, catalog=None, strategy=None, lease=None,
+                 rate=WARMER_RATE, concurrency=WARMER_CONCURRENCY, **kwargs):
+        super().__init__(processing_api, catalog, concurrency=concurrency, **kwargs)
+        self._strategy = strategy or GeventJobs(processing_api=self._api, catalog=self._catalog)
+        self._lease = lease or FetchLease()
+        self._limiter = RateLimiter(rate)
+        self.model = FileModel
+
+    def crawl_page(self, offset):
+        self._limiter.acquire()
+        return super().crawl_page(offset)
+
+    def stored_ids(self, file_ids):
+        if not file_ids:
+            return set()
+        collection = self.model._mongometa.collection
+        return set(d['_id'] for d in collection.find({'_id': {'$in': list(file_ids)}}, projection={'_id': 1}))
+
+    def warm_file(self, the_file, report):
+        """
+        Fetch and store a FINISHED file unless a live request is fetching it already.
+        """
+        file_id = the_file['fileId']
+        token = self._lease.acquire(file_id)
+        if token is None:
+            return
+        from gevent import Timeout
+
+        try:
+            # details and segments are two upstream calls.
+            self._limiter.acquire(2)
+            save_file(self._strategy.fetch_details_bundle(the_file, self.timeout))
+            report['fetched'] += 1
+        except (Exception, Timeout) as e:
+            report['failed'] += 1
+            LOGGER.warning(f"Could not warm {file_id}. {str(e)}.")
+        finally:
+            self._lease.release(file_id, token)
+
+    def crawl(self):
+        """
+        Sweep MAX_PAGES pages one at a time and warm the missing FINISHED files
+        with bounded concurrency. Returns the sweep report.
+        """
+        from gevent import Timeout
+        from gevent.pool import Pool
+
+        started_at = datetime.datetime.utcnow()
+        report = {'finished': 0, 'stored': 0, 'fetched': 0, 'failed': 0, 'pageErrors': 0}
+        pool = Pool(self.concurrency)
+        seen = set()
+        for offset in range(0, self.max_pages + 1):
+            try:
+                page = self.crawl_page(offset)
+            except (Exception, Timeout) as e:
+                report['pageErrors'] += 1
+                LOGGER.warning(f"Could not sweep page {offset + 1}. {str(e)}.")
+                continue
+            self._catalog.record_pages([page])
+
+            finished = {}
+            for record in page[2] or []:
+                if record.get('processingStatus') == FileStatus.FINISHED and record.get('fileId') not in seen:
+                    finished[record['fileId']] = record
+            seen.update(finished)
+            stored = self.stored_ids(finished)
+            report['finished'] += len(finished)
+            report['stored'] += len(stored)
+            for file_id, record in finished.items():
+                if file_id not in stored:
+                    pool.spawn(self.warm_file, record, report)
+        pool.join()
+
+        held = report['stored'] + report['fetched']
+        report['coverage'] = round(100.0 * held / report['finished'], 2) if report['finished'] else 100.0
+        report['startedAt'] = started_at
+        report['finishedAt'] = datetime.datetime.utcnow()
+        LOGGER.info(
+            f"Warmed {report['fetched']} files, {report['failed']} failed. "
+            f"{held} of {report['finished']} FINISHED files held locally ({report['coverage']}% coverage)."
+        )
+        self.save_report(report)
+        return report
+
+    def save_report(self, report):
+        try:
+            WarmerReportModel._mongometa.collection.replace_one({'_id': 'warmer'}, report, upsert=True)
+        except PyMongoError as e:
+            LOGGER.warning(f"Could not save warmer report. {str(e)}.")
+
+    def run_forever(self, interval=WARMER_INTERVAL):
+        super().run_forever(interval)
+
+
+def last_report():
+    """
+    Report of the last sweep of the warmer, None if it has not run yet.
+    """
+    try:
+        return WarmerReportModel._mongometa.collection.find_one({'_id': 'warmer'}, projection={'_id': 0})
+    except PyMongoError:
+        return None
+
+
+def main():
+    from pymodm import connect
+
+    from core.logging_setup import setup_logging
+    setup_logging()
+    connect(os.environ.get('DB_CONNECTION_STRING'))
+    CatalogWarmer().run_forever()
+
+
+if __name__ == '__main__':
+    main()
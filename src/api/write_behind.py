@@ -0,0 +1,242 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from pymodm.errors import ValidationError
+
+from api.metrics import METRICS
+from api.models import FileModel
+from api.storage import index_segments, save_files
+
+LOGGER = logging.getLogger(__name__)
+# files waiting to be saved a worker may hold. Past it, files are saved on the request path. 0 always does.
+SAVE_QUEUE_MAX_SIZE = int(os.environ.get('SAVE_QUEUE_MAX_SIZE', 10000))
+# files written with one bulk upsert.
+SAVE_BATCH_SIZE = int(os.environ.get('SAVE_BATCH_SIZE', 100))
+# seconds a queued file waits for a batch to fill up.
+SAVE_FLUSH_INTERVAL = float(os.environ.get('SAVE_FLUSH_INTERVAL', 0.2))
+SAVE_MAX_ATTEMPTS = int(os.environ.get('SAVE_MAX_ATTEMPTS', 5))
+SAVE_RETRY_BACKOFF = float(os.environ.get('SAVE_RETRY_BACKOFF', 1))
+SAVE_RETRY_BACKOFF_MAX = float(os.environ.get('SAVE_RETRY_BACKOFF_MAX', 30))
+# seconds a worker that is shutting down keeps flushing its queue.
+SAVE_DRAIN_TIMEOUT = float(os.environ.get('SAVE_DRAIN_TIMEOUT', 10))
+
+QUEUE_DEPTH = METRICS.gauge('save_queue_depth', "Files waiting in the write-behind queue to be saved.")
+FLUSH_LATENCY = METRICS.histogram('save_flush_seconds', "Latency of a bulk write of the write-behind queue.")
+SAVES = METRICS.counter('save_queue_files_total', "Files written by the write-behind queue, by outcome.", ['outcome'])
+
+
+class QueuedSave(object):
+    def __init__(self, the_file, callbacks=None):
+        self.the_file = the_file
+        # called once the file is written or dropped, e.g. to release its fetch lease.
+        self.callbacks = callbacks or []
+        self.attempts = 0
+        self.due_at = 0
+
+
+class WriteBehindQueue(object):
+    """
+    Saves files fetched on a cold miss after the response went out.
+
+    Files are queued in the worker, deduplicated by fileId (the last one queued
+    wins), and a flusher thread writes them in batches of batch_size with one
+    unordered bulk upsert, see save_files(). A batch is written as soon as it is
+    full or flush_interval seconds after its first file was queued. Files the
+    write failed for are retried with exponential backoff up to max_attempts
+    times, files that do not validate are dropped. A queued file is read back
+    with pending() until it is stored, and drain() writes what is left when the
+    worker shuts down. The on_stored callback of a file, e.g. the release of its
+    fetch lease, is called once it is written or dropped.
+
+    The thread is a green thread under gevent monkey patching, and a thread of
+    its own under uvicorn, so the queue serves both job strategies. With a full
+    queue, or max_size 0, the caller saves on the request path like before.
+    """
+    def __init__(self, model=FileModel, max_size=SAVE_QUEUE_MAX_SIZE, batch_size=SAVE_BATCH_SIZE,
+                 flush_interval=SAVE_FLUSH_INTERVAL, max_attempts=SAVE_MAX_ATTEMPTS, backoff=SAVE_RETRY_BACKOFF,
+                 backoff_max=SAVE_RETRY_BACKOFF_MAX, clock=time.monotonic):
+        self.model = model
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        # fileId -> QueuedSave, in the order they were first queued.
+        self._pending = OrderedDict()
+        # fileId -> QueuedSave of the batch being written.
+        self._flushing = {}
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.saved = 0
+        self.retried = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def depth(self):
+        with self._lock:
+            return len(self._pending) + len(self._flushing)
+
+    def put(self, the_file, on_stored=None):
+        """
+        Queue a file fetched from the processing API to be saved. Never blocks on storage.
+        Returns False if the queue is full or closed, save the file yourself then.
+
+        @param on_stored: callable called without arguments once the file is written or dropped.
+        """
+        with self._lock:
+            if self._closed or self.max_size <= 0 or (
+                the_file['fileId'] not in self._pending and len(self._pending) >= self.max_size
+            ):
+                self.rejected += 1
+                return False
+            # the copy it replaces is stored with it.
+            replaced = self._pending.get(the_file['fileId'])
+            callbacks = (replaced.callbacks if replaced is not None else []) + ([on_stored] if on_stored else [])
+            self._pending[the_file['fileId']] = QueuedSave(the_file, callbacks)
+            self._ensure_thread()
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+        return True
+
+    def pending(self, file_id):
+        """
+        The file queued to be saved under file_id, None if there is none.
+        """
+        with self._lock:
+            queued = self._pending.get(file_id) or self._flushing.get(file_id)
+            return queued.the_file if queued is not None else None
+
+    def _ensure_thread(self):
+        # a forked worker starts its own flusher.
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception as e:
+                LOGGER.exception(f"Write-behind flush failed. {str(e)}.")
+
+    def _take(self, ignore_due=False):
+        now = self._clock()
+        with self._lock:
+            # a file is written by one flush at a time, so an older copy never lands after a newer one.
+            batch = [
+                (file_id, queued) for file_id, queued in self._pending.items()
+                if (ignore_due or queued.due_at <= now) and file_id not in self._flushing
+            ][:self.batch_size]
+            for file_id, queued in batch:
+                del self._pending[file_id]
+                self._flushing[file_id] = queued
+            return batch
+
+    def flush(self, ignore_due=False):
+        """
+        Write one batch of the queued files that are due. Returns the no. of files in it.
+        """
+        batch = self._take(ignore_due)
+        if not batch:
+            return 0
+        try:
+            with FLUSH_LATENCY.time():
+                errors = save_files([q.the_file for _, q in batch], self.model, index=False)
+        except Exception as e:
+            # the whole write failed, e.g. storage is unreachable.
+            errors = {file_id: e for file_id, _ in batch}
+        for file_id, queued in batch:
+            error = errors.get(file_id)
+            if error is None:
+                self._saved(queued)
+            elif isinstance(error, ValidationError):
+                self._drop(file_id, queued, error)
+            else:
+                self._retry(file_id, queued, error)
+        with self._lock:
+            for file_id, _ in batch:
+                del self._flushing[file_id]
+        return len(batch)
+
+    def _stored(self, file_id, queued):
+        for callback in queued.callbacks:
+            try:
+                callback()
+            except Exception as e:
+                LOGGER.warning(f"Callback of the queued save of {file_id} failed. {str(e)}.")
+
+    def _saved(self, queued):
+        self.saved += 1
+        SAVES.inc(outcome='saved')
+        self._stored(queued.the_file['fileId'], queued)
+        index_segments(queued.the_file['fileId'], queued.the_file.get('segments'))
+
+    def _drop(self, file_id, queued, error):
+        self.dropped += 1
+        SAVES.inc(outcome='dropped')
+        LOGGER.error(f"Dropping queued save of {file_id}. {str(error)}.")
+        self._stored(file_id, queued)
+
+    def _retry(self, file_id, queued, error):
+        queued.attempts += 1
+        if queued.attempts >= self.max_attempts:
+            return self._drop(file_id, queued, error)
+        self.retried += 1
+        SAVES.inc(outcome='retried')
+        queued.due_at = self._clock() + min(self.backoff * 2 ** (queued.attempts - 1), self.backoff_max)
+        LOGGER.warning(f"Could not save {file_id}, attempt {queued.attempts}. {str(error)}.")
+        with self._lock:
+            # a file queued again meanwhile is newer than this one, it is stored in its place.
+            if file_id not in self._pending:
+                self._pending[file_id] = queued
+            else:
+                self._pending[file_id].callbacks.extend(queued.callbacks)
+
+    def drain(self, timeout=SAVE_DRAIN_TIMEOUT):
+        """
+        Write every queued file, retries included, for at most timeout seconds.
+        Returns the no. of files left in the queue.
+        """
+        deadline = self._clock() + timeout
+        while self.depth() and self._clock() < deadline:
+            if not self.flush(ignore_due=True):
+                # the flusher holds the last batch.
+                time.sleep(0.05)
+        return self.depth()
+
+    def close(self, timeout=SAVE_DRAIN_TIMEOUT):
+        """
+        Stop queueing, callers save on the request path from now on, and drain the queue.
+        """
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+        left = self.drain(timeout)
+        if left:
+            LOGGER.error(f"Shutting down with {left} files not saved.")
+        return left
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'saved': self.saved,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+        }
+
+
+SAVE_QUEUE = WriteBehindQueue()
+QUEUE_DEPTH.set_function(SAVE_QUEUE.depth)
@@ -0,0 +1,90 @@
+import os
+import time
+import argparse
+
+from core.logging_setup import setup_logging
+setup_logging()
+from flask import Flask, jsonify
+from pymodm import connect
+
+from api.models import FileModel, SegmentModel
+from api.storage import presentation, save_file
+from benchmarks.utils import summarize, write_result
+
+FILE_ID_PREFIX = 'bench-hit-'
+
+
+def synthetic_file(file_id, segments):
+    return {
+        'fileId': file_id,
+        'processingStatus': 'FINISHED',
+        'fileName': 'bench.mp3',
+        'fileLength': segments * 4000,
+        'mp3Path': 'http://s3.amazonaws.com/snackable-test-audio/mp3Audio/bench.mp3',
+        'seriesTitle': 'Bench Series',
+        'segments': [{
+            'fileSegmentId': i,
+            'fileId': file_id,
+            'segmentText': 'a segment of a synthetic transcript spoken at some point of the file',
+            'startTime': i * 4000,
+            'endTime': (i + 1) * 4000,
+        } for i in range(segments)],
+    }
+
+
+def odm_hit(app, file_id):
+    """
+    The hit path before bodies were pre-rendered.
+    """
+    with app.app_context():
+        son = presentation(FileModel.objects.get({'_id': file_id}).to_son())
+        return jsonify(son).get_data()
+
+
+def raw_hit(app, file_id):
+    """
+    The hit path reading the pre-rendered body with a projection.
+    """
+    document = FileModel._mongometa.collection.find_one({'_id': file_id}, projection={'etag': 1, 'rendered': 1})
+    return bytes(document['rendered'])
+
+
+def measure(fn, app, file_id, requests):
+    latencies = []
+    start_time = time.perf_counter()
+    for _ in range(requests):
+        request_start = time.perf_counter()
+        fn(app, file_id)
+        latencies.append(time.perf_counter() - request_start)
+    return summarize(latencies, time.perf_counter() - start_time)
+
+
+def cleanup():
+    FileModel._mongometa.collection.delete_many({'_id': {'$regex': f'^{FILE_ID_PREFIX}'}})
+    SegmentModel._mongometa.collection.delete_many({'fileId': {'$regex': f'^{FILE_ID_PREFIX}'}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage hit latency of the ODM and the pre-rendered read paths.")
+    parser.add_argument('--sizes', default='10,100,1000,5000', help="comma separated segment counts.")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    connect(os.environ.get('BENCH_DB_CONNECTION_STRING', os.environ.get('DB_CONNECTION_STRING')))
+    app = Flask(__name__)
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            file_id = f'{FILE_ID_PREFIX}{size}'
+            save_file(synthetic_file(file_id, size))
+            body_bytes = len(raw_hit(app, file_id))
+            for path, fn in (('odm', odm_hit), ('raw', raw_hit)):
+                result = {'path': path, 'segments': size, 'body_bytes': body_bytes}
+                result.update(measure(fn, app, file_id, args.requests))
+                write_result(args.output, 'hit_path', result)
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+if __name__ == '__main__':
+    # patch before requests gets imported so that the load is generated by green threads.
+    from gevent import monkey
+    monkey.patch_all()
+
+import time
+import random
+import argparse
+from collections import Counter, OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from benchmarks.utils import summarize, write_result
+
+WORKLOADS = ('hot', 'cold', 'mixed')
+
+
+def catalog(mock_url, limit=5, max_pages=100000):
+    """
+    FINISHED file ids of the mock catalog, in the order of its pages.
+    """
+    session = requests.Session()
+    # the mock may be injecting errors.
+    session.mount('http://', HTTPAdapter(max_retries=Retry(total=10, status_forcelist=[500], backoff_factor=0.05)))
+    file_ids = []
+    for offset in range(max_pages):
+        page = session.get(f'{mock_url}/api/file/all', params={'limit': limit, 'offset': offset}, timeout=30).json()
+        if not page:
+            break
+        file_ids.extend(r['fileId'] for r in page if r.get('processingStatus') == 'FINISHED')
+    return list(OrderedDict.fromkeys(file_ids))
+
+
+def plan(workload, requests_count, hot_ids, cold_ids, hot_ratio, rng):
+    """
+    The (kind, fileId) requests of a run. Every cold request asks for a file no request asked for before.
+    """
+    cold_ids = list(cold_ids)
+    rng.shuffle(cold_ids)
+    planned = []
+    for _ in range(requests_count):
+        hot = workload == 'hot' or (workload == 'mixed' and rng.random() < hot_ratio)
+        if hot:
+            planned.append(('hot', rng.choice(hot_ids)))
+        elif cold_ids:
+            planned.append(('cold', cold_ids.pop()))
+        else:
+            raise SystemExit("Not enough cold files in the catalog for this run, raise MOCK_FILES or lower --requests.")
+    return planned
+
+
+def run(api_url, planned, concurrency, timeout):
+    """
+    Send the planned requests with concurrency green threads.
+    Returns the (kind, status, latency) of every request and the wall clock time.
+    """
+    from gevent.pool import Pool
+
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    outcomes = []
+
+    def send(kind, file_id):
+        start_time = time.perf_counter()
+        try:
+            status = session.get(f'{api_url}/api/presentation/files/{file_id}', timeout=timeout).status_code
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        outcomes.append((kind, status, time.perf_counter() - start_time))
+
+    pool = Pool(concurrency)
+    start_time = time.perf_counter()
+    for kind, file_id in planned:
+        pool.spawn(send, kind, file_id)
+    pool.join()
+    return outcomes, time.perf_counter() - start_time
+
+
+def report(workload, concurrency, outcomes, elapsed):
+    result = {'workload': workload, 'concurrency': concurrency}
+    result.update(summarize([latency for _, _, latency in outcomes], elapsed))
+    result['statuses'] = dict(Counter(str(status) for _, status, _ in outcomes))
+    for kind in ('hot', 'cold'):
+        latencies = [latency for k, _, latency in outcomes if k == kind]
+        if latencies:
+            result[kind] = summarize(latencies)
+    cold = [status for kind, status, _ in outcomes if kind == 'cold']
+    if cold:
+        # a cold request answered from storage (200) means the database was not fresh.
+        result['cold_ratio'] = round(sum(1 for s in cold if s == 201) / len(cold), 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the presentation API under load.")
+    parser.add_argument('--api', default='http://localhost:9002', help="base URL of the presentation API.")
+    parser.add_argument('--mock', default='http://localhost:9001', help="base URL of the mock processing API.")
+    parser.add_argument('--workload', choices=WORKLOADS + ('all',), default='all')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--hot-files', type=int, default=50, help="no. of files the hot requests ask for.")
+    parser.add_argument('--hot-ratio', type=float, default=0.9, help="share of hot requests of the mixed workload.")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    file_ids = catalog(args.mock)
+    hot_ids, cold_ids = file_ids[:args.hot_files], file_ids[args.hot_files:]
+    if not hot_ids:
+        raise SystemExit("The mock catalog has no FINISHED files, set MOCK_FILES.")
+    mock_config = requests.get(f'{args.mock}/api/mock/config', timeout=10).json()
+
+    # the hot files are stored before anything is measured.
+    run(args.api, [('warmup', f) for f in hot_ids], args.concurrency, args.timeout)
+
+    workloads = WORKLOADS if args.workload == 'all' else (args.workload,)
+    for workload in workloads:
+        planned = plan(workload, args.requests, hot_ids, cold_ids, args.hot_ratio, rng)
+        # files a run asked for are not cold for the next runs.
+        asked = set(file_id for _, file_id in planned)
+        cold_ids = [f for f in cold_ids if f not in asked]
+        outcomes, elapsed = run(args.api, planned, args.concurrency, args.timeout)
+        result = report(workload, args.concurrency, outcomes, elapsed)
+        result.update({'catalog_files': len(file_ids), 'mock': mock_config})
+        write_result(args.output, 'load', result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import time
+import random
+import argparse
+
+from core.logging_setup import setup_logging
+setup_logging()
+from pymodm import connect
+
+from api.models import SearchPostingModel, SegmentModel
+from api.search import SearchIndex
+from benchmarks.utils import summarize, write_result
+
+PHRASES = ['royally obsessed', 'breaking news tonight', 'thanks for listening', 'welcome back']
+
+
+def synthetic_segments(file_id, count, vocabulary, weights, rng):
+    segments = []
+    for i in range(count):
+        words = rng.choices(vocabulary, weights=weights, k=rng.randint(8, 30))
+        if rng.random() < 0.05:
+            words.insert(rng.randint(0, len(words)), rng.choice(PHRASES))
+        segments.append({
+            'fileSegmentId': i,
+            'fileId': file_id,
+            'segmentText': ' '.join(words),
+            'startTime': i * 4000,
+            'endTime': (i + 1) * 4000,
+        })
+    return segments
+
+
+def build_corpus(index, segments, per_file, rng):
+    vocabulary = [f'word{i}' for i in range(5000)]
+    # zipf like word frequencies.
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    file_ids = []
+    for n in range(0, segments, per_file):
+        file_id = f'bench-{n // per_file:06d}'
+        file_segments = synthetic_segments(file_id, min(per_file, segments - n), vocabulary, weights, rng)
+        SegmentModel._mongometa.collection.insert_many(file_segments)
+        index.index_file(file_id, file_segments)
+        file_ids.append(file_id)
+    return vocabulary, file_ids
+
+
+def cleanup():
+    SegmentModel._mongometa.collection.delete_many({'fileId': {'$regex': '^bench-'}})
+    SearchPostingModel._mongometa.collection.delete_many({'fileId': {'$regex': '^bench-'}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search query latency over a synthetic corpus.")
+    parser.add_argument('--segments', type=int, default=100000)
+    parser.add_argument('--per-file', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help="keep the corpus for another run.")
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    connect(os.environ.get('BENCH_DB_CONNECTION_STRING', os.environ.get('DB_CONNECTION_STRING')))
+    rng = random.Random(args.seed)
+    index = SearchIndex()
+
+    start_time = time.perf_counter()
+    vocabulary, _ = build_corpus(index, args.segments, args.per_file, rng)
+    index_seconds = time.perf_counter() - start_time
+
+    queries = []
+    for _ in range(args.queries):
+        kind = rng.random()
+        if kind < 0.4:
+            queries.append(rng.choice(vocabulary[:500]))
+        elif kind < 0.8:
+            queries.append(' '.join(rng.sample(vocabulary[:2000], 2)))
+        else:
+            queries.append(rng.choice(PHRASES))
+
+    latencies = []
+    start_time = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - query_start)
+    elapsed = time.perf_counter() - start_time
+
+    result = {'segments': args.segments, 'index_seconds': round(index_seconds, 2)}
+    result.update(summarize(latencies, elapsed))
+    write_result(args.output, 'search', result)
+
+    if not args.keep:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import time
+import random
+import argparse
+
+from bson import BSON
+
+from api.models import FileModel
+from api.serialization import render
+from api.storage import SEGMENTS_LIST, SEGMENTS_PACKED, pack_file, presentation, render_file, unpack_file
+from benchmarks.utils import summarize, write_result
+
+WORDS = (
+    'the a of to and in that is was he for it with as his on be at by i this had not are but from or have an they '
+    'which one you were her all she there would their we him been has when who will more no if out so said what up '
+    'its about into than them can only other new some could time these two may then do first any my now such like '
+    'our over man me even most made after also did many before must through back years where much your way well down'
+).split()
+
+
+def synthetic_file(file_id, segments, rng):
+    """
+    A file with segments of 8 to 40 words of a common vocabulary, about 4 seconds each.
+    """
+    return {
+        'fileId': file_id,
+        'processingStatus': 'FINISHED',
+        'fileName': 'bench.mp3',
+        'fileLength': segments * 4000,
+        'mp3Path': 'http://s3.amazonaws.com/snackable-test-audio/mp3Audio/bench.mp3',
+        'seriesTitle': 'Bench Series',
+        'segments': [{
+            'fileSegmentId': i,
+            'fileId': file_id,
+            'segmentText': ' '.join(rng.choices(WORDS, k=rng.randint(8, 40))),
+            'startTime': i * 4000 + rng.randint(0, 300),
+            'endTime': (i + 1) * 4000 + rng.randint(0, 300),
+        } for i in range(segments)],
+    }
+
+
+def decode_times(data, segments_format, repeat):
+    """
+    Seconds to decode a stored document into the file the API presents, as the load path does.
+    """
+    latencies = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        son = BSON(data).decode()
+        if segments_format == SEGMENTS_PACKED:
+            unpack_file(son)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Document size and decode time of the list and packed segments formats.")
+    parser.add_argument('--sizes', default='10,100,1000,5000,20000', help="comma separated segment counts.")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        son = render_file(FileModel(**synthetic_file(f'bench-format-{size}', size, rng)).to_son())
+        body = bytes(son['rendered'])
+        for segments_format in (SEGMENTS_LIST, SEGMENTS_PACKED):
+            # no GridFS here, the size is the one of the whole document.
+            data = BSON.encode(pack_file(dict(son), segments_format=segments_format, max_bytes=0))
+            without_body = BSON.encode({k: v for k, v in BSON(data).decode().items() if k != 'rendered'})
+            stored = unpack_file(BSON(data).decode())
+            result = {
+                'format': segments_format,
+                'segments': size,
+                'document_bytes': len(data),
+                # what a load of the whole file reads, the rendered body is left out.
+                'document_bytes_without_body': len(without_body),
+                'identical_output': render(presentation(stored)) == body,
+            }
+            result['decode'] = summarize(decode_times(without_body, segments_format, args.repeat))
+            write_result(args.output, 'segments_format', result)
+
+
+if __name__ == '__main__':
+    main()
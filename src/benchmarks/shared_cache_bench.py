@@ -0,0 +1,139 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from api.cache import LRUCache
+from api.shared_cache import SharedResponseCache
+from benchmarks.utils import summarize, write_result
+
+BACKENDS = ('worker', 'shared')
+
+
+def zipf_plan(requests_count, files, skew, rng):
+    """
+    File indexes of a run, file i being asked for with a weight of 1 / (i + 1) ** skew.
+    """
+    weights = [1.0 / (i + 1) ** skew for i in range(files)]
+    return rng.choices(range(files), weights=weights, k=requests_count)
+
+
+def response(index, size):
+    body = (f'{{"fileId": "bench-{index}", "segments": [' + '{"segmentText": "a segment"},' * (size // 28)).encode()
+    return 'etag', {'identity': body}, None
+
+
+def pss_kb():
+    """
+    Proportional set size of this process in KiB, shared pages are split between the processes mapping them.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def worker(cache_factory, planned, sizes, results):
+    cache = cache_factory()
+    pss_before = pss_kb()
+    hit_latencies = []
+    for index in planned:
+        key = f'bench-{index}'
+        start_time = time.perf_counter()
+        if cache.get(key) is not None:
+            hit_latencies.append(time.perf_counter() - start_time)
+        else:
+            # a miss stores the response, as the presentation endpoint does.
+            value = response(index, sizes[index])
+            cache.set(key, value, cache.generation(), size=len(value[1]['identity']))
+    pss_after = pss_kb()
+    stats = cache.stats()
+    results.put({
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'bytes': stats['bytes'],
+        'pss_kb': None if pss_before is None else pss_after - pss_before,
+        'hit_latencies': hit_latencies,
+    })
+
+
+def run(backend, workers, planned, sizes, max_entries, max_bytes, path):
+    """
+    Requests are spread round robin over the workers like gunicorn spreads connections.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    if backend == 'shared':
+        def cache_factory():
+            return SharedResponseCache(path, max_entries, max_bytes, ttl=3600)
+    else:
+        def cache_factory():
+            return LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=3600)
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(cache_factory, planned[i::workers], sizes, results))
+        for i in range(workers)
+    ]
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start_time
+
+    hits = sum(r['hits'] for r in reports)
+    pss = [r['pss_kb'] for r in reports if r['pss_kb'] is not None]
+    result = {
+        'backend': backend,
+        'workers': workers,
+        'hit_rate': round(hits / len(planned), 4),
+        'hit_rate_per_worker': [round(r['hits'] / max(r['hits'] + r['misses'], 1), 4) for r in reports],
+        # bytes of responses held by the host, the shared cache holds each response once.
+        'cached_bytes': reports[0]['bytes'] if backend == 'shared' else sum(r['bytes'] for r in reports),
+        'pss_growth_kb': sum(pss) if pss else None,
+        'elapsed_s': round(elapsed, 3),
+    }
+    result['hit'] = summarize([latency for r in reports for latency in r['hit_latencies']])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hit rate and memory of the per worker and the shared file cache.")
+    parser.add_argument('--workers', default='1,2,4,8', help="comma separated worker counts.")
+    parser.add_argument('--backend', choices=BACKENDS + ('all',), default='all')
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--skew', type=float, default=1.0, help="zipf exponent of the popularity of files.")
+    parser.add_argument('--max-entries', type=int, default=1000)
+    parser.add_argument('--max-bytes', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--path', default=os.path.join(tempfile.gettempdir(), 'snackable_bench_cache'))
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    planned = zipf_plan(args.requests, args.files, args.skew, rng)
+    # presentation responses of a few to some tens of KiB.
+    sizes = [int(rng.lognormvariate(9, 0.8)) for _ in range(args.files)]
+    backends = BACKENDS if args.backend == 'all' else (args.backend,)
+    for workers in (int(w) for w in args.workers.split(',')):
+        for backend in backends:
+            result = run(backend, workers, planned, sizes, args.max_entries, args.max_bytes, args.path)
+            result.update({'requests': args.requests, 'files': args.files, 'skew': args.skew,
+                           'max_entries': args.max_entries, 'max_bytes': args.max_bytes})
+            write_result(args.output, 'shared_cache', result)
+    if os.path.exists(args.path):
+        os.unlink(args.path)
+
+
+if __name__ == '__main__':
+    main()
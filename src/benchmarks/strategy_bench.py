@@ -0,0 +1,58 @@
+if __name__ == '__main__':
+    # patch before requests gets imported so that the load is generated by green threads.
+    from gevent import monkey
+    monkey.patch_all()
+
+import random
+import argparse
+
+import requests
+
+from benchmarks.load_bench import catalog, plan, report, run
+from benchmarks.utils import write_result
+
+WORKLOADS = ('cold', 'hot')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The gevent and asyncio strategies of the presentation API, head to head.")
+    parser.add_argument('--gevent', default='http://localhost:9002', help="base URL of the API served with JOBS_STRATEGY=gevent.")
+    parser.add_argument('--asyncio', default='http://localhost:9003', help="base URL of the API served with JOBS_STRATEGY=asyncio.")
+    parser.add_argument('--mock', default='http://localhost:9001', help="base URL of the mock processing API.")
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--hot-files', type=int, default=50, help="no. of files the hot requests ask for.")
+    parser.add_argument('--rounds', type=int, default=2, help="no. of times each strategy runs each workload, alternating.")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.jsonl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    file_ids = catalog(args.mock)
+    hot_ids, cold_ids = file_ids[:args.hot_files], file_ids[args.hot_files:]
+    if not hot_ids:
+        raise SystemExit("The mock catalog has no FINISHED files, set MOCK_FILES.")
+    mock_config = requests.get(f'{args.mock}/api/mock/config', timeout=10).json()
+    targets = (('gevent', args.gevent), ('asyncio', args.asyncio))
+
+    # both APIs share the database, so the hot files are stored once and
+    # every cold request of either strategy asks for a file nobody asked for.
+    for _, url in targets:
+        run(url, [('warmup', f) for f in hot_ids], args.concurrency, args.timeout)
+
+    for round_no in range(args.rounds):
+        for workload in WORKLOADS:
+            # the strategies take turns so that neither always runs first.
+            for strategy, url in (targets if round_no % 2 == 0 else targets[::-1]):
+                planned = plan(workload, args.requests, hot_ids, cold_ids, 0, rng)
+                asked = set(file_id for _, file_id in planned)
+                cold_ids = [f for f in cold_ids if f not in asked]
+                outcomes, elapsed = run(url, planned, args.concurrency, args.timeout)
+                result = report(workload, args.concurrency, outcomes, elapsed)
+                result.update({'strategy': strategy, 'round': round_no, 'catalog_files': len(file_ids), 'mock': mock_config})
+                write_result(args.output, 'strategy', result)
+
+
+if __name__ == '__main__':
+    main()
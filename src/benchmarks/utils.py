@@ -0,0 +1,51 @@
+import os
+import json
+import time
+import subprocess
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed=None):
+    """
+    Latency percentiles in milliseconds, and throughput if the wall clock time is given.
+    """
+    summary = {
+        'count': len(latencies),
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': round(1000 * percentile(latencies, 50), 3) if latencies else None,
+        'p95_ms': round(1000 * percentile(latencies, 95), 3) if latencies else None,
+        'p99_ms': round(1000 * percentile(latencies, 99), 3) if latencies else None,
+    }
+    if elapsed:
+        summary['throughput_rps'] = round(len(latencies) / elapsed, 2)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.environ.get('GIT_COMMIT', 'unknown')
+
+
+def write_result(path, benchmark, result):
+    """
+    Append a result as a JSON line so that runs can be compared across commits.
+    """
+    record = {'benchmark': benchmark, 'commit': git_commit(), 'timestamp': int(time.time())}
+    record.update(result)
+    print(json.dumps(record, indent=2))
+    if path:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return record
@@ -0,0 +1,25 @@
+import os
+
+# JOBS_STRATEGY=asyncio serves the ASGI app (api.asgi, AsyncioJobs) with uvicorn workers, see api/serve.py.
+worker_class = 'uvicorn.workers.UvicornWorker' if os.environ.get('JOBS_STRATEGY') == 'asyncio' else 'gevent'
+
+
+def on_starting(server):
+    # the metrics files of a previous run, see api.metrics.
+    from api.metrics import METRICS
+
+    METRICS.clear()
+
+
+def child_exit(server, worker):
+    # the gauges of a worker go with it, its counters and histograms are kept, see api.metrics.
+    from api.metrics import METRICS
+
+    METRICS.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # files a worker queued to be saved are written before it goes, see api.write_behind.
+    from api.write_behind import SAVE_QUEUE
+
+    SAVE_QUEUE.close()
@@ -1,10 +1,28 @@
+import os
+import math
+import time
+import uuid
+import random
 import logging
+
+import requests
 from flask import Flask, request, jsonify
 
 from core.logging_setup import setup_logging
 setup_logging()
 app = Flask(__name__)
 LOGGER = logging.getLogger(__name__)
+# the ingestion endpoint of the presentation API, e.g. http://api:9001/api/ingestion/files
+INGESTION_NOTIFY_URL = os.environ.get('INGESTION_NOTIFY_URL')
+INGESTION_TOKEN = os.environ.get('INGESTION_TOKEN')
+# no. of files of a synthetic catalog. 0 serves the hard-coded FILES below.
+MOCK_FILES = int(os.environ.get('MOCK_FILES', 0))
+MOCK_SEED = int(os.environ.get('MOCK_SEED', 42))
+# share of each status in the synthetic catalog.
+MOCK_STATUS_MIX = os.environ.get('MOCK_STATUS_MIX', 'FINISHED:0.8,PROCESSING:0.15,FAILED:0.05')
+# min:max no. of segments of a file.
+MOCK_SEGMENTS = os.environ.get('MOCK_SEGMENTS', '3:3')
+ENDPOINTS = ('all', 'details', 'segments')
 FILES = [
     {
         "fileId": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
@@ -48,8 +66,112 @@ FILES = [
     }
 ]
 
+
+def parse_status_mix(spec):
+    """
+    "FINISHED:0.8,PROCESSING:0.2" -> ([statuses], [weights])
+    """
+    pairs = [item.split(':') for item in spec.split(',') if item]
+    return [p[0] for p in pairs], [float(p[1]) for p in pairs]
+
+
+def parse_range(spec):
+    low, _, high = spec.partition(':')
+    return int(low), int(high or low)
+
+
+def generate_catalog(count, status_mix=MOCK_STATUS_MIX, segments=MOCK_SEGMENTS, seed=MOCK_SEED):
+    """
+    A synthetic catalog of count files. The same seed gives the same catalog,
+    so every worker and every benchmark run sees the same files.
+    Returns the file records and a dict of fileId -> no. of segments.
+    """
+    rng = random.Random(seed)
+    statuses, weights = parse_status_mix(status_mix)
+    low, high = parse_range(segments)
+    files, segment_counts = [], {}
+    for _ in range(count):
+        file_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        files.append({"fileId": file_id, "processingStatus": rng.choices(statuses, weights)[0]})
+        segment_counts[file_id] = rng.randint(low, high)
+    return files, segment_counts
+
+
+def parse_latency(spec):
+    """
+    A latency distribution in seconds, one of
+    none, fixed:<s>, uniform:<min>:<max>, exponential:<mean> or lognormal:<median>:<sigma>.
+    """
+    kind, *args = (spec or 'none').split(':')
+    args = [float(a) for a in args]
+    if kind == 'fixed':
+        return lambda: args[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if kind == 'exponential':
+        return lambda: random.expovariate(1.0 / args[0])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    if kind == 'none':
+        return lambda: 0
+    raise ValueError(f"Unknown latency distribution {spec}.")
+
+
+# per endpoint latency distribution and error rate, e.g. MOCK_LATENCY_DETAILS=lognormal:0.05:0.6
+# and MOCK_ERROR_RATE_DETAILS=0.01. They can be changed at runtime through /api/mock/config.
+CONFIG = {
+    endpoint: {
+        'latency': os.environ.get(f'MOCK_LATENCY_{endpoint.upper()}', 'none'),
+        'error_rate': float(os.environ.get(f'MOCK_ERROR_RATE_{endpoint.upper()}', 0)),
+    } for endpoint in ENDPOINTS
+}
+LATENCIES = {endpoint: parse_latency(CONFIG[endpoint]['latency']) for endpoint in ENDPOINTS}
+SEGMENT_COUNTS = {}
+if MOCK_FILES > 0:
+    FILES, SEGMENT_COUNTS = generate_catalog(MOCK_FILES)
+    LOGGER.info(f"Serving a synthetic catalog of {len(FILES)} files.")
+
+
+def inject(endpoint):
+    """
+    Sleep for the configured latency of an endpoint and fail at its error rate.
+    Returns an error response or None.
+    """
+    delay = LATENCIES[endpoint]()
+    if delay > 0:
+        time.sleep(delay)
+    if random.random() < CONFIG[endpoint]['error_rate']:
+        return jsonify({"error": "Injected error."}), 500
+    return None
+
+
+@app.route('/api/mock/config', methods=['GET', 'POST'])
+def config():
+    """
+    Read or change the latency distribution and error rate of the endpoints, e.g.
+    {"details": {"latency": "lognormal:0.05:0.6", "error_rate": 0.01}}
+    """
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            for endpoint, settings in payload.items():
+                if endpoint not in ENDPOINTS:
+                    raise ValueError(f"Unknown endpoint {endpoint}.")
+                if 'latency' in settings:
+                    LATENCIES[endpoint] = parse_latency(settings['latency'])
+                    CONFIG[endpoint]['latency'] = settings['latency']
+                if 'error_rate' in settings:
+                    CONFIG[endpoint]['error_rate'] = float(settings['error_rate'])
+        except (TypeError, ValueError, IndexError) as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(CONFIG)
+
+
 @app.route('/api/file/all')
 def all():
+    error = inject('all')
+    if error:
+        return error
     try:
         limit = int(request.args.get('limit', 5))
     except (TypeError, ValueError) as e:
@@ -59,3 +181,57 @@ def all():
     except (TypeError, ValueError) as e:
         offset = 0
     return jsonify(FILES[offset*limit:(offset + 1)*limit])
+
+
+@app.route('/api/file/details/<file_id>')
+def details(file_id):
+    error = inject('details')
+    if error:
+        return error
+    return jsonify({
+        "fileName": file_id,
+        "fileLength": 2870700,
+        "mp3Path": f"https://s3.amazonaws.com/snackable-test-audio/mp3Audio/{file_id}.mp3",
+        "originalFilePath": f"https://s3.amazonaws.com/snackable-test-crawler-audio/{file_id}.mp3",
+        "seriesTitle": "Mock Series"
+    })
+
+
+@app.route('/api/file/segments/<file_id>')
+def segments(file_id):
+    error = inject('segments')
+    if error:
+        return error
+    return jsonify([
+        {
+            "fileSegmentId": i,
+            "fileId": file_id,
+            "segmentText": f"Mock segment {i} of {file_id}.",
+            "startTime": i * 4000,
+            "endTime": (i + 1) * 4000
+        }
+        for i in range(SEGMENT_COUNTS.get(file_id, 3))
+    ])
+
+
+@app.route('/api/mock/files/<file_id>/finish', methods=['POST'])
+def finish(file_id):
+    """
+    Mark a file FINISHED and send the "file finished" notification
+    to the presentation API, like the processing service would.
+    """
+    records = [r for r in FILES if r['fileId'] == file_id]
+    if not records:
+        records = [{"fileId": file_id}]
+        FILES.append(records[0])
+    for record in records:
+        record['processingStatus'] = 'FINISHED'
+
+    if not INGESTION_NOTIFY_URL:
+        return jsonify({"fileId": file_id, "notified": False})
+    headers = {'X-Ingestion-Token': INGESTION_TOKEN} if INGESTION_TOKEN else {}
+    response = requests.post(
+        INGESTION_NOTIFY_URL, json={"fileId": file_id, "processingStatus": "FINISHED"}, headers=headers, timeout=5
+    )
+    LOGGER.info(f"Notified {INGESTION_NOTIFY_URL} of {file_id}, got {response.status_code}.")
+    return jsonify({"fileId": file_id, "notified": response.ok})